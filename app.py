@@ -1,14 +1,35 @@
 import urllib.parse
 import re
+import csv
+import gzip
+import io
 import pymysql
 import json
 import os
+import threading
 
-from flask import Flask, request, redirect, url_for, flash, render_template, jsonify, send_from_directory
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import Flask, Response, g, request, session, redirect, url_for, flash, render_template, jsonify, send_from_directory, stream_with_context
 from decimal import Decimal, InvalidOperation
 from datetime import datetime, timedelta
-from db import get_connection
-from costeo import costeo_bp
+import db
+from db import get_connection, pool_stats, schema_cache, invalidate_schema_cache, _connect_raw
+from costeo import costeo_bp, get_bom, invalidar_bom, costos_vigentes, costo_platillo, recalcular_costo_vigente, propagar_costos
+from eventos import publicar, sse_stream
+import archivo
+import catalogo
+import estaticos
+import eventos
+import jobs
+import clientes_busqueda
+import customer_stats
+import rollup
+import stock
+from filtros import FiltroFechas, meses_con_datos, rango_mes
 
 app = Flask(__name__)
 app.secret_key = "super_secret_key"
@@ -27,49 +48,150 @@ def privacy_policy():
 
 # COSTEO BLUEPRINT
 app.register_blueprint(costeo_bp)
+# JOBS PROGRAMADOS (/admin/jobs)
+app.register_blueprint(jobs.jobs_bp)
+
+# Columna phone_last10 (los índices y el backfill son del release): una vez por proceso,
+# antes de que algún handler abra su transacción sobre loyalty_customers
+@app.before_request
+def asegurar_esquema_clientes():
+    clientes_busqueda.asegurar_esquema()
+
+# Conexiones del pool que el handler no cerró: se regresan al terminar el request
+@app.teardown_request
+def liberar_conexiones(exc):
+    fugas = db.liberar_conexiones_hilo()
+    if fugas:
+        app.logger.warning("%s: %d conexión(es) sin cerrar regresadas al pool", request.path, fugas)
+
+# Scheduler de jobs: un hilo por worker, arrancado con su primer request
+@app.before_request
+def iniciar_jobs():
+    jobs.iniciar()
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
-@app.route('/menu')
-def menu():
-    conn = get_connection()
-    try:
-        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("SELECT * FROM productos WHERE activo = 1 ORDER BY categoria, nombre")
-            productos_db = cursor.fetchall()
+# /menu es pública (link de Instagram): la página se renderiza y comprime una vez por
+# versión del catálogo; cada visita es un lookup en memoria o un 304.
+_menu_pagina = {"etag": None}
+_menu_lock = threading.Lock()
 
-            cursor.execute("SELECT * FROM salsas ORDER BY nombre")
-            salsas_db = cursor.fetchall()
-    finally:
-        conn.close()
 
-    return render_template('menu.html', productos=productos_db, salsas=salsas_db)
+def _pagina_menu(cat):
+    global _menu_pagina
+    if _menu_pagina["etag"] == cat["etag"]:
+        return _menu_pagina
+    with _menu_lock:
+        if _menu_pagina["etag"] != cat["etag"]:
+            html = render_template('menu.html', productos=cat["productos"], salsas=cat["salsas"]).encode("utf-8")
+            cuerpos = {"identity": html, "gzip": gzip.compress(html, compresslevel=9)}
+            if brotli is not None:
+                cuerpos["br"] = brotli.compress(html, quality=11)
+            # Se reemplaza el dict completo: quien ya lo leyó nunca ve una página a medias
+            _menu_pagina = {"etag": cat["etag"], "modificado": cat["cargado_en"], "cuerpos": cuerpos}
+        return _menu_pagina
+
+
+@app.route('/menu')
+def menu():
+    cat = catalogo.get_catalogo()
+    if session.get("_flashes"):
+        # Con mensajes flash pendientes la página es de esta sesión: sin caché
+        return render_template('menu.html', productos=cat["productos"], salsas=cat["salsas"])
+
+    pagina = _pagina_menu(cat)
+    codificacion = "identity"
+    for enc in ("br", "gzip"):
+        if enc in pagina["cuerpos"] and request.accept_encodings[enc]:
+            codificacion = enc
+            break
+
+    resp = Response(pagina["cuerpos"][codificacion], mimetype="text/html")
+    if codificacion != "identity":
+        resp.headers["Content-Encoding"] = codificacion
+    resp.headers["Vary"] = "Accept-Encoding"
+    # Revalidar siempre: una edición de producto se ve en la siguiente visita
+    resp.headers["Cache-Control"] = "public, no-cache"
+    resp.set_etag(f'{pagina["etag"]}-{codificacion}')
+    resp.last_modified = pagina["modificado"]
+    return resp.make_conditional(request)
+
+@app.route('/api/catalogo')
+def api_catalogo():
+    # JSON del catálogo para el POS; el navegador revalida con If-None-Match y recibe 304
+    cat = catalogo.get_catalogo()
+    resp = Response(cat["json"], mimetype="application/json")
+    resp.set_etag(cat["etag"])
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# PDFs del menú (estaticos.py): /carta y /ver-pdf son los links estables que circulan
+# en redes; redirigen a la URL con hash, que se cachea como immutable y admite Range.
+def _redirigir_pdf(nombre):
+    ruta = estaticos.ruta_publicada(nombre)
+    if ruta is None:
+        # Sin build: el original directo (Range + ETag de send_file)
+        resp = send_from_directory(app.static_folder, nombre, conditional=True, max_age=300)
+        resp.headers["Cache-Control"] = estaticos.CACHE_ORIGINAL
+        return resp
+    publicado = ruta.split("/", 1)[1]
+    destino = f"{estaticos.BASE_URL}/{ruta}" if estaticos.BASE_URL else url_for("pdf_publicado", nombre=publicado)
+    resp = redirect(destino)
+    resp.headers["Cache-Control"] = estaticos.CACHE_ORIGINAL
+    return resp
 
 @app.route('/carta')
 def mostrar_carta():
-    return send_from_directory(app.static_folder, 'carta.pdf')
+    return _redirigir_pdf('carta.pdf')
 
 @app.route('/ver-pdf')
 def ver_pdf():
-    return send_from_directory(app.static_folder, 'menu_Mayo.pdf')
+    return _redirigir_pdf('menu_Mayo.pdf')
+
+@app.route('/pdf/<nombre>')
+def pdf_publicado(nombre):
+    if nombre not in estaticos.manifest().values():
+        return "No encontrado", 404
+    if estaticos.X_ACCEL:
+        # nginx transmite el archivo; el worker queda libre de inmediato
+        resp = Response(mimetype="application/pdf")
+        resp.headers["X-Accel-Redirect"] = f"{estaticos.X_ACCEL}/{nombre}"
+    else:
+        resp = send_from_directory(estaticos.DIST_DIR, nombre, conditional=True)
+    resp.headers["Cache-Control"] = estaticos.CACHE_INMUTABLE
+    return resp
 
 # =========================================================
 # ================== Raw Data =============================
 # =========================================================
 
+RAW_PAGINA = 200
+RAW_COLUMNAS = ["id", "fecha", "origen", "mesero", "total", "neto", "estado", "metodo_pago"]
+
+
+def _raw_filtro(mes, antes=None, antes_id=None):
+    # Keyset sobre (fecha, id) DESC: la página siguiente empieza después de la última fila vista
+    conds, params = FiltroFechas(meses=[mes] if mes else []).condiciones("fecha")
+    if antes is not None and antes_id is not None:
+        conds.append("(fecha < %s OR (fecha = %s AND id < %s))")
+        params.extend([antes, antes, antes_id])
+    return ("WHERE " + " AND ".join(conds)) if conds else "", params
+
+
 @app.route("/raw-data")
 def raw_data():
     mes = request.args.get("mes")
+    antes_id = request.args.get("antes_id", type=int)
+    try:
+        antes = datetime.fromisoformat(request.args["antes"]) if antes_id is not None and request.args.get("antes") else None
+    except ValueError:
+        antes = None
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            filtro = ""
-            params = []
-            if mes:
-                filtro = "WHERE DATE_FORMAT(fecha, '%%Y-%%m') = %s"
-                params.append(mes)
+            filtro, params = _raw_filtro(mes, antes, antes_id if antes else None)
 
             cursor.execute(f"""
                 SELECT id, fecha, DATE(fecha) as dia, 
@@ -77,25 +199,92 @@ def raw_data():
                 FROM pedidos
                 {filtro}
                 ORDER BY fecha DESC, id DESC
-            """, params)
-            todos_pedidos = cursor.fetchall()
+                LIMIT %s
+            """, params + [RAW_PAGINA + 1])
+            pagina = cursor.fetchall()
+            hay_mas = len(pagina) > RAW_PAGINA
+            pagina = pagina[:RAW_PAGINA]
 
             pedidos_agrupados = {}
-            for p in todos_pedidos:
+            for p in pagina:
                 dia_str = str(p['dia'])
                 if dia_str not in pedidos_agrupados:
                     pedidos_agrupados[dia_str] = []
                 pedidos_agrupados[dia_str].append(p)
 
-            cursor.execute("SELECT DISTINCT DATE_FORMAT(fecha, '%Y-%m') AS mes FROM pedidos ORDER BY mes DESC")
-            meses_disponibles = [m["mes"] for m in cursor.fetchall()]
+            meses_disponibles = meses_con_datos(cursor, "pedidos")
     finally:
         conn.close()
 
+    siguiente = None
+    if hay_mas:
+        ultimo = pagina[-1]
+        siguiente = url_for("raw_data", mes=mes or None, antes=ultimo["fecha"].isoformat(), antes_id=ultimo["id"])
+
     return render_template("raw_data.html", 
                            pedidos_agrupados=pedidos_agrupados, 
                            meses_disponibles=meses_disponibles, 
-                           mes=mes)
+                           mes=mes,
+                           paginado=antes is not None,
+                           siguiente=siguiente)
+
+
+@app.route("/raw-data/export.<formato>")
+def raw_data_export(formato):
+    # Cursor sin buffer (SSDictCursor): las filas se leen del socket conforme se envían,
+    # memoria constante aunque sea todo el historial
+    if formato not in ("csv", "ndjson"):
+        return "Formato no soportado (csv o ndjson)", 404
+    # mes termina en el nombre del archivo (Content-Disposition): solo YYYY-MM o nada
+    mes = request.args.get("mes") or None
+    if mes is not None and not (re.fullmatch(r"\d{4}-\d{2}", mes) and rango_mes(mes)):
+        return "Mes inválido (YYYY-MM)", 400
+    filtro, params = _raw_filtro(mes)
+
+    def generar():
+        # Conexión propia, fuera del pool: la descarga puede tardar minutos y el SET SESSION
+        # de abajo no debe quedarse en una conexión que luego usa otro request
+        conn = _connect_raw()
+        try:
+            with conn.cursor(pymysql.cursors.SSDictCursor) as cursor:
+                # Si el cliente lee lento, MySQL espera hasta net_write_timeout para escribir
+                cursor.execute("SET SESSION net_write_timeout = 600")
+                cursor.execute(f"""
+                    SELECT {", ".join(RAW_COLUMNAS)}
+                    FROM pedidos
+                    {filtro}
+                    ORDER BY fecha DESC, id DESC
+                """, params)
+
+                buffer = io.StringIO()
+                escritor = csv.writer(buffer)
+                if formato == "csv":
+                    escritor.writerow(RAW_COLUMNAS)
+                while True:
+                    filas = cursor.fetchmany(1000)
+                    if not filas:
+                        break
+                    for row in filas:
+                        if formato == "csv":
+                            escritor.writerow([row[c] for c in RAW_COLUMNAS])
+                        else:
+                            buffer.write(json.dumps(row, default=str, ensure_ascii=False) + "\n")
+                    # Se manda en bloques de ~64KB, no fila por fila
+                    if buffer.tell() >= 64 * 1024:
+                        yield buffer.getvalue()
+                        buffer.seek(0)
+                        buffer.truncate()
+                yield buffer.getvalue()
+        finally:
+            conn.close()
+
+    nombre = f"pedidos_{mes or 'todo'}.{formato}"
+    mimetype = "text/csv" if formato == "csv" else "application/x-ndjson"
+    return Response(generar(), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={nombre}",
+        # Sin buffer en el proxy: los primeros bytes salen de inmediato
+        "X-Accel-Buffering": "no",
+    })
 
 # =========================================================
 # ================== HELPERS ==============================
@@ -137,15 +326,8 @@ def normalize_phone_mx(raw: str) -> str | None:
     return None
 
 def table_has_column(cursor, table_name: str, col_name: str) -> bool:
-    cursor.execute("""
-        SELECT 1
-        FROM information_schema.COLUMNS
-        WHERE TABLE_SCHEMA = DATABASE()
-          AND TABLE_NAME = %s
-          AND COLUMN_NAME = %s
-        LIMIT 1
-    """, (table_name, col_name))
-    return cursor.fetchone() is not None
+    # Se responde desde memoria; information_schema solo se consulta al cargar/expirar la caché
+    return schema_cache.has_column(cursor, table_name, col_name)
 
 def wa_me_link(phone_e164: str, message_text: str) -> str:
     phone = (phone_e164 or "").replace("+", "")
@@ -185,14 +367,25 @@ def loyalty_get_or_create_customer(cursor, phone_e164: str) -> int:
     if row:
         return row["id"]
 
-    cursor.execute("INSERT INTO loyalty_customers (phone_e164) VALUES (%s)", (phone_e164,))
+    cursor.execute(
+        "INSERT INTO loyalty_customers (phone_e164, phone_last10) VALUES (%s, %s)",
+        (phone_e164, clientes_busqueda.phone_last10(phone_e164))
+    )
     customer_id = cursor.lastrowid
     cursor.execute("""
         INSERT INTO loyalty_accounts (customer_id, totopos_balance, totopos_lifetime)
         VALUES (%s,0,0)
     """, (customer_id,))
+    # Al índice en memoria solo después del commit (registrar_altas_clientes): si la
+    # transacción se revierte, el cliente no existe
+    g.setdefault("altas_clientes", []).append((customer_id, None, phone_e164))
     return customer_id
 
+
+def registrar_altas_clientes() -> None:
+    for cid, nombre, phone_e164 in g.pop("altas_clientes", []):
+        clientes_busqueda.registrar_alta(cid, nombre, phone_e164)
+
 def loyalty_add_totopos_for_purchase(cursor, customer_id: int, pedido_id: int, earned: int) -> int:
     if earned <= 0:
         cursor.execute("SELECT totopos_balance FROM loyalty_accounts WHERE customer_id=%s", (customer_id,))
@@ -200,7 +393,11 @@ def loyalty_add_totopos_for_purchase(cursor, customer_id: int, pedido_id: int, e
         return row["totopos_balance"] if row else 0
 
     cursor.execute("SELECT id FROM loyalty_tx WHERE customer_id=%s AND pedido_id=%s AND reason='purchase'", (customer_id, pedido_id))
-    if cursor.fetchone():
+    ya_registrado = cursor.fetchone()
+    if not ya_registrado and archivo.hay_archivo(cursor, "loyalty"):
+        cursor.execute("SELECT id FROM loyalty_tx_archivo WHERE customer_id=%s AND pedido_id=%s AND reason='purchase'", (customer_id, pedido_id))
+        ya_registrado = cursor.fetchone()
+    if ya_registrado:
         cursor.execute("SELECT totopos_balance FROM loyalty_accounts WHERE customer_id=%s", (customer_id,))
         row = cursor.fetchone()
         return row["totopos_balance"] if row else 0
@@ -216,6 +413,7 @@ def loyalty_add_totopos_for_purchase(cursor, customer_id: int, pedido_id: int, e
         INSERT INTO loyalty_tx (customer_id, pedido_id, delta, reason)
         VALUES (%s,%s,%s,'purchase')
     """, (customer_id, pedido_id, earned))
+    customer_stats.registrar_compra(cursor, customer_id, pedido_id)
 
     cursor.execute("SELECT totopos_balance FROM loyalty_accounts WHERE customer_id=%s", (customer_id,))
     row = cursor.fetchone()
@@ -261,17 +459,15 @@ def buscar_cliente():
     query = request.args.get("q", "").strip()
     if len(query) < 3:
         return jsonify([])
+    # Índice en memoria (clientes_busqueda.py); la BD solo si no se pudo cargar
+    try:
+        return jsonify(clientes_busqueda.indice_actual().buscar(query))
+    except pymysql.MySQLError:
+        app.logger.exception("Índice de clientes no disponible; búsqueda en BD")
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            search_val = f"%{query}%"
-            cursor.execute("""
-                SELECT id, nombre, phone_e164 
-                FROM loyalty_customers 
-                WHERE nombre LIKE %s OR phone_e164 LIKE %s
-                LIMIT 5
-            """, (search_val, search_val))
-            resultados = cursor.fetchall()
+            resultados = clientes_busqueda.buscar(cursor, query)
     finally:
         conn.close()
     return jsonify(resultados)
@@ -281,64 +477,53 @@ def buscar_cliente():
 # =============== INVENTARIO: DESCONTAR ===================
 # =========================================================
 
-def descontar_stock_por_pedido_cursor(cur, pedido_id: int) -> None:
-    cur.execute("""
-        SELECT
-            pi.cantidad AS cantidad_vendida,
-            p.platillo_id,
-            pi.proteina_id
-        FROM pedido_items pi
-        JOIN productos p ON p.id = pi.producto_id
-        WHERE pi.pedido_id = %s
-    """, (pedido_id,))
-    items = cur.fetchall()
-
-    if not items:
-        return
-
+def consumo_insumos(bom, items) -> dict:
+    # items: [{cantidad, platillo_id, proteina_id}] -> {insumo_id: cantidad_base total}
     consumo = {}
     for it in items:
         platillo_id = it.get("platillo_id")
         proteina_id = it.get("proteina_id")
-        qty = Decimal(str(it.get("cantidad_vendida") or 0))
+        qty = Decimal(str(it.get("cantidad") or 0))
 
         if not platillo_id or qty <= 0:
             continue
 
-        cur.execute("""
-            SELECT r.insumo_id, r.cantidad_base
-            FROM recetas r
-            JOIN insumos i ON i.id = r.insumo_id
-            WHERE r.platillo_id = %s
-              AND i.descuenta_stock = 1
-        """, (platillo_id,))
-        base_rows = cur.fetchall()
-
-        for r in base_rows:
-            insumo_id = int(r["insumo_id"])
-            cant_base = Decimal(str(r["cantidad_base"]))
-            consumo[insumo_id] = consumo.get(insumo_id, Decimal("0")) + (cant_base * qty)
+        for r in bom["recetas"].get(int(platillo_id), ()):
+            if r["descuenta_stock"]:
+                consumo[r["insumo_id"]] = consumo.get(r["insumo_id"], Decimal("0")) + (r["cantidad_base"] * qty)
 
         if proteina_id is not None:
-            cur.execute("SELECT proteina_cantidad_base FROM platillos WHERE id = %s LIMIT 1", (platillo_id,))
-            pr = cur.fetchone()
-            prot_qty_base = Decimal(str((pr or {}).get("proteina_cantidad_base") or 0))
+            pl = bom["platillos"].get(int(platillo_id)) or {}
+            prot_qty_base = Decimal(str(pl.get("proteina_cantidad_base") or 0))
+            insumo_prot = bom["proteinas"].get(int(proteina_id))
+            ins = bom["insumos"].get(insumo_prot) if insumo_prot else None
+
+            if prot_qty_base > 0 and ins and int(ins.get("descuenta_stock") or 0) == 1:
+                consumo[insumo_prot] = consumo.get(insumo_prot, Decimal("0")) + (prot_qty_base * qty)
+
+    return consumo
+
+
+def descontar_stock_por_pedido_cursor(cur, pedido_id: int) -> None:
+    # Una sola consulta por los items del pedido; recetas y proteínas salen de la caché BOM
+    cur.execute("""
+        SELECT pi.cantidad, p.platillo_id, pi.proteina_id
+        FROM pedido_items pi
+        JOIN productos p ON p.id = pi.producto_id
+        WHERE pi.pedido_id = %s
+    """, (pedido_id,))
+    items = cur.fetchall()
 
-            if prot_qty_base > 0:
-                cur.execute("SELECT insumo_id FROM proteinas WHERE id = %s LIMIT 1", (proteina_id,))
-                prow = cur.fetchone()
-                insumo_prot = (prow or {}).get("insumo_id")
+    if not items:
+        return
 
-                if insumo_prot:
-                    cur.execute("SELECT descuenta_stock FROM insumos WHERE id = %s LIMIT 1", (insumo_prot,))
-                    irow = cur.fetchone()
-                    if irow and int(irow.get("descuenta_stock") or 0) == 1:
-                        insumo_id = int(insumo_prot)
-                        consumo[insumo_id] = consumo.get(insumo_id, Decimal("0")) + (prot_qty_base * qty)
+    consumo = consumo_insumos(get_bom(cur), items)
 
     if not consumo:
         return
 
+    antes = stock.antes_de_insertar(cur, "salida_venta", "pedidos", [pedido_id])
+
     rows = []
     for insumo_id, total_salida in consumo.items():
         rows.append((
@@ -357,6 +542,8 @@ def descontar_stock_por_pedido_cursor(cur, pedido_id: int) -> None:
             (%s, %s, %s, %s, %s, %s)
     """, rows)
 
+    stock.despues_de_insertar(cur, "salida_venta", "pedidos", [pedido_id], antes)
+
 
 def descontar_stock_por_pedido(pedido_id: int) -> None:
     conn = get_connection()
@@ -373,53 +560,240 @@ def descontar_stock_por_pedido(pedido_id: int) -> None:
         conn.close()
 
 
+# =========================================================
+# ================== PRECIOS DEL CARRITO ==================
+# =========================================================
+
+def resolver_precios(cursor, producto_ids, origen: str) -> dict:
+    # Precio final por producto_id para todo el carrito en un solo SELECT ... IN
+    ids = sorted({int(x) for x in producto_ids if str(x).isdigit()})
+    if not ids:
+        return {}
+
+    has_uber = table_has_column(cursor, "productos", "precio_uber")
+    col_uber = ", precio_uber" if has_uber else ""
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"SELECT id, precio {col_uber} FROM productos WHERE id IN ({placeholders})", ids)
+
+    es_uber = (origen or "").strip().lower() == "uber"
+    precios = {}
+    for row in cursor.fetchall():
+        precio = row.get("precio_uber") if (es_uber and row.get("precio_uber") is not None) else row.get("precio")
+        if precio is None:
+            continue
+        precios[int(row["id"])] = Decimal(str(precio))
+    return precios
+
+
+_autoinc_step = None
+
+def autoinc_step(cursor) -> int:
+    # auto_increment_increment es configuración del servidor: se lee una vez por proceso
+    global _autoinc_step
+    if _autoinc_step is None:
+        cursor.execute("SELECT @@auto_increment_increment AS step")
+        row = cursor.fetchone()
+        _autoinc_step = int((row or {}).get("step") or 1)
+    return _autoinc_step
+
+
+def insertar_items_pedido(cursor, pedido_id: int, items) -> None:
+    # Inserta los platillos padre en un solo INSERT multi-fila, deduce sus ids del rango
+    # contiguo de auto-increment y luego inserta todos los extras ya ligados con item_padre_id.
+    has_prot_id = table_has_column(cursor, "pedido_items", "proteina_id")
+    has_salsa_id = table_has_column(cursor, "pedido_items", "salsa_id")
+    has_padre_id = table_has_column(cursor, "pedido_items", "item_padre_id")
+
+    cols = ["pedido_id", "producto_id", "proteina", "sin", "nota", "cantidad", "precio_unitario", "subtotal"]
+    if has_prot_id: cols.append("proteina_id")
+    if has_salsa_id: cols.append("salsa_id")
+
+    def row_vals(it):
+        vals = [pedido_id, it["producto_id"], it["proteina"], it["sin"], it["nota"], it["cantidad"], it["precio_unitario"], it["subtotal"]]
+        if has_prot_id: vals.append(it["proteina_id"])
+        if has_salsa_id: vals.append(it["salsa_id"])
+        return vals
+
+    def insert_multi(columns, rows):
+        row_ph = "(" + ",".join(["%s"] * len(columns)) + ")"
+        params = [v for r in rows for v in r]
+        cursor.execute(f"INSERT INTO pedido_items ({','.join(columns)}) VALUES {','.join([row_ph] * len(rows))}", params)
+        return cursor.lastrowid
+
+    # Solo es extra si tiene un padre asignado. Ignoramos si dice "Para:" en la nota.
+    padres = [it for it in items if it["padre_index"] is None]
+    extras = [it for it in items if it["padre_index"] is not None]
+
+    index_to_db_id = {}
+    if padres:
+        first_id = insert_multi(cols, [row_vals(it) for it in padres])
+        step = autoinc_step(cursor)
+        for n, it in enumerate(padres):
+            index_to_db_id[it["original_index"]] = first_id + n * step
+
+    if extras:
+        cols_extra = list(cols)
+        rows_extra = []
+        if has_padre_id:
+            cols_extra.append("item_padre_id")
+        for it in extras:
+            vals = row_vals(it)
+            if has_padre_id:
+                vals.append(index_to_db_id.get(it["padre_index"]))
+            rows_extra.append(vals)
+        insert_multi(cols_extra, rows_extra)
+
+
 # ================== PEDIDOS ABIERTOS ==================
+def cargar_tablero_cocina(cursor, pedido_id=None) -> list:
+    # Todos los pedidos abiertos (o solo pedido_id) con sus items en una sola consulta; se
+    # agrupan aquí por pedido_id y los extras quedan colgados de su platillo padre (item_padre_id).
+    has_mesa = table_has_column(cursor, "pedidos", "mesa")
+    has_salsa_id = table_has_column(cursor, "pedido_items", "salsa_id")
+    has_padre_id = table_has_column(cursor, "pedido_items", "item_padre_id")
+
+    col_mesa = "pe.mesa" if has_mesa else "NULL AS mesa"
+    col_padre = "pi.item_padre_id" if has_padre_id else "NULL AS item_padre_id"
+    col_salsa = "s.nombre AS salsa" if has_salsa_id else "NULL AS salsa"
+    join_salsa = "LEFT JOIN salsas s ON pi.salsa_id = s.id" if has_salsa_id else ""
+    filtro_pedido = "AND pe.id = %s" if pedido_id is not None else ""
+    params = (pedido_id,) if pedido_id is not None else ()
+
+    cursor.execute(f"""
+        SELECT
+            pe.id AS pedido_id, pe.fecha, pe.origen, pe.mesero, pe.total, {col_mesa},
+            pi.id AS item_id,
+            pr.nombre,
+            pi.cantidad,
+            pi.proteina,
+            pi.sin AS modificadores,
+            pi.nota AS notas,
+            {col_salsa},
+            COALESCE(pi.entregado, 0) AS entregado,
+            {col_padre}
+        FROM pedidos pe
+        LEFT JOIN pedido_items pi ON pi.pedido_id = pe.id
+        LEFT JOIN productos pr ON pr.id = pi.producto_id
+        {join_salsa}
+        WHERE pe.estado = 'abierto' {filtro_pedido}
+        ORDER BY pe.fecha DESC, pe.id DESC, pi.id ASC
+    """, params)
+
+    pedidos = []
+    por_id = {}
+    for row in cursor.fetchall():
+        p = por_id.get(row["pedido_id"])
+        if p is None:
+            p = {
+                "id": row["pedido_id"],
+                "fecha": row["fecha"],
+                "origen": row["origen"],
+                "mesero": row["mesero"],
+                "total": row["total"],
+                "mesa": row["mesa"],
+                "items_preview": [],
+            }
+            por_id[row["pedido_id"]] = p
+            pedidos.append(p)
+
+        if row["item_id"] is None:
+            continue
+
+        p["items_preview"].append({
+            "id": row["item_id"],
+            "nombre": row["nombre"],
+            "cantidad": row["cantidad"],
+            "proteina": row["proteina"],
+            "modificadores": row["modificadores"],
+            "notas": row["notas"],
+            "salsa": row["salsa"],
+            "entregado": int(row["entregado"] or 0),
+            "item_padre_id": row["item_padre_id"],
+            "hijos": [],
+        })
+
+    for p in pedidos:
+        items_por_id = {it["id"]: it for it in p["items_preview"]}
+        for it in p["items_preview"]:
+            padre = items_por_id.get(it["item_padre_id"]) if it["item_padre_id"] else None
+            if padre is not None:
+                padre["hijos"].append(it)
+
+    return pedidos
+
+
+def tablero_cocina_json(pedidos) -> list:
+    data = []
+    for p in pedidos:
+        d = dict(p)
+        d["fecha"] = p["fecha"].isoformat(sep=" ") if hasattr(p["fecha"], "isoformat") else p["fecha"]
+        d["total"] = float(p["total"] or 0)
+        d["items_preview"] = [
+            {k: v for k, v in it.items() if k != "hijos"} | {"hijos": [h["id"] for h in it["hijos"]]}
+            for it in p["items_preview"]
+        ]
+        data.append(d)
+    return data
+
+
 @app.route("/pedidos_abiertos")
 def pedidos_abiertos():
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            has_mesa = table_has_column(cursor, "pedidos", "mesa")
-            col_mesa = ", mesa" if has_mesa else ""
+            pedidos = cargar_tablero_cocina(cursor)
+    finally:
+        conn.close()
 
-            cursor.execute(f"""
-                SELECT id, fecha, origen, mesero, total {col_mesa}
-                FROM pedidos
-                WHERE estado = 'abierto'
-                ORDER BY fecha DESC
-            """)
-            pedidos = cursor.fetchall()
+    return render_template("pedidos_abiertos.html", pedidos=pedidos)
 
-            has_salsa_id = table_has_column(cursor, "pedido_items", "salsa_id")
-            has_padre_id = table_has_column(cursor, "pedido_items", "item_padre_id")
 
-            col_padre = "pi.item_padre_id" if has_padre_id else "NULL AS item_padre_id"
-            col_salsa = "s.nombre AS salsa" if has_salsa_id else "NULL AS salsa"
-            join_salsa = "LEFT JOIN salsas s ON pi.salsa_id = s.id" if has_salsa_id else ""
+@app.get("/pedidos_abiertos/<int:pedido_id>/tarjeta")
+def tarjeta_pedido_abierto(pedido_id):
+    # Una sola tarjeta del tablero: el stream avisa pedido_creado/pedido_actualizado y cada
+    # pantalla pide solo ese pedido en vez del tablero completo. 404 si ya no está abierto.
+    conn = get_connection()
+    try:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            pedidos = cargar_tablero_cocina(cursor, pedido_id=pedido_id)
+    finally:
+        conn.close()
 
-            for p in pedidos:
-                cursor.execute(f"""
-                    SELECT 
-                        pi.id, 
-                        pr.nombre, 
-                        pi.cantidad, 
-                        pi.proteina, 
-                        pi.sin AS modificadores, 
-                        pi.nota AS notas,
-                        {col_salsa},
-                        COALESCE(pi.entregado, 0) AS entregado,
-                        {col_padre}
-                    FROM pedido_items pi
-                    JOIN productos pr ON pr.id = pi.producto_id
-                    {join_salsa}
-                    WHERE pi.pedido_id = %s
-                    ORDER BY pi.id ASC
-                """, (p["id"],))
-                p["items_preview"] = cursor.fetchall()
+    if not pedidos:
+        return "", 404
+    return render_template("kds_card.html", p=pedidos[0])
+
+
+@app.get("/api/pedidos_abiertos")
+def api_pedidos_abiertos():
+    conn = get_connection()
+    try:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            pedidos = cargar_tablero_cocina(cursor)
     finally:
         conn.close()
 
-    return render_template("pedidos_abiertos.html", pedidos=pedidos)
+    return jsonify({"pedidos": tablero_cocina_json(pedidos)})
+
+
+@app.get("/api/pedidos_abiertos/stream")
+def stream_pedidos_abiertos():
+    # Server-Sent Events: deltas del tablero (no toma conexión de BD mientras está abierto)
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+    last_id = int(last_id) if last_id and str(last_id).isdigit() else None
+    q = eventos.broker.subscribe(last_id)
+    if q is None:
+        # Tope de streams en este worker: el tablero reintenta con espera creciente
+        return "Demasiados streams abiertos", 503, {"Retry-After": "60"}
+    eventos.iniciar_sondeo()
+    resp = Response(
+        stream_with_context(sse_stream(q)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # También si el generador nunca llega a arrancar
+    resp.call_on_close(lambda: eventos.broker.unsubscribe(q))
+    return resp
 
 
 # =========================================================
@@ -428,17 +802,15 @@ def pedidos_abiertos():
 
 @app.route("/nuevo_pedido", methods=["GET", "POST"])
 def nuevo_pedido():
+    # GET no toca MySQL mientras el catálogo en memoria esté vigente
+    cat = catalogo.get_catalogo()
+    if request.method != "POST":
+        return render_template("nuevo_pedido.html", productos=cat["productos"], salsas=cat["salsas"], proteinas=cat["proteinas"])
+
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
 
-            cursor.execute("SELECT * FROM productos WHERE activo = 1 ORDER BY categoria, nombre")
-            productos = cursor.fetchall()
-            cursor.execute("SELECT * FROM salsas ORDER BY nombre")
-            salsas = cursor.fetchall()
-            cursor.execute("SELECT * FROM proteinas ORDER BY nombre")
-            top_productos = cursor.fetchall()
-
             if request.method == "POST":
                 fecha = request.form.get("fecha")
                 if not fecha:
@@ -477,6 +849,7 @@ def nuevo_pedido():
 
                 total_bruto = Decimal("0")
                 items = []
+                precios = resolver_precios(cursor, productos_ids, origen)
 
                 for i, prod_id in enumerate(productos_ids):
                     if not str(prod_id).isdigit(): continue
@@ -485,20 +858,9 @@ def nuevo_pedido():
                     cant = int(cant_raw) if str(cant_raw).strip().isdigit() else 0
                     if cant <= 0: continue
 
-                    if table_has_column(cursor, "productos", "precio_uber"):
-                        cursor.execute("""
-                            SELECT CASE
-                                WHEN %s = 'uber' AND precio_uber IS NOT NULL THEN precio_uber
-                                ELSE precio END AS precio_final
-                            FROM productos WHERE id = %s
-                        """, (origen, int(prod_id)))
-                    else:
-                        cursor.execute("SELECT precio AS precio_final FROM productos WHERE id=%s", (int(prod_id),))
-
-                    row = cursor.fetchone()
-                    if not row or row.get("precio_final") is None: continue
+                    precio_unit = precios.get(int(prod_id))
+                    if precio_unit is None: continue
 
-                    precio_unit = Decimal(str(row["precio_final"]))
                     subtotal = precio_unit * cant
                     total_bruto += subtotal
 
@@ -541,47 +903,8 @@ def nuevo_pedido():
                 cursor.execute(f"INSERT INTO pedidos ({colsql}) VALUES ({placeholders})", tuple(vals))
                 pedido_id = cursor.lastrowid
 
-                has_prot_id = table_has_column(cursor, "pedido_items", "proteina_id")
-                has_salsa_id = table_has_column(cursor, "pedido_items", "salsa_id")
-                has_padre_id = table_has_column(cursor, "pedido_items", "item_padre_id")
-
-                index_to_db_id = {}
-                extras_to_insert = []
-
-                for it in items:
-                    # --- CORRECCIÓN --- 
-                    # Solo es extra si tiene un padre asignado. Ignoramos si dice "Para:" en la nota.
-                    es_extra = (it["padre_index"] is not None)
-
-                    if not es_extra:
-                        cols_it = ["pedido_id", "producto_id", "proteina", "sin", "nota", "cantidad", "precio_unitario", "subtotal"]
-                        vals_it = [pedido_id, it["producto_id"], it["proteina"], it["sin"], it["nota"], it["cantidad"], it["precio_unitario"], it["subtotal"]]
-
-                        if has_prot_id: cols_it.append("proteina_id"); vals_it.append(it["proteina_id"])
-                        if has_salsa_id: cols_it.append("salsa_id"); vals_it.append(it["salsa_id"])
-
-                        placeholders_it = ",".join(["%s"] * len(cols_it))
-                        cursor.execute(f"INSERT INTO pedido_items ({','.join(cols_it)}) VALUES ({placeholders_it})", tuple(vals_it))
-
-                        index_to_db_id[it["original_index"]] = cursor.lastrowid
-                    else:
-                        extras_to_insert.append(it)
-
-                for it in extras_to_insert:
-                    cols_it = ["pedido_id", "producto_id", "proteina", "sin", "nota", "cantidad", "precio_unitario", "subtotal"]
-                    vals_it = [pedido_id, it["producto_id"], it["proteina"], it["sin"], it["nota"], it["cantidad"], it["precio_unitario"], it["subtotal"]]
-
-                    if has_prot_id: cols_it.append("proteina_id"); vals_it.append(it["proteina_id"])
-                    if has_salsa_id: cols_it.append("salsa_id"); vals_it.append(it["salsa_id"])
-
-                    if has_padre_id:
-                        db_padre_id = index_to_db_id.get(it["padre_index"]) if it["padre_index"] is not None else None
-                        if db_padre_id:
-                            cols_it.append("item_padre_id")
-                            vals_it.append(db_padre_id)
-
-                    placeholders_it = ",".join(["%s"] * len(cols_it))
-                    cursor.execute(f"INSERT INTO pedido_items ({','.join(cols_it)}) VALUES ({placeholders_it})", tuple(vals_it))
+                insertar_items_pedido(cursor, pedido_id, items)
+                dias_rollup = rollup.dias_de_pedidos(cursor, [pedido_id])
 
                 if telefono_e164:
                     customer_id = loyalty_get_or_create_customer(cursor, telefono_e164)
@@ -589,8 +912,12 @@ def nuevo_pedido():
 
                 enviar_wa = request.form.get("enviar_wa") == "1"
 
+                publicar(cursor, "pedido_creado", pedido_id=pedido_id)
+                conn.commit()
+                registrar_altas_clientes()
+                rollup.refrescar_tras_commit(conn, dias_rollup)
+
                 if enviar_wa and telefono_e164:
-                    conn.commit()
                     ticket_text = generar_ticket_texto(pedido_id, cursor)
                     
                     cursor.execute("SELECT totopos_balance FROM loyalty_accounts WHERE customer_id=%s", (customer_id,))
@@ -607,13 +934,12 @@ def nuevo_pedido():
                         "redirect_url": url_for("ver_pedido", pedido_id=pedido_id)
                     })
                 else:
-                    conn.commit()
                     flash(f"Pedido #{pedido_id} creado y abierto", "success")
                     return redirect(url_for("ver_pedido", pedido_id=pedido_id))
     finally:
         conn.close()
 
-    return render_template("nuevo_pedido.html", productos=productos, salsas=salsas, proteinas=top_productos)
+    return render_template("nuevo_pedido.html", productos=cat["productos"], salsas=cat["salsas"], proteinas=cat["proteinas"])
 
 # =========================================================
 # GESTIÓN DE CLIENTES Y LEALTAD (TOTOPOS)
@@ -636,23 +962,26 @@ def lista_clientes():
                     if cursor.fetchone():
                         flash("Este cliente (teléfono) ya existe.", "warning")
                     else:
-                        cursor.execute("INSERT INTO loyalty_customers (nombre, phone_e164) VALUES (%s, %s)", (nombre, telefono))
+                        cursor.execute(
+                            "INSERT INTO loyalty_customers (nombre, phone_e164, phone_last10) VALUES (%s, %s, %s)",
+                            (nombre, telefono, clientes_busqueda.phone_last10(telefono))
+                        )
                         new_id = cursor.lastrowid
                         cursor.execute("INSERT INTO loyalty_accounts (customer_id, totopos_balance, totopos_lifetime) VALUES (%s, 0, 0)", (new_id,))
                         conn.commit()
+                        clientes_busqueda.registrar_alta(new_id, nombre, telefono)
                         flash(f"Cliente {nombre} registrado con éxito.", "success")
                 return redirect(url_for("lista_clientes"))
 
+            customer_stats.ensure_customer_stats_table()
             cursor.execute("""
                 SELECT 
                     c.id, c.nombre, c.phone_e164, 
                     a.totopos_balance, a.totopos_lifetime,
-                    (SELECT MAX(p.fecha) 
-                     FROM pedidos p 
-                     JOIN loyalty_tx tx ON p.id = tx.pedido_id 
-                     WHERE tx.customer_id = c.id) as ultima_compra
+                    s.last_purchase_at as ultima_compra
                 FROM loyalty_customers c
                 LEFT JOIN loyalty_accounts a ON c.id = a.customer_id
+                LEFT JOIN customer_stats s ON s.customer_id = c.id
                 ORDER BY a.totopos_balance DESC
             """)
             clientes = cursor.fetchall()
@@ -684,15 +1013,8 @@ def mi_perfil(phone=None):
         conn = get_connection()
         try:
             with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-                cursor.execute("""
-                    SELECT c.nombre, c.phone_e164, a.totopos_balance 
-                    FROM loyalty_customers c
-                    LEFT JOIN loyalty_accounts a ON c.id = a.customer_id
-                    WHERE c.phone_e164 = %s 
-                       OR c.phone_e164 = %s 
-                       OR REPLACE(c.phone_e164, ' ', '') LIKE %s
-                """, (telefono_mexico, ultimos_10, f"%{ultimos_10}%"))
-                cliente = cursor.fetchone()
+                # Igualdad sobre phone_last10 (índice); con menos de 10 dígitos no hay búsqueda
+                cliente = clientes_busqueda.por_telefono(cursor, telefono_mexico)
         finally:
             conn.close()
 
@@ -720,7 +1042,11 @@ def detalle_cliente(customer_id):
                 ajuste = int(request.form.get("ajuste_puntos", 0) or 0)
                 motivo = request.form.get("motivo", "Ajuste manual")
 
-                cursor.execute("UPDATE loyalty_customers SET nombre=%s, phone_e164=%s WHERE id=%s", (nombre, telefono, customer_id))
+                cursor.execute(
+                    "UPDATE loyalty_customers SET nombre=%s, phone_e164=%s, phone_last10=%s WHERE id=%s",
+                    (nombre, telefono, clientes_busqueda.phone_last10(telefono), customer_id)
+                )
+                clientes_busqueda.invalidar_indice(cursor)
 
                 if ajuste != 0:
                     cursor.execute("""
@@ -744,13 +1070,25 @@ def detalle_cliente(customer_id):
             """, (customer_id,))
             cliente = cursor.fetchone()
 
-            cursor.execute("""
-                SELECT tx.*, p.fecha 
-                FROM loyalty_tx tx
-                LEFT JOIN pedidos p ON tx.pedido_id = p.id
-                WHERE tx.customer_id = %s
-                ORDER BY tx.id DESC LIMIT 30
-            """, (customer_id,))
+            if archivo.hay_archivo(cursor, "loyalty"):
+                cursor.execute("""
+                    SELECT tx.*, p.fecha
+                    FROM (
+                        (SELECT * FROM loyalty_tx WHERE customer_id = %s ORDER BY id DESC LIMIT 30)
+                        UNION ALL
+                        (SELECT * FROM loyalty_tx_archivo WHERE customer_id = %s ORDER BY id DESC LIMIT 30)
+                    ) tx
+                    LEFT JOIN pedidos p ON tx.pedido_id = p.id
+                    ORDER BY tx.id DESC LIMIT 30
+                """, (customer_id, customer_id))
+            else:
+                cursor.execute("""
+                    SELECT tx.*, p.fecha 
+                    FROM loyalty_tx tx
+                    LEFT JOIN pedidos p ON tx.pedido_id = p.id
+                    WHERE tx.customer_id = %s
+                    ORDER BY tx.id DESC LIMIT 30
+                """, (customer_id,))
             historial = cursor.fetchall()
     finally:
         conn.close()
@@ -778,12 +1116,8 @@ def ver_pedido(pedido_id):
                 flash("Pedido no disponible", "error")
                 return redirect(url_for("pedidos_abiertos"))
 
-            cursor.execute("SELECT * FROM salsas ORDER BY nombre")
-            salsas = cursor.fetchall()
-            cursor.execute("SELECT * FROM proteinas ORDER BY nombre")
-            proteinas = cursor.fetchall()
-            cursor.execute("SELECT * FROM productos WHERE activo = 1 ORDER BY categoria, nombre")
-            productos = cursor.fetchall()
+            cat = catalogo.get_catalogo(cursor)
+            salsas, proteinas, productos = cat["salsas"], cat["proteinas"], cat["productos"]
 
             has_prot_id = table_has_column(cursor, "pedido_items", "proteina_id")
             has_salsa_id = table_has_column(cursor, "pedido_items", "salsa_id")
@@ -830,12 +1164,7 @@ def ver_pedido(pedido_id):
                 # --- CONTROL DE INVENTARIO PARA PEDIDOS CERRADOS ---
                 # Si el pedido ya estaba cerrado, eliminamos sus movimientos previos de stock antes de actualizar
                 if pedido.get("estado") == "cerrado":
-                    cursor.execute("""
-                        DELETE FROM inventario_movimientos
-                        WHERE tipo = 'salida_venta'
-                          AND ref_tabla = 'pedidos'
-                          AND ref_id = %s
-                    """, (pedido_id,))
+                    stock.borrar_movimientos(cursor, "salida_venta", "pedidos", [pedido_id])
 
                 fecha = request.form.get("fecha") or pedido.get("fecha")
                 origen = (request.form.get("origen") or "").strip().lower()
@@ -866,6 +1195,7 @@ def ver_pedido(pedido_id):
 
                 total_bruto = Decimal("0")
                 items_a_insertar = []
+                precios = resolver_precios(cursor, productos_ids, origen)
 
                 for i, prod_id in enumerate(productos_ids):
                     if not str(prod_id).isdigit(): continue
@@ -874,20 +1204,9 @@ def ver_pedido(pedido_id):
                     cant = int(cant_raw) if str(cant_raw).strip().isdigit() else 0
                     if cant <= 0: continue
 
-                    if table_has_column(cursor, "productos", "precio_uber"):
-                        cursor.execute("""
-                            SELECT CASE
-                                WHEN %s = 'uber' AND precio_uber IS NOT NULL THEN precio_uber
-                                ELSE precio END AS precio_final
-                            FROM productos WHERE id = %s
-                        """, (origen, int(prod_id)))
-                    else:
-                        cursor.execute("SELECT precio AS precio_final FROM productos WHERE id=%s", (int(prod_id),))
+                    precio_unit = precios.get(int(prod_id))
+                    if precio_unit is None: continue
 
-                    row_prod = cursor.fetchone()
-                    if not row_prod or row_prod.get("precio_final") is None: continue
-
-                    precio_unit = Decimal(str(row_prod["precio_final"]))
                     subtotal = precio_unit * cant
                     total_bruto += subtotal
 
@@ -919,41 +1238,7 @@ def ver_pedido(pedido_id):
 
                 # Limpiar items viejos e insertar los nuevos modificados
                 cursor.execute("DELETE FROM pedido_items WHERE pedido_id = %s", (pedido_id,))
-
-                index_to_db_id = {}
-                extras_to_insert = []
-
-                for it in items_a_insertar:
-                    es_extra = (it["padre_index"] is not None)
-
-                    if not es_extra:
-                        cols_it = ["pedido_id", "producto_id", "proteina", "sin", "nota", "cantidad", "precio_unitario", "subtotal"]
-                        vals_it = [pedido_id, it["producto_id"], it["proteina"], it["sin"], it["nota"], it["cantidad"], it["precio_unitario"], it["subtotal"]]
-
-                        if has_prot_id: cols_it.append("proteina_id"); vals_it.append(it["proteina_id"])
-                        if has_salsa_id: cols_it.append("salsa_id"); vals_it.append(it["salsa_id"])
-
-                        placeholders_it = ",".join(["%s"] * len(cols_it))
-                        cursor.execute(f"INSERT INTO pedido_items ({','.join(cols_it)}) VALUES ({placeholders_it})", tuple(vals_it))
-                        index_to_db_id[it["original_index"]] = cursor.lastrowid
-                    else:
-                        extras_to_insert.append(it)
-
-                for it in extras_to_insert:
-                    cols_it = ["pedido_id", "producto_id", "proteina", "sin", "nota", "cantidad", "precio_unitario", "subtotal"]
-                    vals_it = [pedido_id, it["producto_id"], it["proteina"], it["sin"], it["nota"], it["cantidad"], it["precio_unitario"], it["subtotal"]]
-
-                    if has_prot_id: cols_it.append("proteina_id"); vals_it.append(it["proteina_id"])
-                    if has_salsa_id: cols_it.append("salsa_id"); vals_it.append(it["salsa_id"])
-
-                    if has_padre_id:
-                        db_padre_id = index_to_db_id.get(it["padre_index"]) if it["padre_index"] is not None else None
-                        if db_padre_id:
-                            cols_it.append("item_padre_id")
-                            vals_it.append(db_padre_id)
-
-                    placeholders_it = ",".join(["%s"] * len(cols_it))
-                    cursor.execute(f"INSERT INTO pedido_items ({','.join(cols_it)}) VALUES ({placeholders_it})", tuple(vals_it))
+                insertar_items_pedido(cursor, pedido_id, items_a_insertar)
 
                 has_desc = table_has_column(cursor, "pedidos", "descuento")
                 update_query = """
@@ -972,6 +1257,7 @@ def ver_pedido(pedido_id):
                 
                 update_vals.append(pedido_id)
                 cursor.execute(update_query, tuple(update_vals))
+                dias_rollup = rollup.dias_de_pedidos(cursor, [pedido_id], dias_extra=[pedido.get("fecha")])
 
                 # --- RE-APLICAR INVENTARIO SI EL PEDIDO YA ESTABA CERRADO ---
                 if pedido.get("estado") == "cerrado":
@@ -982,7 +1268,13 @@ def ver_pedido(pedido_id):
                     # El programa de lealtad ignora duplicados por purchase usando la restricción unique/tx_check en loyalty_tx
                     loyalty_add_totopos_for_purchase(cursor, customer_id, pedido_id, 1)
 
+                # Total o fecha pudieron cambiar: recalcular a los clientes ligados al pedido
+                customer_stats.refrescar_clientes(cursor, customer_stats.clientes_de_pedidos(cursor, [pedido_id]))
+
+                publicar(cursor, "pedido_actualizado", pedido_id=pedido_id)
                 conn.commit()
+                registrar_altas_clientes()
+                rollup.refrescar_tras_commit(conn, dias_rollup)
 
                 if enviar_wa and telefono_e164:
                     ticket_text = generar_ticket_texto(pedido_id, cursor)
@@ -1128,6 +1420,7 @@ def cerrar_pedido(pedido_id):
 
             cursor.execute("UPDATE pedidos SET estado='cerrado' WHERE id=%s", (pedido_id,))
             descontar_stock_por_pedido_cursor(cursor, pedido_id)
+            publicar(cursor, "pedido_cerrado", pedido_id=pedido_id)
             conn.commit()
             flash("Pedido cerrado correctamente (inventario actualizado)", "success")
             return redirect(url_for("pedidos_abiertos"))
@@ -1161,9 +1454,12 @@ def cerrar_pedido_whatsapp(pedido_id):
                 ticket_text = generar_ticket_texto(pedido_id, cursor)
                 msg_loyalty = loyalty_message(balance, 1, pedido_id, Decimal(str(pedido["total"])), phone)
                 full_message = ticket_text + "\n\n" + msg_loyalty
+                publicar(cursor, "pedido_cerrado", pedido_id=pedido_id)
                 conn.commit()
+                registrar_altas_clientes()
                 return redirect(wa_me_link(phone, full_message))
 
+            publicar(cursor, "pedido_cerrado", pedido_id=pedido_id)
             conn.commit()
             flash("Pedido cerrado. No se envió WhatsApp porque no hay teléfono.", "success")
             return redirect(url_for("pedidos_abiertos"))
@@ -1213,6 +1509,7 @@ def productos():
                     INSERT INTO productos (nombre, categoria, costo, precio, platillo_id, activo)
                     VALUES (%s,%s,%s,%s,%s,1)
                 """, (nombre, categoria, str(costo), str(precio), platillo_id))
+                catalogo.invalidar_catalogo(cursor)
 
                 conn.commit()
                 flash("Producto agregado correctamente", "success")
@@ -1249,6 +1546,7 @@ def actualizar_platillo_producto(producto_id):
 
             costo = calcular_costo_platillo(cursor, platillo_id) if platillo_id else Decimal("0")
             cursor.execute("UPDATE productos SET platillo_id=%s, costo=%s WHERE id=%s", (platillo_id, str(costo), producto_id))
+            catalogo.invalidar_catalogo(cursor)
             conn.commit()
             flash("Producto actualizado (platillo + costo).", "success")
             return redirect(url_for("productos"))
@@ -1262,6 +1560,7 @@ def productos_set_platillo(producto_id):
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
             cursor.execute("UPDATE productos SET platillo_id = %s WHERE id = %s", (platillo_id, producto_id))
+            catalogo.invalidar_catalogo(cursor)
             conn.commit()
             flash("Relación producto -> platillo actualizada", "success")
     finally:
@@ -1286,6 +1585,7 @@ def compras():
             if not table_has_column(cursor, "insumos_compras", "oculto"):
                 cursor.execute("ALTER TABLE insumos_compras ADD COLUMN oculto INT DEFAULT 0")
                 conn.commit()
+                invalidate_schema_cache()
 
             cursor.execute("""
                 SELECT DISTINCT concepto 
@@ -1366,6 +1666,12 @@ def compras():
                         INSERT IGNORE INTO inventario_movimientos (insumo_id, cantidad_base, tipo, ref_tabla, ref_id, nota)
                         VALUES (%s, %s, 'entrada_compra', 'insumos_compras', %s, %s)
                     """, (int(insumo_id_val), str(cant_base_dec), compra_id, f"Entrada por compra #{compra_id}"))
+                    if cursor.rowcount == 1:
+                        stock.aplicar_deltas(cursor, {int(insumo_id_val): cant_base_dec})
+
+                if insumo_id_val and str(insumo_id_val).isdigit() and costo_unitario_val is not None:
+                    cambiados = recalcular_costo_vigente(cursor, [int(insumo_id_val)])
+                    propagar_costos(cursor, cambiados)
 
                 conn.commit()
                 flash("Compra registrada correctamente", "success")
@@ -1398,6 +1704,7 @@ def eliminar_concepto_compras():
         with conn.cursor() as cursor:
             if not table_has_column(cursor, "insumos_compras", "oculto"):
                 cursor.execute("ALTER TABLE insumos_compras ADD COLUMN oculto INT DEFAULT 0")
+                invalidate_schema_cache()
 
             cursor.execute("""
                 UPDATE insumos_compras 
@@ -1430,6 +1737,7 @@ def eliminar_insumo_compras():
     try:
         with conn.cursor() as cursor:
             cursor.execute("UPDATE insumos SET activo = 0 WHERE id = %s", (int(insumo_id),))
+            invalidar_bom(cursor)
             conn.commit()
 
             flash("Insumo eliminado de la lista exitosamente.", "success")
@@ -1454,65 +1762,40 @@ def dashboard():
     dias_seleccionados = request.args.getlist("dia_semana")
     origen_seleccionado = request.args.get("origen", "")
 
+    rollup.ensure_rollup_tables()
     conn = get_connection()
 
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("SELECT DISTINCT DATE_FORMAT(fecha, '%Y-%m') AS mes FROM pedidos ORDER BY mes DESC")
-            meses_disp_raw = cursor.fetchall()
-            meses_disponibles = [m["mes"] for m in meses_disp_raw]
-
-            conds_general = []
-            params_general = []
-
-            if meses_seleccionados:
-                placeholders = ",".join(["%s"] * len(meses_seleccionados))
-                conds_general.append(f"DATE_FORMAT({{campo_fecha}}, '%%Y-%%m') IN ({placeholders})")
-                params_general.extend(meses_seleccionados)
-            elif not fecha_inicio_seleccionada and not fecha_fin_seleccionada:
-                if meses_disponibles:
-                    last_m = meses_disponibles[0]
-                    conds_general.append("DATE_FORMAT({campo_fecha}, '%%Y-%%m') = %s")
-                    params_general.append(last_m)
-
-            if fecha_inicio_seleccionada:
-                conds_general.append("DATE({campo_fecha}) >= %s")
-                params_general.append(fecha_inicio_seleccionada)
-            if fecha_fin_seleccionada:
-                conds_general.append("DATE({campo_fecha}) <= %s")
-                params_general.append(fecha_fin_seleccionada)
-
-            p_dias = ""
-            if dias_seleccionados:
-                mapa_dias = {'Domingo': 1, 'Lunes': 2, 'Martes': 3, 'Miércoles': 4, 'Jueves': 5, 'Viernes': 6, 'Sábado': 7}
-                dias_num = [str(mapa_dias[d]) for d in dias_seleccionados if d in mapa_dias]
-                if dias_num:
-                    p_dias = ",".join(dias_num)
-                    conds_general.append(f"DAYOFWEEK({{campo_fecha}}) IN ({p_dias})")
-
-            conds_pedidos = list(conds_general)
-            params_pedidos = list(params_general)
-
-            if origen_seleccionado:
-                conds_pedidos.append("{campo_origen} = %s")
-                params_pedidos.append(origen_seleccionado)
-
-            def build_where(conds, c_fecha, c_origen="origen"):
-                if not conds: return ""
-                return "WHERE " + " AND ".join([c.replace("{campo_fecha}", c_fecha).replace("{campo_origen}", c_origen) for c in conds])
-
-            filtro_pedidos = build_where(conds_pedidos, "fecha", "origen")
-            filtro_compras = build_where(conds_general, "fecha")
-            filtro_ads = build_where(conds_general, "dia")
-            filtro_org = build_where(conds_general, "hora_publicacion")
-
-            filtro_tx_p = build_where(conds_pedidos, "p.fecha", "p.origen")
-            if filtro_tx_p.startswith("WHERE"):
-                filtro_tx_p = "AND " + filtro_tx_p[5:]
-
-            filtro_bcg = build_where(conds_pedidos, "pe.fecha", "pe.origen")
-
-            filtro_prev_pedidos = ""
+            # Ventas salen del rollup diario (rollup.py); compras, ads y lealtad siguen sobre sus tablas
+            meses_disponibles = meses_con_datos(cursor, "pedidos")
+
+            meses_filtro = list(meses_seleccionados)
+            if not meses_filtro and not fecha_inicio_seleccionada and not fecha_fin_seleccionada and meses_disponibles:
+                meses_filtro = [meses_disponibles[0]]
+
+            filtro = FiltroFechas(
+                meses=meses_filtro,
+                desde=fecha_inicio_seleccionada,
+                hasta=fecha_fin_seleccionada,
+                dias_semana=dias_seleccionados,
+            )
+
+            def con_origen(c_origen):
+                return [(f"{c_origen} = %s", origen_seleccionado)] if origen_seleccionado else []
+
+            # Los params solo dependen de los valores del filtro, no del nombre de la columna
+            filtro_pedidos, params_pedidos = filtro.sql("fecha", con_origen("origen"))
+            filtro_compras, params_general = filtro.sql("fecha")
+            filtro_ads, _ = filtro.sql("dia")
+            filtro_org, _ = filtro.sql("hora_publicacion")
+            filtro_tx_p, _ = filtro.sql("p.fecha", con_origen("p.origen"), prefijo="AND")
+            # loyalty_tx vivo, o vivo + archivo si el rango empieza antes del último corte (archivo.py)
+            tabla_tx = archivo.tabla_lectura(cursor, "loyalty", filtro.inicio)
+            filtro_rollup, _ = filtro.sql("dia", con_origen("origen"))
+            filtro_rollup_prod, _ = filtro.sql("r.dia", con_origen("r.origen"))
+
+            filtro_prev_rollup = ""
             filtro_prev_compras = ""
             params_prev_pedidos = []
             params_prev_compras = []
@@ -1524,28 +1807,15 @@ def dashboard():
                 prev_m = get_previous_month(meses_disponibles[0])
 
             if prev_m:
-                conds_prev = ["DATE_FORMAT({campo_fecha}, '%%Y-%%m') = %s"]
-                params_prev_base = [prev_m]
+                filtro_prev = FiltroFechas(meses=[prev_m], dias_semana=dias_seleccionados)
+                filtro_prev_rollup, params_prev_pedidos = filtro_prev.sql("dia", con_origen("origen"))
+                filtro_prev_compras, params_prev_compras = filtro_prev.sql("fecha")
 
-                if p_dias:
-                    conds_prev.append(f"DAYOFWEEK({{campo_fecha}}) IN ({p_dias})")
-
-                conds_prev_pedidos = list(conds_prev)
-                params_prev_pedidos = list(params_prev_base)
-
-                if origen_seleccionado:
-                    conds_prev_pedidos.append("{campo_origen} = %s")
-                    params_prev_pedidos.append(origen_seleccionado)
-
-                filtro_prev_pedidos = build_where(conds_prev_pedidos, "fecha", "origen")
-                filtro_prev_compras = build_where(conds_prev, "fecha")
-                params_prev_compras = list(params_prev_base)
-
-            cursor.execute(f"SELECT COUNT(DISTINCT DATE(fecha)) AS dias FROM pedidos {filtro_pedidos}", params_pedidos)
+            cursor.execute(f"SELECT COUNT(DISTINCT dia) AS dias FROM rollup_ventas_dia {filtro_rollup}", params_pedidos)
             dias_totales = int(cursor.fetchone()["dias"] or 1)
             meses_con_venta = len(meses_seleccionados) if meses_seleccionados else 1
 
-            cursor.execute(f"SELECT SUM(total) AS total FROM pedidos {filtro_pedidos}", params_pedidos)
+            cursor.execute(f"SELECT SUM(total) AS total FROM rollup_ventas_dia {filtro_rollup}", params_pedidos)
             total_ingresos = Decimal(str(cursor.fetchone()["total"] or 0))
 
             cursor.execute(f"SELECT SUM(costo) AS total FROM insumos_compras {filtro_compras}", params_general)
@@ -1555,8 +1825,8 @@ def dashboard():
             gross_margin_pct = ((total_ingresos - total_costos) / total_ingresos * 100) if total_ingresos > 0 else 0
 
             var_ingresos = var_costos = var_utilidad = 0
-            if filtro_prev_pedidos:
-                cursor.execute(f"SELECT SUM(total) AS total FROM pedidos {filtro_prev_pedidos}", params_prev_pedidos)
+            if filtro_prev_rollup:
+                cursor.execute(f"SELECT SUM(total) AS total FROM rollup_ventas_dia {filtro_prev_rollup}", params_prev_pedidos)
                 prev_ingresos = Decimal(str(cursor.fetchone()["total"] or 0))
 
                 cursor.execute(f"SELECT SUM(costo) AS total FROM insumos_compras {filtro_prev_compras}", params_prev_compras)
@@ -1573,7 +1843,7 @@ def dashboard():
                     COUNT(DISTINCT p.id) as pedidos_loyalty,
                     SUM(p.total) as ventas_loyalty
                 FROM pedidos p
-                JOIN loyalty_tx tx ON p.id = tx.pedido_id
+                JOIN {tabla_tx} tx ON p.id = tx.pedido_id
                 WHERE tx.reason = 'purchase' {filtro_tx_p}
             """, params_pedidos)
             loyalty_data = cursor.fetchone()
@@ -1583,7 +1853,7 @@ def dashboard():
 
             ventas_casual = total_ingresos - ventas_loyalty
 
-            cursor.execute(f"SELECT COUNT(id) as total_pedidos FROM pedidos {filtro_pedidos}", params_pedidos)
+            cursor.execute(f"SELECT SUM(pedidos) as total_pedidos FROM rollup_ventas_dia {filtro_rollup}", params_pedidos)
             total_pedidos_gral = int(cursor.fetchone()["total_pedidos"] or 0)
             pedidos_casuales = total_pedidos_gral - pedidos_loyalty
 
@@ -1600,7 +1870,7 @@ def dashboard():
             cursor.execute(f"""
                 SELECT c.nombre, c.phone_e164 as telefono, COUNT(DISTINCT p.id) as visitas, SUM(p.total) as gastado
                 FROM loyalty_customers c
-                JOIN loyalty_tx tx ON c.id = tx.customer_id
+                JOIN {tabla_tx} tx ON c.id = tx.customer_id
                 JOIN pedidos p ON tx.pedido_id = p.id
                 WHERE tx.reason = 'purchase' {filtro_tx_p}
                 GROUP BY c.id
@@ -1613,9 +1883,9 @@ def dashboard():
                 top_clientes.append(c)
 
             cursor.execute(f"""
-                SELECT DAY(fecha) as dia_num, DATE_FORMAT(fecha, '%%Y-%%m') as mes, SUM(total) as total
-                FROM pedidos
-                {filtro_pedidos}
+                SELECT DAY(dia) as dia_num, DATE_FORMAT(dia, '%%Y-%%m') as mes, SUM(total) as total
+                FROM rollup_ventas_dia
+                {filtro_rollup}
                 GROUP BY mes, dia_num
             """, params_pedidos)
             ventas_comp_raw = cursor.fetchall()
@@ -1639,8 +1909,8 @@ def dashboard():
                 gastos_comparativas[mes][r["dia_num"]] = float(r["total"] or 0)
 
             cursor.execute("""
-                SELECT DATE(fecha) as f, SUM(total) as total 
-                FROM pedidos 
+                SELECT dia as f, SUM(total) as total
+                FROM rollup_ventas_dia
                 GROUP BY f ORDER BY f
             """)
             historico_ingresos = [{"fecha": str(r["f"]), "total": float(r["total"] or 0)} for r in cursor.fetchall()]
@@ -1654,13 +1924,12 @@ def dashboard():
 
             cursor.execute(f"""
                 SELECT p.nombre,
-                       SUM(pi.cantidad) AS cantidad,
-                       SUM(pi.subtotal) AS ingreso_total,
-                       ((SUM(pi.subtotal) / SUM(pi.cantidad)) - COALESCE(p.costo, 0)) AS margen_unitario
-                FROM pedido_items pi
-                JOIN pedidos pe ON pe.id = pi.pedido_id
-                JOIN productos p ON p.id = pi.producto_id
-                {filtro_bcg}
+                       SUM(r.unidades) AS cantidad,
+                       SUM(r.ingreso) AS ingreso_total,
+                       ((SUM(r.ingreso) / SUM(r.unidades)) - COALESCE(p.costo, 0)) AS margen_unitario
+                FROM rollup_ventas_producto_dia r
+                JOIN productos p ON p.id = r.producto_id
+                {filtro_rollup_prod}
                 GROUP BY p.id, p.nombre, p.costo
                 ORDER BY ingreso_total DESC
             """, params_pedidos)
@@ -1672,16 +1941,16 @@ def dashboard():
 
             menu_engineering_data = [{"nombre": i["nombre"], "x": float(i["cantidad"]), "x_promedio": float(i["cantidad"] or 0)/dias_totales, "y": float(i["margen_unitario"]), "y_promedio": float(i["margen_unitario"])} for i in bcg_raw]
 
-            cursor.execute(f"SELECT HOUR(fecha) AS hora_num, COUNT(*) AS total_pedidos, SUM(total) AS total_dinero FROM pedidos {filtro_pedidos} GROUP BY HOUR(fecha) ORDER BY hora_num", params_pedidos)
+            cursor.execute(f"SELECT hora AS hora_num, SUM(pedidos) AS total_pedidos, SUM(total) AS total_dinero FROM rollup_ventas_dia {filtro_rollup} GROUP BY hora ORDER BY hora_num", params_pedidos)
             ventas_hora = [{"hora": f"{v['hora_num']}:00", "total": float(v["total_dinero"] or 0), "promedio": float(v["total_dinero"] or 0) / dias_totales} for v in cursor.fetchall()]
 
             cursor.execute(f"""
                 SELECT dia_num, nombre, ROUND(AVG(total_del_dia), 2) AS promedio, SUM(total_del_dia) AS total
                 FROM (
-                    SELECT DAYOFWEEK(fecha) AS dia_num,
-                           CASE DAYOFWEEK(fecha) WHEN 1 THEN 'Dom' WHEN 2 THEN 'Lun' WHEN 3 THEN 'Mar' WHEN 4 THEN 'Mie' WHEN 5 THEN 'Jue' WHEN 6 THEN 'Vie' WHEN 7 THEN 'Sab' END AS nombre,
-                           DATE(fecha) AS f, SUM(total) AS total_del_dia
-                    FROM pedidos {filtro_pedidos} GROUP BY DATE(fecha), dia_num, nombre
+                    SELECT DAYOFWEEK(dia) AS dia_num,
+                           CASE DAYOFWEEK(dia) WHEN 1 THEN 'Dom' WHEN 2 THEN 'Lun' WHEN 3 THEN 'Mar' WHEN 4 THEN 'Mie' WHEN 5 THEN 'Jue' WHEN 6 THEN 'Vie' WHEN 7 THEN 'Sab' END AS nombre,
+                           dia AS f, SUM(total) AS total_del_dia
+                    FROM rollup_ventas_dia {filtro_rollup} GROUP BY dia, dia_num, nombre
                 ) t
                 GROUP BY dia_num, nombre ORDER BY dia_num
             """, params_pedidos)
@@ -1690,16 +1959,14 @@ def dashboard():
             top_productos = bcg_raw[:10]
             cursor.execute(f"SELECT concepto, tipo_costo, COUNT(*) AS veces, SUM(costo) AS total_gastado FROM insumos_compras {filtro_compras} GROUP BY concepto, tipo_costo ORDER BY total_gastado DESC LIMIT 10", params_general)
             top_gastos = cursor.fetchall()
-            for g in top_gastos: 
-                g["promedio_gastado"] = float(g["total_gastado"] or 0) / meses_con_venta
+            for gasto in top_gastos: 
+                gasto["promedio_gastado"] = float(gasto["total_gastado"] or 0) / meses_con_venta
 
             cursor.execute(f"""
-                SELECT COALESCE(p.categoria, 'Otros') AS concepto, SUM(pi.subtotal) AS total
-                FROM pedido_items pi
-                JOIN pedidos pe ON pe.id = pi.pedido_id
-                JOIN productos p ON p.id = pi.producto_id
-                {filtro_bcg}
-                GROUP BY p.categoria
+                SELECT COALESCE(r.categoria, 'Otros') AS concepto, SUM(r.ingreso) AS total
+                FROM rollup_ventas_producto_dia r
+                {filtro_rollup_prod}
+                GROUP BY r.categoria
                 ORDER BY total DESC
             """, params_pedidos)
 
@@ -1746,7 +2013,7 @@ def dashboard():
             cac_global = float(total_gasto_ads) / total_pedidos_gral if total_pedidos_gral > 0 else 0
             roas_global = float(total_ingresos) / float(total_gasto_ads) if total_gasto_ads > 0 else 0
 
-            cursor.execute(f"SELECT DATE(fecha) as f, SUM(total) as total FROM pedidos {filtro_pedidos} GROUP BY DATE(fecha)", params_pedidos)
+            cursor.execute(f"SELECT dia as f, SUM(total) as total FROM rollup_ventas_dia {filtro_rollup} GROUP BY dia", params_pedidos)
             ventas_dict = {str(r["f"]): float(r["total"] or 0) for r in cursor.fetchall()}
 
             cursor.execute(f"""
@@ -1844,7 +2111,14 @@ def toggle_item_cocina(item_id):
     try:
         with conn.cursor() as cur:
             cur.execute("UPDATE pedido_items SET entregado = NOT entregado WHERE id = %s", (item_id,))
+            cur.execute("SELECT pedido_id, COALESCE(entregado, 0) AS entregado FROM pedido_items WHERE id = %s", (item_id,))
+            row = cur.fetchone()
+            if row:
+                publicar(cur, "item_toggled", pedido_id=row["pedido_id"], item_id=item_id, entregado=int(row["entregado"]))
             conn.commit()
+
+        if row:
+            return jsonify({"status": "success", "entregado": int(row["entregado"])})
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1886,8 +2160,11 @@ def eliminar_item_pedido(pedido_id, item_id):
                     neto = neto - %s
                 WHERE id = %s
             """, (subtotal, subtotal, pedido_id))
+            dias_rollup = rollup.dias_de_pedidos(cursor, [pedido_id])
 
+            publicar(cursor, "item_eliminado", pedido_id=pedido_id, item_id=item_id)
             conn.commit()
+            rollup.refrescar_tras_commit(conn, dias_rollup)
             flash("Producto eliminado del pedido", "success")
     finally:
         conn.close()
@@ -1908,20 +2185,22 @@ def eliminar_pedido(pedido_id):
                 return redirect(url_for("borrar_pedidos"))
 
             if (pedido.get("estado") or "") == "cerrado":
-                cursor.execute("""
-                    DELETE FROM inventario_movimientos
-                    WHERE tipo='salida_venta'
-                      AND ref_tabla='pedidos'
-                      AND ref_id=%s
-                """, (pedido_id,))
+                stock.borrar_movimientos(cursor, "salida_venta", "pedidos", [pedido_id])
 
+            clientes_afectados = set()
             if table_has_column(cursor, "loyalty_tx", "pedido_id"):
+                clientes_afectados = customer_stats.clientes_de_pedidos(cursor, [pedido_id])
                 cursor.execute("DELETE FROM loyalty_tx WHERE pedido_id=%s", (pedido_id,))
+                archivo.borrar_archivados(cursor, "loyalty", "pedido_id = %s", (pedido_id,))
 
+            dias_afectados = rollup.dias_de_pedidos(cursor, [pedido_id])
             cursor.execute("DELETE FROM pedido_items WHERE pedido_id=%s", (pedido_id,))
             cursor.execute("DELETE FROM pedidos WHERE id=%s", (pedido_id,))
+            customer_stats.refrescar_clientes(cursor, clientes_afectados)
 
+            publicar(cursor, "pedido_eliminado", pedido_id=pedido_id)
             conn.commit()
+            rollup.refrescar_tras_commit(conn, dias_afectados)
             flash(f"Pedido #{pedido_id} eliminado correctamente.", "success")
     except Exception as e:
         try: conn.rollback()
@@ -2064,13 +2343,9 @@ def borrar_pedidos():
         where.append("id = %s")
         params.append(int(pedido_id))
 
-    if desde:
-        where.append("DATE(fecha) >= %s")
-        params.append(desde)
-
-    if hasta:
-        where.append("DATE(fecha) <= %s")
-        params.append(hasta)
+    conds_fecha, params_fecha = FiltroFechas(desde=desde, hasta=hasta).condiciones("fecha")
+    where.extend(conds_fecha)
+    params.extend(params_fecha)
 
     filtro_sql = ("WHERE " + " AND ".join(where)) if where else ""
 
@@ -2108,6 +2383,10 @@ def borrar_pedidos_bulk():
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
             if modo == "borrar_todos_abiertos":
+                cursor.execute("SELECT DISTINCT DATE(fecha) AS dia FROM pedidos WHERE estado='abierto'")
+                dias_afectados = [r["dia"] for r in cursor.fetchall()]
+                cursor.execute("SELECT id FROM pedidos WHERE estado='abierto'")
+                clientes_afectados = customer_stats.clientes_de_pedidos(cursor, [r["id"] for r in cursor.fetchall()])
                 cursor.execute("""
                     DELETE pi
                     FROM pedido_items pi
@@ -2115,7 +2394,10 @@ def borrar_pedidos_bulk():
                     WHERE pe.estado = 'abierto'
                 """)
                 cursor.execute("DELETE FROM pedidos WHERE estado='abierto'")
+                customer_stats.refrescar_clientes(cursor, clientes_afectados)
+                publicar(cursor, "resync")
                 conn.commit()
+                rollup.refrescar_tras_commit(conn, dias_afectados)
                 flash("Se borraron TODOS los pedidos abiertos.", "success")
                 return redirect(url_for("borrar_pedidos", estado="abierto"))
 
@@ -2137,18 +2419,17 @@ def borrar_pedidos_bulk():
             cerrados = [r["id"] for r in cursor.fetchall()]
 
             if cerrados:
-                ph2 = ",".join(["%s"] * len(cerrados))
-                cursor.execute(f"""
-                    DELETE FROM inventario_movimientos
-                    WHERE tipo='salida_venta'
-                      AND ref_tabla='pedidos'
-                      AND ref_id IN ({ph2})
-                """, cerrados)
+                stock.borrar_movimientos(cursor, "salida_venta", "pedidos", cerrados)
 
+            dias_afectados = rollup.dias_de_pedidos(cursor, ids_int)
+            clientes_afectados = customer_stats.clientes_de_pedidos(cursor, ids_int)
             cursor.execute(f"DELETE FROM pedido_items WHERE pedido_id IN ({placeholders})", ids_int)
             cursor.execute(f"DELETE FROM pedidos WHERE id IN ({placeholders})", ids_int)
+            customer_stats.refrescar_clientes(cursor, clientes_afectados)
 
+            publicar(cursor, "resync")
             conn.commit()
+            rollup.refrescar_tras_commit(conn, dias_afectados)
             flash(f"Se borraron {len(ids_int)} pedido(s).", "success")
             return redirect(url_for("borrar_pedidos"))
     finally:
@@ -2166,11 +2447,15 @@ def ver_stock():
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cur:
+            # Saldo mantenido en stock_balance (stock.py); ya no se suma el ledger completo
+            stock.ensure_stock_balance_table()
             cur.execute("""
-                SELECT insumo_id, nombre, unidad_base, stock_actual
-                FROM vw_stock_actual
-                WHERE (%s = '' OR nombre LIKE %s)
-                ORDER BY nombre
+                SELECT i.id AS insumo_id, i.nombre, i.unidad_base, COALESCE(sb.stock, 0) AS stock_actual
+                FROM insumos i
+                LEFT JOIN stock_balance sb ON sb.insumo_id = i.id
+                WHERE i.activo = 1
+                  AND (%s = '' OR i.nombre LIKE %s)
+                ORDER BY i.nombre
             """, (q, f"%{q}%"))
             rows = cur.fetchall()
 
@@ -2217,6 +2502,7 @@ def agregar_stock():
                 VALUES
                     (%s, %s, 'entrada_manual', 'stock_ui', NULL, 'Entrada manual desde /inventario/stock')
             """, (int(insumo_id), str(cantidad)))
+            stock.aplicar_deltas(cur, {int(insumo_id): cantidad})
 
             conn.commit()
 
@@ -2240,6 +2526,7 @@ def eliminar_producto_producto(producto_id):
                 SET activo = 0
                 WHERE id = %s
             """, (producto_id,))
+            catalogo.invalidar_catalogo(cursor)
             conn.commit()
             flash("Producto eliminado (desactivado).", "success")
             return redirect(url_for("productos"))
@@ -2248,31 +2535,12 @@ def eliminar_producto_producto(producto_id):
 
 
 def calcular_costo_platillo(cursor, platillo_id: int) -> Decimal:
-    cursor.execute("""
-        SELECT
-            COALESCE(SUM(
-                (r.cantidad_base * (1 + (i.merma_pct / 100))) *
-                (
-                    CASE
-                        WHEN r.usa_precio_manual = 1 AND r.precio_manual IS NOT NULL
-                            THEN r.precio_manual
-                        ELSE COALESCE((
-                            SELECT ic.costo_unitario
-                            FROM insumos_compras ic
-                            WHERE ic.insumo_id = r.insumo_id
-                              AND ic.costo_unitario IS NOT NULL
-                            ORDER BY ic.fecha DESC, ic.id DESC
-                            LIMIT 1
-                        ), 0)
-                    END
-                )
-            ), 0) AS costo_platillo
-        FROM recetas r
-        JOIN insumos i ON i.id = r.insumo_id
-        WHERE r.platillo_id = %s
-    """, (platillo_id,))
-    row = cursor.fetchone()
-    return Decimal(str(row["costo_platillo"] or 0))
+    bom = get_bom(cursor)
+    lineas = bom["recetas"].get(int(platillo_id), [])
+    if not lineas:
+        return Decimal("0")
+    costos = costos_vigentes(cursor, [r["insumo_id"] for r in lineas if not (r["usa_precio_manual"] and r["precio_manual"] is not None)])
+    return costo_platillo(bom, costos, platillo_id)
 
 
 @app.get("/api/platillos/<int:platillo_id>/costo")
@@ -2341,6 +2609,7 @@ def platillo_set_proteina_qty(platillo_id):
                     cantidad_base = VALUES(cantidad_base)
             """, (platillo_id, proteina_id, insumo_id, str(cantidad_base)))
 
+            invalidar_bom(cur)
             conn.commit()
 
             ub = ins.get("unidad_base") or ""
@@ -2365,20 +2634,19 @@ def campanas():
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            # Rango sobre customer_stats.last_purchase_at (equivale a DATEDIFF(NOW(), ultima) >= dias)
+            customer_stats.ensure_customer_stats_table()
             cursor.execute("""
                 SELECT 
                     c.id, c.nombre, c.phone_e164, 
                     a.totopos_balance,
-                    MAX(p.fecha) as ultima_compra,
-                    DATEDIFF(NOW(), MAX(p.fecha)) as dias_ausente
-                FROM loyalty_customers c
-                JOIN loyalty_tx tx ON c.id = tx.customer_id
-                JOIN pedidos p ON tx.pedido_id = p.id
+                    s.last_purchase_at as ultima_compra,
+                    DATEDIFF(NOW(), s.last_purchase_at) as dias_ausente
+                FROM customer_stats s
+                JOIN loyalty_customers c ON c.id = s.customer_id
                 LEFT JOIN loyalty_accounts a ON c.id = a.customer_id
-                WHERE tx.reason = 'purchase'
-                GROUP BY c.id
-                HAVING dias_ausente >= %s
-                ORDER BY dias_ausente DESC
+                WHERE s.last_purchase_at < CURDATE() + INTERVAL 1 DAY - INTERVAL %s DAY
+                ORDER BY s.last_purchase_at ASC
             """, (dias,))
             clientes_inactivos = cursor.fetchall()
     finally:
@@ -2407,28 +2675,33 @@ def corte_caja():
     if not fecha_str:
         fecha_str = datetime.now().strftime("%Y-%m-%d")
 
+    filtro_dia, params_dia = FiltroFechas(dia=fecha_str).sql("fecha")
+    if not filtro_dia:
+        flash("Fecha inválida.", "error")
+        return redirect(url_for("corte_caja"))
+
     conn = get_connection()
     try:
         with conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT COUNT(*) as abiertos FROM pedidos 
-                WHERE DATE(fecha) = %s AND estado = 'abierto'
-            """, (fecha_str,))
+                {filtro_dia} AND estado = 'abierto'
+            """, params_dia)
             pedidos_abiertos = cursor.fetchone()["abiertos"]
 
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT COALESCE(metodo_pago, 'Otro') as metodo_pago, SUM(total) as total_ventas 
                 FROM pedidos 
-                WHERE DATE(fecha) = %s AND estado = 'cerrado'
+                {filtro_dia} AND estado = 'cerrado'
                 GROUP BY metodo_pago
-            """, (fecha_str,))
+            """, params_dia)
             ventas_dia = cursor.fetchall()
 
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT SUM(costo) as total_gastos 
                 FROM insumos_compras 
-                WHERE DATE(fecha) = %s
-            """, (fecha_str,))
+                {filtro_dia}
+            """, params_dia)
             gastos_row = cursor.fetchone()
             total_gastos = Decimal(str(gastos_row["total_gastos"] or 0))
 
@@ -2525,6 +2798,15 @@ def corte_caja():
         cortes=historial_cortes
     )
 
+# =========================================================
+# ================== POOL DE CONEXIONES ====================
+# =========================================================
+
+@app.get("/api/db_pool_stats")
+def api_db_pool_stats():
+    # Contadores por worker de gunicorn (hits/misses/esperas) para dimensionar DB_POOL_SIZE
+    return jsonify(pool_stats())
+
 # ================== RUN ==================
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,364 @@
+import os
+import sys
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from cache import VersionedCache, VERSION_CHECK_INTERVAL
+from db import get_connection, schema_cache, invalidate_schema_cache
+
+# =========================================================
+# Snapshots mensuales y archivo de ledgers
+# =========================================================
+# inventario_movimientos y loyalty_tx solo crecen. compactar() escribe un saldo de
+# apertura por insumo/cliente para cada mes cerrado (tabla *_snapshot) y mueve las filas
+# más viejas que la retención a *_archivo (misma estructura, CREATE TABLE ... LIKE).
+#
+#   saldo total = snapshot del último corte + filas vivas desde ese corte
+#
+# verificar() recalcula todo desde vivo + archivo y compara contra los snapshots.
+#
+#   python archivo.py compactar [meses_retencion]
+#   python archivo.py verificar
+
+RETENCION_MESES = int(os.getenv("ARCHIVO_RETENCION_MESES", 6))
+LOTE = 5000
+
+LEDGERS = {
+    "inventario": {
+        "tabla": "inventario_movimientos",
+        "archivo": "inventario_movimientos_archivo",
+        "snapshot": "inventario_snapshot",
+        "clave": "insumo_id",
+        "monto": "cantidad_base",
+    },
+    "loyalty": {
+        "tabla": "loyalty_tx",
+        "archivo": "loyalty_tx_archivo",
+        "snapshot": "loyalty_snapshot",
+        "clave": "customer_id",
+        "monto": "delta",
+    },
+}
+
+COL_FECHA = "created_at"
+
+
+def _siguiente_mes(d: date) -> date:
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+
+def _restar_meses(d: date, n: int) -> date:
+    total = d.year * 12 + (d.month - 1) - n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def _as_date(val):
+    if val is None:
+        return None
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    return datetime.strptime(str(val)[:10], "%Y-%m-%d").date()
+
+
+# =========================================================
+# Lectura (snapshot + cola viva)
+# =========================================================
+def _cargar_archivos(cursor) -> frozenset:
+    # Ledgers cuya tabla de snapshots ya existe (una sola consulta para todos)
+    por_tabla = {cfg["snapshot"]: nombre for nombre, cfg in LEDGERS.items()}
+    cursor.execute(f"""
+        SELECT TABLE_NAME AS tabla FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({','.join(['%s'] * len(por_tabla))})
+    """, list(por_tabla))
+    return frozenset(por_tabla[r["tabla"].lower()] for r in cursor.fetchall() if r["tabla"].lower() in por_tabla)
+
+
+# compactar() suele correr en otro proceso (CLI o job): crea las tablas de snapshots y
+# sube la versión "archivo" en cache_versiones, así el "no" también queda en memoria
+# y cada worker vuelve a information_schema solo cuando cambia esa versión
+archivos_cache = VersionedCache("archivo", _cargar_archivos)
+
+
+def hay_archivo(cursor, ledger: str) -> bool:
+    return ledger in archivos_cache.get(cursor)
+
+
+def ultimo_corte(cursor, ledger: str):
+    if not hay_archivo(cursor, ledger):
+        return None
+    cursor.execute(f"SELECT MAX(mes) AS mes FROM {LEDGERS[ledger]['snapshot']}")
+    row = cursor.fetchone()
+    return _as_date(row["mes"]) if row else None
+
+
+def tabla_lectura(cursor, ledger: str, desde=None) -> str:
+    # Tabla viva, o viva + archivo si el rango pedido empieza antes del último corte
+    cfg = LEDGERS[ledger]
+    corte = ultimo_corte(cursor, ledger)
+    if corte is None or (desde is not None and _as_date(desde) >= corte):
+        return cfg["tabla"]
+    return f"(SELECT * FROM {cfg['tabla']} UNION ALL SELECT * FROM {cfg['archivo']})"
+
+
+def saldos(cursor, ledger: str) -> dict:
+    cfg = LEDGERS[ledger]
+    corte = ultimo_corte(cursor, ledger)
+    if corte is None:
+        cursor.execute(f"""
+            SELECT {cfg['clave']} AS clave, SUM({cfg['monto']}) AS saldo
+            FROM {cfg['tabla']}
+            GROUP BY {cfg['clave']}
+        """)
+    else:
+        cursor.execute(f"""
+            SELECT clave, SUM(monto) AS saldo
+            FROM (
+                SELECT {cfg['clave']} AS clave, saldo_apertura AS monto FROM {cfg['snapshot']} WHERE mes = %s
+                UNION ALL
+                SELECT {cfg['clave']}, {cfg['monto']} FROM {cfg['tabla']} WHERE {COL_FECHA} >= %s
+            ) t
+            GROUP BY clave
+        """, (corte, corte))
+    return {int(r["clave"]): Decimal(str(r["saldo"] or 0)) for r in cursor.fetchall() if r["clave"] is not None}
+
+
+def borrar_archivados(cursor, ledger: str, where: str, params) -> dict:
+    # Borra filas ya archivadas y corrige los snapshots posteriores a cada fila.
+    # Regresa {clave: -monto} para ajustar saldos mantenidos (p.ej. stock_balance).
+    cfg = LEDGERS[ledger]
+    if not hay_archivo(cursor, ledger):
+        return {}
+    cursor.execute(f"""
+        SELECT id, {cfg['clave']} AS clave, {cfg['monto']} AS monto, {COL_FECHA} AS fecha
+        FROM {cfg['archivo']}
+        WHERE {where}
+    """, params)
+    filas = cursor.fetchall()
+    if not filas:
+        return {}
+
+    deltas = {}
+    for f in filas:
+        monto = Decimal(str(f["monto"] or 0))
+        deltas[int(f["clave"])] = deltas.get(int(f["clave"]), Decimal("0")) - monto
+        cursor.execute(f"""
+            UPDATE {cfg['snapshot']}
+            SET saldo_apertura = saldo_apertura - %s, movimientos = movimientos - 1
+            WHERE {cfg['clave']} = %s AND mes > %s
+        """, (str(monto), int(f["clave"]), f["fecha"]))
+
+    ids = [int(f["id"]) for f in filas]
+    cursor.execute(f"DELETE FROM {cfg['archivo']} WHERE id IN ({','.join(['%s'] * len(ids))})", ids)
+    return deltas
+
+
+# =========================================================
+# Compactación
+# =========================================================
+def _asegurar_tablas(cursor, cfg) -> None:
+    # Columna de fecha primero: el archivo se crea LIKE la tabla viva
+    if not schema_cache.has_column(cursor, cfg["tabla"], COL_FECHA):
+        cursor.execute(f"ALTER TABLE {cfg['tabla']} ADD COLUMN {COL_FECHA} TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        invalidate_schema_cache()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {cfg['archivo']} LIKE {cfg['tabla']}")
+    extra = "ultima_compra DATETIME NULL," if cfg["tabla"] == "loyalty_tx" else ""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {cfg['snapshot']} (
+            mes DATE NOT NULL,
+            {cfg['clave']} INT NOT NULL,
+            saldo_apertura DECIMAL(16,4) NOT NULL DEFAULT 0,
+            movimientos INT NOT NULL DEFAULT 0,
+            {extra}
+            PRIMARY KEY (mes, {cfg['clave']})
+        )
+    """)
+    invalidate_schema_cache()
+
+
+def _escribir_snapshot(cursor, cfg, mes: date, previo) -> None:
+    clave, monto = cfg["clave"], cfg["monto"]
+    partes, params = [], [mes]
+    if previo:
+        partes.append(f"SELECT {clave} AS clave, saldo_apertura AS monto, movimientos AS n FROM {cfg['snapshot']} WHERE mes = %s")
+        params.append(previo)
+    for tabla in (cfg["tabla"], cfg["archivo"]):
+        if previo:
+            partes.append(f"SELECT {clave}, {monto}, 1 FROM {tabla} WHERE {clave} IS NOT NULL AND {COL_FECHA} >= %s AND {COL_FECHA} < %s")
+            params.extend([previo, mes])
+        else:
+            partes.append(f"SELECT {clave}, {monto}, 1 FROM {tabla} WHERE {clave} IS NOT NULL AND {COL_FECHA} < %s")
+            params.append(mes)
+
+    cursor.execute(f"""
+        INSERT INTO {cfg['snapshot']} (mes, {clave}, saldo_apertura, movimientos)
+        SELECT %s, clave, SUM(monto), SUM(n)
+        FROM ({' UNION ALL '.join(partes)}) t
+        GROUP BY clave
+        ON DUPLICATE KEY UPDATE saldo_apertura = VALUES(saldo_apertura), movimientos = VALUES(movimientos)
+    """, params)
+
+    if cfg["tabla"] == "loyalty_tx":
+        partes, params = [], []
+        if previo:
+            partes.append("SELECT customer_id, ultima_compra AS fecha FROM loyalty_snapshot WHERE mes = %s")
+            params.append(previo)
+        for tabla in (cfg["tabla"], cfg["archivo"]):
+            rango = f"tx.{COL_FECHA} >= %s AND tx.{COL_FECHA} < %s" if previo else f"tx.{COL_FECHA} < %s"
+            partes.append(f"""
+                SELECT tx.customer_id, p.fecha
+                FROM {tabla} tx
+                JOIN pedidos p ON p.id = tx.pedido_id
+                WHERE tx.reason = 'purchase' AND {rango}
+            """)
+            params.extend([previo, mes] if previo else [mes])
+        params.append(mes)
+        cursor.execute(f"""
+            UPDATE loyalty_snapshot s
+            JOIN (
+                SELECT customer_id, MAX(fecha) AS ultima
+                FROM ({' UNION ALL '.join(partes)}) u
+                GROUP BY customer_id
+            ) x ON x.customer_id = s.customer_id
+            SET s.ultima_compra = x.ultima
+            WHERE s.mes = %s
+        """, params)
+
+
+def compactar_ledger(ledger: str, retencion_meses: int = RETENCION_MESES) -> dict:
+    cfg = LEDGERS[ledger]
+    corte = _restar_meses(date.today().replace(day=1), retencion_meses)
+    resumen = {"ledger": ledger, "corte": corte, "snapshots": [], "archivadas": 0}
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            _asegurar_tablas(cursor, cfg)
+            archivos_cache.invalidate(cursor)
+            conn.commit()
+
+            # 1) Un snapshot por cada mes pendiente hasta el corte
+            previo = ultimo_corte(cursor, ledger)
+            if previo:
+                mes = _siguiente_mes(previo)
+            else:
+                cursor.execute(f"SELECT MIN({COL_FECHA}) AS f FROM {cfg['tabla']}")
+                primero = _as_date(cursor.fetchone()["f"])
+                mes = _siguiente_mes(primero.replace(day=1)) if primero else None
+
+            while mes is not None and mes <= corte:
+                _escribir_snapshot(cursor, cfg, mes, previo)
+                conn.commit()
+                resumen["snapshots"].append(mes)
+                previo, mes = mes, _siguiente_mes(mes)
+
+            if previo is None or previo < corte:
+                return resumen
+
+            # 2) Mover al archivo lo anterior al corte, por lotes. Antes se da a los workers
+            # tiempo de ver la versión nueva: con el "no" en memoria leerían solo la tabla viva
+            time.sleep(VERSION_CHECK_INTERVAL)
+            while True:
+                cursor.execute(f"SELECT id FROM {cfg['tabla']} WHERE {COL_FECHA} < %s ORDER BY id LIMIT {LOTE}", (corte,))
+                ids = [int(r["id"]) for r in cursor.fetchall()]
+                if not ids:
+                    break
+                placeholders = ",".join(["%s"] * len(ids))
+                cursor.execute(f"INSERT INTO {cfg['archivo']} SELECT * FROM {cfg['tabla']} WHERE id IN ({placeholders})", ids)
+                cursor.execute(f"DELETE FROM {cfg['tabla']} WHERE id IN ({placeholders})", ids)
+                conn.commit()
+                resumen["archivadas"] += len(ids)
+        return resumen
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def compactar(retencion_meses: int = RETENCION_MESES) -> list:
+    return [compactar_ledger(nombre, retencion_meses) for nombre in LEDGERS]
+
+
+# =========================================================
+# Verificación
+# =========================================================
+def verificar_ledger(ledger: str) -> list:
+    # Recalcula desde vivo + archivo y compara con cada snapshot y con snapshot + cola
+    cfg = LEDGERS[ledger]
+    errores = []
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            if not hay_archivo(cursor, ledger):
+                conn.commit()
+                return errores
+
+            cursor.execute(f"""
+                SELECT clave, DATE_FORMAT(fecha, '%%Y-%%m-01') AS mes, SUM(monto) AS total, COUNT(*) AS n
+                FROM (
+                    SELECT {cfg['clave']} AS clave, {COL_FECHA} AS fecha, {cfg['monto']} AS monto FROM {cfg['tabla']}
+                    UNION ALL
+                    SELECT {cfg['clave']}, {COL_FECHA}, {cfg['monto']} FROM {cfg['archivo']}
+                ) t
+                WHERE clave IS NOT NULL
+                GROUP BY clave, mes
+            """)
+            por_mes = {}
+            for r in cursor.fetchall():
+                por_mes.setdefault(int(r["clave"]), []).append(
+                    (_as_date(r["mes"]), Decimal(str(r["total"] or 0)), int(r["n"]))
+                )
+
+            cursor.execute(f"SELECT mes, {cfg['clave']} AS clave, saldo_apertura, movimientos FROM {cfg['snapshot']}")
+            snaps = {}
+            for r in cursor.fetchall():
+                snaps.setdefault(_as_date(r["mes"]), {})[int(r["clave"])] = (Decimal(str(r["saldo_apertura"])), int(r["movimientos"]))
+
+            for mes, filas in sorted(snaps.items()):
+                claves = set(filas) | set(por_mes)
+                for clave in claves:
+                    esperado = sum((t for m, t, _ in por_mes.get(clave, []) if m < mes), Decimal("0"))
+                    esperado_n = sum(n for m, _, n in por_mes.get(clave, []) if m < mes)
+                    saldo, n = filas.get(clave, (Decimal("0"), 0))
+                    if saldo != esperado or n != esperado_n:
+                        errores.append({"ledger": ledger, "mes": mes, "clave": clave, "snapshot": saldo, "ledger_total": esperado})
+
+            totales = {clave: sum((t for _, t, _ in filas), Decimal("0")) for clave, filas in por_mes.items()}
+            actuales = saldos(cursor, ledger)
+            for clave in set(totales) | set(actuales):
+                if totales.get(clave, Decimal("0")) != actuales.get(clave, Decimal("0")):
+                    errores.append({"ledger": ledger, "mes": None, "clave": clave, "snapshot": actuales.get(clave), "ledger_total": totales.get(clave)})
+            conn.commit()
+        return errores
+    finally:
+        conn.close()
+
+
+def verificar() -> list:
+    errores = []
+    for nombre in LEDGERS:
+        errores.extend(verificar_ledger(nombre))
+    return errores
+
+
+if __name__ == "__main__":
+    accion = sys.argv[1] if len(sys.argv) > 1 else ""
+    if accion == "compactar":
+        meses = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else RETENCION_MESES
+        for r in compactar(meses):
+            print(f"{r['ledger']}: corte {r['corte']}, {len(r['snapshots'])} snapshot(s), {r['archivadas']} fila(s) archivadas")
+        errores = verificar()
+        print("Verificación OK." if not errores else f"Verificación con {len(errores)} diferencia(s).")
+        sys.exit(1 if errores else 0)
+    elif accion == "verificar":
+        errores = verificar()
+        for e in errores:
+            print(f"{e['ledger']} mes={e['mes']} clave={e['clave']}: snapshot={e['snapshot']} ledger={e['ledger_total']}")
+        print("Verificación OK." if not errores else f"{len(errores)} diferencia(s).")
+        sys.exit(1 if errores else 0)
+    else:
+        print("Uso: python archivo.py compactar [meses_retencion] | verificar")
@@ -0,0 +1,78 @@
+import random
+import statistics
+import sys
+import time
+
+from clientes_busqueda import IndiceClientes
+
+# =========================================================
+# Benchmark: índice en memoria de clientes (typeahead)
+# =========================================================
+# No usa la BD: genera N clientes sintéticos, mide la carga y la latencia
+# de búsquedas por nombre, prefijo de teléfono y sufijo de teléfono. Con pocos nombres y
+# apellidos distintos es el peor caso para las búsquedas de varios términos.
+#
+#   python bench_busqueda.py [clientes]
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 100_000
+CONSULTAS = 2000
+
+NOMBRES = ["José", "María", "Ángel", "Sofía", "Luis", "Fernanda", "Jesús", "Lucía", "Raúl", "Andrés",
+           "Mónica", "Iván", "Begoña", "Nicolás", "Inés", "Óscar", "Valeria", "Julián", "Ximena", "Héctor"]
+APELLIDOS = ["García", "Hernández", "López", "Martínez", "González", "Pérez", "Rodríguez", "Sánchez",
+             "Ramírez", "Cruz", "Gómez", "Díaz", "Núñez", "Ibáñez", "Muñoz", "Ortíz", "Vázquez", "Jiménez"]
+
+
+def generar(n, rnd):
+    rows = []
+    for cid in range(1, n + 1):
+        nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+        rows.append({"id": cid, "nombre": nombre, "phone_e164": f"+52{rnd.randint(10**9, 10**10 - 1)}"})
+    return rows
+
+
+def medir(idx, consultas):
+    tiempos = []
+    resultados = 0
+    for q in consultas:
+        t0 = time.perf_counter()
+        resultados += len(idx.buscar(q))
+        tiempos.append((time.perf_counter() - t0) * 1e6)
+    tiempos.sort()
+    return {
+        "p50": statistics.median(tiempos),
+        "p99": tiempos[int(len(tiempos) * 0.99) - 1],
+        "max": tiempos[-1],
+        "prom_resultados": resultados / len(consultas),
+    }
+
+
+def main():
+    rnd = random.Random(42)
+    rows = generar(N, rnd)
+
+    idx = IndiceClientes()
+    t0 = time.perf_counter()
+    idx.cargar(rows)
+    print(f"Carga de {N:,} clientes: {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    muestra = [rnd.choice(rows) for _ in range(CONSULTAS)]
+    casos = {
+        "nombre (3 letras)": [r["nombre"].split()[0][:3].lower() for r in muestra],
+        "nombre + apellido": [" ".join(p[:4] for p in r["nombre"].split()[:2]) for r in muestra],
+        "sin acentos": [r["nombre"].split()[1][:5].replace("á", "a").replace("é", "e").replace("í", "i") for r in muestra],
+        "tel. prefijo (4)": [r["phone_e164"][3:7] for r in muestra],
+        "tel. sufijo (4)": [r["phone_e164"][-4:] for r in muestra],
+        "tel. completo": [r["phone_e164"] for r in muestra],
+    }
+    for nombre, consultas in casos.items():
+        m = medir(idx, consultas)
+        print(f"{nombre:<20} p50={m['p50']:8.1f} µs  p99={m['p99']:8.1f} µs  max={m['max']:9.1f} µs  resultados={m['prom_resultados']:.1f}")
+
+    t0 = time.perf_counter()
+    idx.agregar([{"id": N + i, "nombre": "Cliente Nuevo", "phone_e164": None} for i in range(1, 101)])
+    print(f"100 altas en caliente: {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import sys
+import time
+
+from db import get_connection
+from filtros import FiltroFechas
+
+# =========================================================
+# Benchmark: DATE_FORMAT(fecha) = mes  vs  rango [inicio, fin)
+# =========================================================
+# Crea bench_pedidos con ~1M pedidos sintéticos (3 años) en la BD configurada,
+# con el mismo índice compuesto (fecha, estado, origen) que filtros.INDICES,
+# y compara tiempos + EXPLAIN de los dos estilos de filtro.
+#
+#   python bench_fechas.py [filas] [--keep]
+
+FILAS = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1_000_000
+REPETICIONES = 5
+
+
+def preparar(cursor, filas):
+    cursor.execute("DROP TABLE IF EXISTS bench_pedidos")
+    cursor.execute("""
+        CREATE TABLE bench_pedidos (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            fecha DATETIME NOT NULL,
+            estado VARCHAR(20) NOT NULL,
+            origen VARCHAR(50) NOT NULL,
+            total DECIMAL(10,2) NOT NULL,
+            INDEX idx_bench_fecha_estado_origen (fecha, estado, origen)
+        )
+    """)
+    cursor.execute("SET SESSION cte_max_recursion_depth = %s", (filas + 1,))
+    lote = 100_000
+    for inicio in range(0, filas, lote):
+        n = min(lote, filas - inicio)
+        cursor.execute("""
+            INSERT INTO bench_pedidos (fecha, estado, origen, total)
+            WITH RECURSIVE seq (n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < %s)
+            SELECT
+                TIMESTAMP('2023-01-01') + INTERVAL FLOOR(RAND() * 3 * 365 * 86400) SECOND,
+                IF(RAND() < 0.97, 'cerrado', 'abierto'),
+                ELT(1 + FLOOR(RAND() * 3), 'local', 'uber', 'whatsapp'),
+                ROUND(50 + RAND() * 450, 2)
+            FROM seq
+        """, (n - 1,))
+    cursor.execute("ANALYZE TABLE bench_pedidos")
+    cursor.fetchall()
+
+
+def medir(cursor, sql, params):
+    tiempos = []
+    for _ in range(REPETICIONES):
+        t0 = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        tiempos.append(time.perf_counter() - t0)
+    cursor.execute("EXPLAIN " + sql, params)
+    plan = cursor.fetchone()
+    return min(tiempos), plan
+
+
+def main():
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            print(f"Generando {FILAS:,} pedidos sintéticos...")
+            preparar(cursor, FILAS)
+            conn.commit()
+
+            mes = "2024-06"
+            casos = [
+                ("DATE_FORMAT (scan)",
+                 "SELECT COUNT(*) AS n, SUM(total) AS t FROM bench_pedidos WHERE DATE_FORMAT(fecha, '%%Y-%%m') = %s AND estado = 'cerrado'",
+                 [mes]),
+            ]
+            filtro, params = FiltroFechas(meses=[mes]).sql("fecha", [("estado = %s", "cerrado")])
+            casos.append(("rango [inicio, fin)", f"SELECT COUNT(*) AS n, SUM(total) AS t FROM bench_pedidos {filtro}", params))
+
+            dia_sql = "SELECT COUNT(*) AS n FROM bench_pedidos WHERE DATE(fecha) = %s AND estado = 'abierto'"
+            casos.append(("DATE() = dia (scan)", dia_sql, ["2024-06-15"]))
+            filtro, params = FiltroFechas(dia="2024-06-15").sql("fecha", [("estado = %s", "abierto")])
+            casos.append(("día como rango", f"SELECT COUNT(*) AS n FROM bench_pedidos {filtro}", params))
+
+            for nombre, sql, params in casos:
+                mejor, plan = medir(cursor, sql, params)
+                print(f"{nombre:<22} {mejor * 1000:9.1f} ms   type={plan.get('type')} key={plan.get('key')} rows={plan.get('rows')}")
+    finally:
+        if "--keep" not in sys.argv:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("DROP TABLE IF EXISTS bench_pedidos")
+                conn.commit()
+            except Exception:
+                pass
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
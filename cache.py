@@ -0,0 +1,81 @@
+import os
+import time
+import threading
+
+from db import ensure_ddl
+
+# Cada cuánto (segundos) un worker revisa si otro worker invalidó la caché
+VERSION_CHECK_INTERVAL = float(os.getenv("CACHE_VERSION_CHECK_SECS", 2))
+
+CACHE_VERSIONES_DDL = """
+    CREATE TABLE IF NOT EXISTS cache_versiones (
+        clave VARCHAR(64) NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        actualizado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+"""
+
+
+def ensure_versions_table() -> None:
+    ensure_ddl("cache_versiones", [CACHE_VERSIONES_DDL])
+
+
+def read_version(cursor, clave: str) -> int:
+    ensure_versions_table()
+    cursor.execute("SELECT version FROM cache_versiones WHERE clave = %s", (clave,))
+    row = cursor.fetchone()
+    return int(row["version"]) if row else 0
+
+
+def bump_version(cursor, clave: str) -> None:
+    # Va dentro de la transacción de quien edita: la invalidación se publica al hacer commit
+    ensure_versions_table()
+    cursor.execute("""
+        INSERT INTO cache_versiones (clave, version) VALUES (%s, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    """, (clave,))
+
+
+class VersionedCache:
+    """Valor cargado una vez por worker y recargado solo cuando cambia su versión en cache_versiones."""
+
+    def __init__(self, clave: str, loader):
+        self.clave = clave
+        self._loader = loader
+        self._value = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def peek(self):
+        # Valor ya cargado y revisado hace menos de VERSION_CHECK_INTERVAL; si no, None (hay que ir a la BD)
+        if self._value is not None and time.monotonic() - self._checked_at < VERSION_CHECK_INTERVAL:
+            return self._value
+        return None
+
+    def get(self, cursor):
+        now = time.monotonic()
+        if self._value is not None and now - self._checked_at < VERSION_CHECK_INTERVAL:
+            return self._value
+
+        with self._lock:
+            version = read_version(cursor, self.clave)
+            if self._value is None or version != self._version:
+                # La versión se lee antes de cargar: si alguien invalida en medio, se recarga en la siguiente revisión
+                self._value = self._loader(cursor)
+                self._version = version
+            self._checked_at = now
+            return self._value
+
+    def invalidate(self, cursor) -> None:
+        bump_version(cursor, self.clave)
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._value = None
+            self._version = None
@@ -0,0 +1,67 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from cache import VersionedCache
+from db import get_connection
+
+# =========================================================
+# Catálogo del POS (productos activos, salsas, proteínas)
+# =========================================================
+# Una copia por worker con su JSON y ETag ya calculados. Se invalida con la versión
+# "catalogo" (cache_versiones) desde los handlers que cambian productos o precios.
+# productos.costo no va en el catálogo: el POS no lo usa y así la propagación de
+# costos (costeo.propagar_costos) no obliga a recargarlo.
+
+
+def _json_default(valor):
+    if isinstance(valor, Decimal):
+        return float(valor)
+    return str(valor)
+
+
+def cargar_catalogo(cursor) -> dict:
+    cursor.execute("SELECT * FROM productos WHERE activo = 1 ORDER BY categoria, nombre")
+    productos = [{k: v for k, v in r.items() if k != "costo"} for r in cursor.fetchall()]
+    cursor.execute("SELECT * FROM salsas ORDER BY nombre")
+    salsas = cursor.fetchall()
+    cursor.execute("SELECT * FROM proteinas ORDER BY nombre")
+    proteinas = cursor.fetchall()
+
+    cuerpo = json.dumps(
+        {"productos": productos, "salsas": salsas, "proteinas": proteinas},
+        default=_json_default, ensure_ascii=False, separators=(",", ":"),
+    ).encode("utf-8")
+    return {
+        "productos": productos,
+        "salsas": salsas,
+        "proteinas": proteinas,
+        "json": cuerpo,
+        # Mismo contenido -> mismo ETag en todos los workers
+        "etag": hashlib.sha1(cuerpo).hexdigest(),
+        "cargado_en": datetime.now(timezone.utc).replace(microsecond=0),
+    }
+
+
+catalogo_cache = VersionedCache("catalogo", cargar_catalogo)
+
+
+def get_catalogo(cursor=None) -> dict:
+    # Sin cursor: solo abre conexión si toca revisar la versión (cada VERSION_CHECK_INTERVAL)
+    if cursor is not None:
+        return catalogo_cache.get(cursor)
+    valor = catalogo_cache.peek()
+    if valor is not None:
+        return valor
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            return catalogo_cache.get(cur)
+    finally:
+        conn.close()
+
+
+def invalidar_catalogo(cursor) -> None:
+    # Llamar dentro de la misma transacción que modifica productos, salsas o proteínas
+    catalogo_cache.invalidate(cursor)
@@ -0,0 +1,424 @@
+import bisect
+import heapq
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from pymysql import MySQLError
+
+from cache import read_version, bump_version
+from db import get_connection, schema_cache, invalidate_schema_cache
+
+# =========================================================
+# Búsqueda indexada de clientes
+# =========================================================
+# loyalty_customers.phone_last10: últimos 10 dígitos del teléfono ya normalizado
+# (normalize_phone_mx) con índice -> mi_perfil es una búsqueda por igualdad y
+# buscar_cliente por prefijo. Los nombres se buscan con un índice FULLTEXT ngram
+# (subcadenas de 2+ caracteres) en lugar de LIKE '%q%'. Columna, backfill e índices
+# se crean con "python clientes_busqueda.py esquema" (release en el Procfile).
+
+LIMITE_BUSQUEDA = 5
+# Cada cuánto (segundos) el índice en memoria revisa altas/ediciones hechas en otros workers
+INDICE_CHECK_SECS = float(os.getenv("CLIENTES_INDICE_CHECK_SECS", 2))
+# Las altas se releen con traslape: un id menor puede hacer commit después de uno mayor
+VENTANA_ALTAS = 200
+
+# Códigos de error de MySQL
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+def phone_last10(phone) -> str | None:
+    digitos = re.sub(r"\D", "", phone or "")
+    return digitos[-10:] if len(digitos) >= 10 else None
+
+
+def _tiene_indice(cursor, nombre: str) -> bool:
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'loyalty_customers' AND INDEX_NAME = %s
+        LIMIT 1
+    """, (nombre,))
+    return cursor.fetchone() is not None
+
+
+def _alter(cursor, sql) -> bool:
+    # Otro proceso pudo crear la misma columna/índice al mismo tiempo: 1060/1061 = ya está
+    try:
+        cursor.execute(sql)
+        return True
+    except MySQLError as e:
+        if e.args and e.args[0] in (ER_DUP_FIELDNAME, ER_DUP_KEYNAME):
+            return False
+        raise
+
+
+def migrar_esquema() -> list:
+    # Columna, backfill e índices de búsqueda. Es lento en tablas grandes (FULLTEXT ngram):
+    # corre como paso de release (Procfile) o a mano, nunca en un request.
+    #   python clientes_busqueda.py esquema
+    hecho = []
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            if not schema_cache.has_column(cursor, "loyalty_customers", "phone_last10"):
+                if _alter(cursor, "ALTER TABLE loyalty_customers ADD COLUMN phone_last10 CHAR(10) NULL"):
+                    hecho.append("columna phone_last10")
+                invalidate_schema_cache()
+            # Backfill: mismos dígitos que phone_last10() sobre phone_e164
+            cursor.execute("""
+                UPDATE loyalty_customers
+                SET phone_last10 = RIGHT(REGEXP_REPLACE(phone_e164, '[^0-9]', ''), 10)
+                WHERE phone_last10 IS NULL
+                  AND CHAR_LENGTH(REGEXP_REPLACE(phone_e164, '[^0-9]', '')) >= 10
+            """)
+            if cursor.rowcount:
+                hecho.append(f"backfill de {cursor.rowcount} teléfono(s)")
+            conn.commit()
+            if not _tiene_indice(cursor, "idx_customers_phone_last10"):
+                if _alter(cursor, "ALTER TABLE loyalty_customers ADD INDEX idx_customers_phone_last10 (phone_last10)"):
+                    hecho.append("índice idx_customers_phone_last10")
+            if not _tiene_indice(cursor, "ft_customers_nombre"):
+                if _alter(cursor, "ALTER TABLE loyalty_customers ADD FULLTEXT INDEX ft_customers_nombre (nombre) WITH PARSER ngram"):
+                    hecho.append("índice ft_customers_nombre")
+        conn.commit()
+    finally:
+        conn.close()
+    return hecho
+
+
+def asegurar_esquema() -> None:
+    # Una vez por proceso. Solo garantiza la columna (ADD COLUMN es instantáneo en
+    # MySQL 8) para que los INSERT/UPDATE que la escriben no fallen si el release
+    # todavía no corrió migrar_esquema(); backfill e índices se quedan en la migración.
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if not schema_cache.has_column(cursor, "loyalty_customers", "phone_last10"):
+                    _alter(cursor, "ALTER TABLE loyalty_customers ADD COLUMN phone_last10 CHAR(10) NULL")
+                    invalidate_schema_cache()
+            conn.commit()
+        finally:
+            conn.close()
+        _esquema_listo = True
+    # Primer request del proceso: el índice en memoria se carga en segundo plano
+    precargar_indice()
+
+
+def por_telefono(cursor, telefono):
+    last10 = phone_last10(telefono)
+    if not last10:
+        return None
+    asegurar_esquema()
+    cursor.execute("""
+        SELECT c.nombre, c.phone_e164, a.totopos_balance
+        FROM loyalty_customers c
+        LEFT JOIN loyalty_accounts a ON c.id = a.customer_id
+        WHERE c.phone_last10 = %s
+        ORDER BY c.id
+        LIMIT 1
+    """, (last10,))
+    return cursor.fetchone()
+
+
+def buscar(cursor, query: str, limite: int = LIMITE_BUSQUEDA) -> list:
+    asegurar_esquema()
+    digitos = re.sub(r"[\s()+\-]", "", query)
+    if digitos.isdigit():
+        # Con lada 52/521 se compara contra los últimos 10; si no, prefijo del número nacional
+        prefijo = digitos[-10:] if len(digitos) > 10 else digitos
+        cursor.execute("""
+            SELECT id, nombre, phone_e164
+            FROM loyalty_customers
+            WHERE phone_last10 LIKE %s
+            ORDER BY phone_last10
+            LIMIT %s
+        """, (prefijo.replace("%", "") + "%", limite))
+        return cursor.fetchall()
+
+    # Frase entre comillas: todos los n-gramas en orden (equivale a subcadena)
+    frase = '"' + query.replace('"', " ") + '"'
+    try:
+        cursor.execute("""
+            SELECT id, nombre, phone_e164
+            FROM loyalty_customers
+            WHERE MATCH(nombre) AGAINST (%s IN BOOLEAN MODE)
+            LIMIT %s
+        """, (frase, limite))
+    except MySQLError as e:
+        # Sin ft_customers_nombre (migrar_esquema no ha corrido): búsqueda lenta pero correcta
+        if not e.args or e.args[0] != ER_FT_MATCHING_KEY_NOT_FOUND:
+            raise
+        cursor.execute("""
+            SELECT id, nombre, phone_e164
+            FROM loyalty_customers
+            WHERE nombre LIKE %s
+            LIMIT %s
+        """, ("%" + query.replace("%", "") + "%", limite))
+    return cursor.fetchall()
+
+
+# =========================================================
+# Índice en memoria para el typeahead (/api/buscar_cliente)
+# =========================================================
+# Por cada token de nombre (sin acentos) una lista ordenada (posición, largo del nombre, id):
+# el orden de la lista ya es el del ranking, así que el top-k se lee sin recorrer todas las
+# coincidencias. Teléfonos: últimos 10 dígitos (prefijo) y esos dígitos al revés (sufijo).
+# Las altas se agregan en caliente; las ediciones suben la versión "clientes_busqueda" y
+# cada worker recarga completo.
+
+def plegar(texto) -> str:
+    texto = unicodedata.normalize("NFKD", texto or "")
+    return "".join(ch for ch in texto if not unicodedata.combining(ch)).lower()
+
+
+def tokens_nombre(nombre) -> list:
+    return re.findall(r"[0-9a-zñ]+", plegar(nombre))
+
+
+class IndiceClientes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clientes = {}
+        self._tokens_de = {}   # id -> tokens del nombre
+        self._postings = {}    # token -> [(posición, largo nombre, id)] ordenada
+        self._vocab = []       # tokens distintos, ordenados (búsqueda por prefijo)
+        self._ids = {}         # token -> ids (intersección para varios términos)
+        self._tel = []         # (últimos 10, id)
+        self._tel_rev = []     # (últimos 10 al revés, id)
+        self.max_id = 0
+
+    def __len__(self):
+        return len(self.clientes)
+
+    def _registrar(self, r, postings, tel, rev):
+        cid = int(r["id"])
+        nombre = r["nombre"] or ""
+        self.clientes[cid] = {"id": cid, "nombre": r["nombre"], "phone_e164": r["phone_e164"]}
+        toks = tokens_nombre(nombre)
+        self._tokens_de[cid] = toks
+        for pos, t in enumerate(toks):
+            postings.setdefault(t, []).append((pos, len(nombre), cid))
+        last10 = phone_last10(r["phone_e164"])
+        if last10:
+            tel.append((last10, cid))
+            rev.append((last10[::-1], cid))
+        return cid
+
+    def cargar(self, rows) -> None:
+        nuevo = IndiceClientes()
+        postings, tel, rev = {}, [], []
+        for r in rows:
+            nuevo._registrar(r, postings, tel, rev)
+        for lista in postings.values():
+            lista.sort()
+        tel.sort()
+        rev.sort()
+        with self._lock:
+            self.clientes, self._tokens_de = nuevo.clientes, nuevo._tokens_de
+            self._postings, self._vocab = postings, sorted(postings)
+            self._ids = {t: {cid for *_, cid in lista} for t, lista in postings.items()}
+            self._tel, self._tel_rev = tel, rev
+            self.max_id = max(self.clientes, default=0)
+
+    def agregar(self, rows) -> None:
+        with self._lock:
+            for r in rows:
+                if int(r["id"]) in self.clientes:
+                    continue
+                postings, tel, rev = {}, [], []
+                cid = self._registrar(r, postings, tel, rev)
+                for t, entradas in postings.items():
+                    if t not in self._postings:
+                        self._postings[t] = []
+                        self._ids[t] = set()
+                        bisect.insort(self._vocab, t)
+                    self._ids[t].add(cid)
+                    for e in entradas:
+                        bisect.insort(self._postings[t], e)
+                for e in tel:
+                    bisect.insort(self._tel, e)
+                for e in rev:
+                    bisect.insort(self._tel_rev, e)
+                self.max_id = max(self.max_id, cid)
+
+    @staticmethod
+    def _rango(lista, prefijo):
+        # Entradas cuyo primer campo empieza con prefijo: [i, j)
+        return bisect.bisect_left(lista, (prefijo,)), bisect.bisect_left(lista, (prefijo + "\uffff",))
+
+    def _coincidencias(self, term):
+        # (exacto 0 / prefijo 1, posición, largo, id) en orden de ranking; un id puede repetirse
+        i = bisect.bisect_left(self._vocab, term)
+        j = bisect.bisect_left(self._vocab, term + "\uffff")
+        tokens = self._vocab[i:j]
+        exacto = self._postings[term] if tokens and tokens[0] == term else []
+        prefijos = [self._postings[t] for t in tokens if t != term]
+        if len(prefijos) == 1:
+            prefijos = prefijos[0]
+        elif prefijos:
+            prefijos = heapq.merge(*prefijos)
+        return itertools.chain(
+            ((0,) + e for e in exacto),
+            ((1,) + e for e in prefijos),
+        )
+
+    def _ids_prefijo(self, term):
+        i = bisect.bisect_left(self._vocab, term)
+        j = bisect.bisect_left(self._vocab, term + "\uffff")
+        if j - i == 1:
+            return self._ids[self._vocab[i]]
+        return set().union(*(self._ids[t] for t in self._vocab[i:j]))
+
+    @staticmethod
+    def _mejor(tokens, term, excluir):
+        mejor = None
+        for pos, t in enumerate(tokens):
+            if pos != excluir and t.startswith(term):
+                s = (0 if t == term else 1, pos)
+                if mejor is None or s < mejor:
+                    mejor = s
+        return mejor
+
+    def _buscar_nombre(self, terminos, k):
+        if len(terminos) == 1:
+            # Un término: las coincidencias ya salen en orden de ranking, basta con las primeras k
+            ids = []
+            for *_, cid in self._coincidencias(terminos[0]):
+                if cid not in ids:
+                    ids.append(cid)
+                    if len(ids) == k:
+                        break
+            return ids
+
+        # Varios términos: se recorre en orden de ranking el término con menos ids; los demás
+        # se filtran por conjunto de ids y se puntúan sobre los tokens del cliente (en otra
+        # posición). Como suman al menos (flag_min, 1 si el guía está en la posición 0), se
+        # corta en cuanto la entrada del guía ya no puede entrar al top-k.
+        conjuntos = sorted(((len(ids), t, ids) for t in terminos for ids in [self._ids_prefijo(t)]), key=lambda x: x[0])
+        guia_term = conjuntos[0][1]
+        otros = [t for _, t, _ in conjuntos[1:]]
+        filtros = [ids for _, _, ids in conjuntos[1:]]
+        flag_min = sum(0 if t in self._postings else 1 for t in otros)
+
+        vistos, top = set(), []
+        for flag, pos, largo, cid in self._coincidencias(guia_term):
+            if len(top) >= k:
+                cota = (flag + flag_min, pos + (len(otros) if pos == 0 else 0), largo, cid)
+                if cota > top[-1]:
+                    break
+            if cid in vistos or not all(cid in ids for ids in filtros):
+                continue
+            vistos.add(cid)
+            f, p = flag, pos
+            for term in otros:
+                s = self._mejor(self._tokens_de[cid], term, pos)
+                if s is None:
+                    break
+                f, p = f + s[0], p + s[1]
+            else:
+                bisect.insort(top, (f, p, largo, cid))
+                del top[k:]
+        return [cid for *_, cid in top]
+
+    def _buscar_telefono(self, d, k):
+        scores = {}
+        i, j = self._rango(self._tel, d)
+        for last10, cid in self._tel[i:j]:
+            scores[cid] = 0 if last10 == d else 1
+        i, j = self._rango(self._tel_rev, d[::-1])
+        for _, cid in self._tel_rev[i:j]:
+            scores.setdefault(cid, 2)
+        top = heapq.nsmallest(
+            k, scores.items(),
+            key=lambda kv: (kv[1], len(self.clientes[kv[0]]["nombre"] or ""), kv[0])
+        )
+        return [cid for cid, _ in top]
+
+    def buscar(self, query: str, k: int = LIMITE_BUSQUEDA) -> list:
+        digitos = re.sub(r"[\s()+\-]", "", query or "")
+        with self._lock:
+            if digitos.isdigit():
+                ids = self._buscar_telefono(digitos[-10:] if len(digitos) > 10 else digitos, k)
+            else:
+                terminos = tokens_nombre(query)
+                ids = self._buscar_nombre(terminos, k) if terminos else []
+            return [dict(self.clientes[cid]) for cid in ids]
+
+
+indice = IndiceClientes()
+_indice_estado = {"version": None, "checked_at": 0.0}
+_indice_sync_lock = threading.Lock()
+
+
+def _sincronizar_indice(cursor) -> None:
+    version = read_version(cursor, "clientes_busqueda")
+    if _indice_estado["version"] != version:
+        # La versión se lee antes de cargar: una edición concurrente se ve en la siguiente revisión
+        cursor.execute("SELECT id, nombre, phone_e164 FROM loyalty_customers")
+        indice.cargar(cursor.fetchall())
+        _indice_estado["version"] = version
+    else:
+        cursor.execute(
+            "SELECT id, nombre, phone_e164 FROM loyalty_customers WHERE id > %s ORDER BY id",
+            (max(0, indice.max_id - VENTANA_ALTAS),)
+        )
+        nuevos = cursor.fetchall()
+        if nuevos:
+            indice.agregar(nuevos)
+
+
+def indice_actual():
+    # Toca la BD solo si pasó INDICE_CHECK_SECS desde la última revisión
+    ahora = time.monotonic()
+    if _indice_estado["version"] is not None and ahora - _indice_estado["checked_at"] < INDICE_CHECK_SECS:
+        return indice
+    with _indice_sync_lock:
+        if _indice_estado["version"] is not None and ahora - _indice_estado["checked_at"] < INDICE_CHECK_SECS:
+            return indice
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                _sincronizar_indice(cursor)
+        finally:
+            conn.close()
+        _indice_estado["checked_at"] = time.monotonic()
+    return indice
+
+
+def precargar_indice() -> None:
+    threading.Thread(target=indice_actual, daemon=True).start()
+
+
+def registrar_alta(cid: int, nombre, phone_e164) -> None:
+    # Alta en este worker: visible de inmediato; los demás la toman por id > max_id
+    indice.agregar([{"id": cid, "nombre": nombre, "phone_e164": phone_e164}])
+
+
+def invalidar_indice(cursor) -> None:
+    # Edición de nombre/teléfono: dentro de la transacción del handler
+    bump_version(cursor, "clientes_busqueda")
+    _indice_estado["version"] = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "esquema":
+        hecho = migrar_esquema()
+        print("Esquema de búsqueda de clientes: " + (", ".join(hecho) if hecho else "ya estaba al día"))
+    else:
+        print("Uso: python clientes_busqueda.py esquema")
@@ -1,6 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from decimal import Decimal, InvalidOperation
-from db import get_connection
+from db import get_connection, ensure_ddl
+from cache import VersionedCache
+import catalogo
 
 costeo_bp = Blueprint("costeo", __name__, url_prefix="/admin")
 
@@ -48,6 +50,241 @@ def execute_many(sql, rows):
         conn.close()
 
 
+# =========================
+# Caché de recetas (BOM)
+# =========================
+def _dec(val, default="0"):
+    return Decimal(str(val)) if val is not None else Decimal(default)
+
+
+def cargar_bom(cursor):
+    cursor.execute("SELECT id, nombre, proteina_cantidad_base FROM platillos")
+    platillos = {
+        int(r["id"]): {"nombre": r["nombre"], "proteina_cantidad_base": r["proteina_cantidad_base"]}
+        for r in cursor.fetchall()
+    }
+
+    cursor.execute("SELECT id, nombre, unidad_base, merma_pct, descuenta_stock, activo FROM insumos")
+    insumos = {int(r["id"]): r for r in cursor.fetchall()}
+
+    cursor.execute("SELECT id, insumo_id FROM proteinas")
+    proteinas = {int(r["id"]): (int(r["insumo_id"]) if r["insumo_id"] else None) for r in cursor.fetchall()}
+
+    cursor.execute("""
+        SELECT id, platillo_id, insumo_id, cantidad_base, usa_precio_manual, precio_manual
+        FROM recetas
+        ORDER BY platillo_id, id
+    """)
+    recetas = {}
+    for r in cursor.fetchall():
+        ins = insumos.get(int(r["insumo_id"])) or {}
+        recetas.setdefault(int(r["platillo_id"]), []).append({
+            "receta_id": r["id"],
+            "insumo_id": int(r["insumo_id"]),
+            "cantidad_base": _dec(r["cantidad_base"]),
+            "merma_pct": _dec(ins.get("merma_pct")),
+            "descuenta_stock": int(ins.get("descuenta_stock") or 0) == 1,
+            "usa_precio_manual": int(r["usa_precio_manual"] or 0) == 1,
+            "precio_manual": _dec(r["precio_manual"]) if r["precio_manual"] is not None else None,
+        })
+
+    # Índice inverso insumo -> platillos (para propagar cambios de costo)
+    platillos_por_insumo = {}
+    for platillo_id, lineas in recetas.items():
+        for r in lineas:
+            platillos_por_insumo.setdefault(r["insumo_id"], set()).add(platillo_id)
+
+    return {
+        "platillos": platillos,
+        "insumos": insumos,
+        "proteinas": proteinas,
+        "recetas": recetas,
+        "platillos_por_insumo": platillos_por_insumo,
+    }
+
+
+bom_cache = VersionedCache("bom", cargar_bom)
+
+
+def get_bom(cursor):
+    return bom_cache.get(cursor)
+
+
+def invalidar_bom(cursor):
+    # Llamar dentro de la misma transacción que modifica recetas, platillos, proteínas o insumos
+    bom_cache.invalidate(cursor)
+
+
+def invalidar_bom_commit():
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            invalidar_bom(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# =========================
+# Costo vigente por insumo (materializado)
+# =========================
+# insumo_costo_vigente guarda el costo unitario de la última compra (fecha DESC, id DESC)
+# de cada insumo. Se recalcula para los insumos tocados al registrar o borrar compras.
+COSTO_VIGENTE_DDL = """
+    CREATE TABLE IF NOT EXISTS insumo_costo_vigente (
+        insumo_id INT NOT NULL PRIMARY KEY,
+        compra_id INT NOT NULL,
+        fecha DATETIME NULL,
+        costo_unitario DECIMAL(14,4) NOT NULL,
+        actualizado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+"""
+
+COSTO_OPERATIVO_PCT = Decimal("0.75")
+MARGEN_OBJETIVO = Decimal("0.50")
+
+
+def ensure_costo_vigente_table() -> None:
+    ensure_ddl("insumo_costo_vigente", [COSTO_VIGENTE_DDL])
+
+
+def recalcular_costo_vigente(cursor, insumo_ids=None) -> set:
+    # insumo_ids=None recalcula todos (backfill). Regresa los insumos cuyo costo cambió.
+    ensure_costo_vigente_table()
+    filtro, params = "", []
+    ids = None
+    if insumo_ids is not None:
+        ids = sorted({int(x) for x in insumo_ids if x})
+        if not ids:
+            return set()
+        filtro = f"AND ic.insumo_id IN ({','.join(['%s'] * len(ids))})"
+        params = ids
+
+    antes = costos_vigentes(cursor, ids)
+    if ids is None:
+        cursor.execute("DELETE FROM insumo_costo_vigente")
+    else:
+        cursor.execute(f"DELETE FROM insumo_costo_vigente WHERE insumo_id IN ({','.join(['%s'] * len(ids))})", ids)
+
+    cursor.execute(f"""
+        INSERT INTO insumo_costo_vigente (insumo_id, compra_id, fecha, costo_unitario)
+        SELECT insumo_id, id, fecha, costo_unitario
+        FROM (
+            SELECT ic.insumo_id, ic.id, ic.fecha, ic.costo_unitario,
+                   ROW_NUMBER() OVER (PARTITION BY ic.insumo_id ORDER BY ic.fecha DESC, ic.id DESC) AS rn
+            FROM insumos_compras ic
+            WHERE ic.insumo_id IS NOT NULL
+              AND ic.costo_unitario IS NOT NULL
+              {filtro}
+        ) t
+        WHERE rn = 1
+    """, params)
+
+    despues = costos_vigentes(cursor, ids)
+    return {i for i in set(antes) | set(despues) if antes.get(i) != despues.get(i)}
+
+
+def costos_vigentes(cursor, insumo_ids=None) -> dict:
+    ensure_costo_vigente_table()
+    if insumo_ids is None:
+        cursor.execute("SELECT insumo_id, costo_unitario FROM insumo_costo_vigente")
+    else:
+        ids = sorted({int(x) for x in insumo_ids})
+        if not ids:
+            return {}
+        cursor.execute(
+            f"SELECT insumo_id, costo_unitario FROM insumo_costo_vigente WHERE insumo_id IN ({','.join(['%s'] * len(ids))})",
+            ids
+        )
+    return {int(r["insumo_id"]): Decimal(str(r["costo_unitario"])) for r in cursor.fetchall()}
+
+
+def costo_platillo(bom, costos, platillo_id) -> Decimal:
+    # Costo de insumos de un platillo; precio manual de la receta gana sobre la última compra
+    total = Decimal("0")
+    for r in bom["recetas"].get(int(platillo_id), []):
+        if r["usa_precio_manual"] and r["precio_manual"] is not None:
+            costo_unit = r["precio_manual"]
+        else:
+            costo_unit = costos.get(r["insumo_id"], Decimal("0"))
+        total += (r["cantidad_base"] * (1 + (r["merma_pct"] / 100))) * costo_unit
+    return total
+
+
+def actualizar_costo_productos(cursor, platillo_ids) -> int:
+    # Recalcula solo los platillos dados y escribe productos.costo en un solo UPDATE
+    ids = sorted({int(x) for x in platillo_ids if x})
+    if not ids:
+        return 0
+    bom = get_bom(cursor)
+    insumo_ids = {r["insumo_id"] for pid in ids for r in bom["recetas"].get(pid, [])}
+    costos = costos_vigentes(cursor, insumo_ids)
+
+    casos, params = [], []
+    for pid in ids:
+        casos.append("WHEN %s THEN %s")
+        params.extend([pid, str(costo_platillo(bom, costos, pid))])
+    params.extend(ids)
+
+    cursor.execute(f"""
+        UPDATE productos
+        SET costo = CASE platillo_id {' '.join(casos)} END
+        WHERE platillo_id IN ({','.join(['%s'] * len(ids))})
+    """, params)
+    return cursor.rowcount
+
+
+def propagar_costos(cursor, insumo_ids) -> int:
+    # insumo -> recetas -> platillos -> productos, solo para los insumos que cambiaron
+    indice = get_bom(cursor)["platillos_por_insumo"]
+    platillo_ids = set()
+    for insumo_id in insumo_ids:
+        platillo_ids |= indice.get(int(insumo_id), set())
+    return actualizar_costo_productos(cursor, platillo_ids)
+
+
+def costeo_platillos(cursor, platillo_ids=None) -> list:
+    # Reemplaza a v_costeo_platillos_compras: BOM en memoria + costo vigente materializado
+    bom = get_bom(cursor)
+    costos = costos_vigentes(cursor)
+
+    cursor.execute("SELECT id, precio_actual FROM platillos")
+    precios = {int(r["id"]): r["precio_actual"] for r in cursor.fetchall()}
+
+    ids = platillo_ids if platillo_ids is not None else bom["platillos"].keys()
+    data = []
+    for pid in ids:
+        p = bom["platillos"].get(int(pid))
+        if not p:
+            continue
+        costo_insumos = Decimal("0")
+        sin_precio = 0
+        for r in bom["recetas"].get(int(pid), []):
+            costo = costos.get(r["insumo_id"])
+            if costo is None:
+                sin_precio += 1
+                continue
+            costo_insumos += r["cantidad_base"] * costo * (1 + r["merma_pct"] / 100)
+
+        costo_insumos = costo_insumos.quantize(Decimal("0.01"))
+        costo_operativo = (costo_insumos * COSTO_OPERATIVO_PCT).quantize(Decimal("0.01"))
+        costo_total = costo_insumos + costo_operativo
+        precio_sugerido = (costo_total / (1 - MARGEN_OBJETIVO)).quantize(Decimal("0.01"))
+        data.append({
+            "platillo_id": int(pid),
+            "platillo": p["nombre"],
+            "costo_insumos": costo_insumos,
+            "costo_operativo": costo_operativo,
+            "costo_total": costo_total,
+            "ganancia_sugerida": precio_sugerido - costo_total,
+            "precio_sugerido": precio_sugerido,
+            "precio_actual": precios.get(int(pid)),
+            "insumos_sin_precio": sin_precio,
+        })
+    data.sort(key=lambda r: (r["platillo"] or "").lower())
+    return data
+
+
 # =========================
 # Platillos
 # =========================
@@ -79,6 +316,7 @@ def platillos_create():
 
     try:
         execute("INSERT INTO platillos (nombre, precio_actual) VALUES (%s,%s)", (nombre, precio_val))
+        invalidar_bom_commit()
         flash("Platillo guardado.", "success")
     except Exception as e:
         flash(f"No se pudo guardar el platillo: {e}", "error")
@@ -126,6 +364,7 @@ def insumos_create():
             "INSERT INTO insumos (nombre, unidad_base, merma_pct, activo) VALUES (%s,%s,%s,1)",
             (nombre, unidad_base, merma_val)
         )
+        invalidar_bom_commit()
         flash("Insumo guardado.", "success")
     except Exception as e:
         flash(f"No se pudo guardar el insumo: {e}", "error")
@@ -144,56 +383,61 @@ def recetas_index():
 
 @costeo_bp.get("/recetas/<int:platillo_id>")
 def recetas_edit(platillo_id):
-    platillo = query_one("SELECT id, nombre, proteina_cantidad_base FROM platillos WHERE id=%s", (platillo_id,))
-    if not platillo:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            bom = get_bom(cursor)
+            costos = costos_vigentes(cursor)
+            costeo_compras = next(iter(costeo_platillos(cursor, [platillo_id])), None)
+    finally:
+        conn.close()
+
+    p = bom["platillos"].get(platillo_id)
+    if not p:
         flash("Platillo no encontrado.", "error")
         return redirect(url_for("costeo.recetas_index"))
-
-    insumos = query_all("""
-        SELECT
-          i.id,
-          i.nombre,
-          i.unidad_base,
-          i.merma_pct,
-          cv.costo_unitario AS ultimo_costo
-        FROM insumos i
-        LEFT JOIN v_insumo_costo_vigente cv ON cv.insumo_id = i.id
-        WHERE i.activo=1
-        ORDER BY i.nombre
-    """)
+    platillo = {"id": platillo_id, "nombre": p["nombre"], "proteina_cantidad_base": p["proteina_cantidad_base"]}
+
+    insumos = sorted(
+        (
+            {
+                "id": i["id"],
+                "nombre": i["nombre"],
+                "unidad_base": i["unidad_base"],
+                "merma_pct": i["merma_pct"],
+                "ultimo_costo": costos.get(int(i["id"])),
+            }
+            for i in bom["insumos"].values() if int(i["activo"] or 0) == 1
+        ),
+        key=lambda i: (i["nombre"] or "").lower()
+    )
 
     # Receta: simplificada para usar solo compras reales
-    receta = query_all("""
-        SELECT
-          r.id AS receta_id,
-          r.insumo_id,
-          i.nombre AS insumo_nombre,
-          i.unidad_base,
-          i.merma_pct,
-          r.cantidad_base,
-          cv.costo_unitario AS costo_unitario_usado,
-          ROUND(
-            r.cantidad_base * cv.costo_unitario * (1 + (i.merma_pct/100)), 2
-          ) AS subtotal
-        FROM recetas r
-        JOIN insumos i ON i.id = r.insumo_id
-        LEFT JOIN v_insumo_costo_vigente cv ON cv.insumo_id = r.insumo_id
-        WHERE r.platillo_id=%s
-        ORDER BY i.nombre
-    """, (platillo_id,))
+    receta = []
+    for r in bom["recetas"].get(platillo_id, []):
+        ins = bom["insumos"].get(r["insumo_id"]) or {}
+        costo = costos.get(r["insumo_id"])
+        subtotal = None
+        if costo is not None:
+            subtotal = (r["cantidad_base"] * costo * (1 + r["merma_pct"] / 100)).quantize(Decimal("0.01"))
+        receta.append({
+            "receta_id": r["receta_id"],
+            "insumo_id": r["insumo_id"],
+            "insumo_nombre": ins.get("nombre"),
+            "unidad_base": ins.get("unidad_base"),
+            "merma_pct": ins.get("merma_pct"),
+            "cantidad_base": r["cantidad_base"],
+            "costo_unitario_usado": costo,
+            "subtotal": subtotal,
+        })
+    receta.sort(key=lambda r: (r["insumo_nombre"] or "").lower())
 
     costeo = None
-    costeo_compras = None
     try:
         costeo = query_one("SELECT * FROM v_costeo_platillos WHERE platillo_id=%s", (platillo_id,))
     except Exception:
         costeo = None
 
-    try:
-        costeo_compras = query_one("SELECT * FROM v_costeo_platillos_compras WHERE platillo_id=%s", (platillo_id,))
-    except Exception:
-        costeo_compras = None
-
     return render_template(
         "admin/recetas_edit.html",
         platillo=platillo,
@@ -266,6 +510,9 @@ def recetas_save(platillo_id):
                 (prot_val, platillo_id)
             )
 
+            invalidar_bom(cursor)
+            actualizar_costo_productos(cursor, [platillo_id])
+
         conn.commit()
     finally:
         conn.close()
@@ -281,7 +528,12 @@ def recetas_save(platillo_id):
 def costeo_index():
     try:
         # Se cambia para mostrar siempre los dinámicos basados en compras
-        data = query_all("SELECT * FROM v_costeo_platillos_compras ORDER BY platillo")
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                data = costeo_platillos(cursor)
+        finally:
+            conn.close()
     except Exception:
         data = []
         flash("No se pudo cargar el costeo dinámico: verifica tus compras.", "error")
@@ -319,6 +571,7 @@ def platillo_precio_update(platillo_id):
                 SET precio = %s
                 WHERE platillo_id = %s
             """, (precio_pos, platillo_id))
+            catalogo.invalidar_catalogo(cursor)
 
             conn.commit()
             flash("Precio actualizado ✅", "success")
@@ -330,3 +583,22 @@ def platillo_precio_update(platillo_id):
         conn.close()
 
     return redirect(url_for("costeo.platillos_index"))
+
+
+if __name__ == "__main__":
+    # Backfill: python costeo.py costos
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "costos":
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cambiados = recalcular_costo_vigente(cursor)
+                propagar_costos(cursor, cambiados)
+                cursor.execute("SELECT COUNT(*) AS n FROM insumo_costo_vigente")
+                n = cursor.fetchone()["n"]
+            conn.commit()
+        finally:
+            conn.close()
+        print(f"Costo vigente recalculado para {n} insumo(s).")
+    else:
+        print("Uso: python costeo.py costos")
@@ -0,0 +1,127 @@
+import sys
+
+import archivo
+from db import get_connection, ensure_ddl
+
+# =========================================================
+# Actividad por cliente (customer_stats)
+# =========================================================
+# Una fila por cliente con sus compras (loyalty_tx reason='purchase' ⋈ pedidos).
+# Se incrementa al registrar una compra y se recalcula por cliente al editar o
+# borrar pedidos. campanas y lista_clientes la leen por rango sobre last_purchase_at.
+
+CUSTOMER_STATS_DDL = """
+    CREATE TABLE IF NOT EXISTS customer_stats (
+        customer_id INT NOT NULL PRIMARY KEY,
+        first_purchase_at DATETIME NULL,
+        last_purchase_at DATETIME NULL,
+        visits INT NOT NULL DEFAULT 0,
+        lifetime_spend DECIMAL(14,2) NOT NULL DEFAULT 0,
+        avg_ticket DECIMAL(14,2) NOT NULL DEFAULT 0,
+        KEY idx_customer_stats_last (last_purchase_at)
+    )
+"""
+
+
+def _ddl(cursor) -> list:
+    # Carga inicial (vivo + archivo) solo si la tabla está vacía
+    seed = f"""
+        INSERT INTO customer_stats (customer_id, first_purchase_at, last_purchase_at, visits, lifetime_spend, avg_ticket)
+        SELECT * FROM ({_compras_sql(archivo.tabla_lectura(cursor, "loyalty"))}) s
+        WHERE NOT EXISTS (SELECT 1 FROM customer_stats)
+    """
+    # READ COMMITTED: el seed no debe esperar los locks de la transacción que llama
+    return [CUSTOMER_STATS_DDL, "SET TRANSACTION ISOLATION LEVEL READ COMMITTED", seed]
+
+
+def ensure_customer_stats_table() -> None:
+    # Una vez por proceso; el seed se arma solo entonces (ensure_ddl, en su propia conexión)
+    ensure_ddl("customer_stats", _ddl)
+
+
+def _compras_sql(tabla_tx: str, filtro: str = "") -> str:
+    return f"""
+        SELECT
+            c.customer_id,
+            MIN(p.fecha) AS first_purchase_at,
+            MAX(p.fecha) AS last_purchase_at,
+            COUNT(*) AS visits,
+            COALESCE(SUM(p.total), 0) AS lifetime_spend,
+            COALESCE(SUM(p.total), 0) / COUNT(*) AS avg_ticket
+        FROM (
+            SELECT DISTINCT tx.customer_id, tx.pedido_id
+            FROM {tabla_tx} tx
+            WHERE tx.reason = 'purchase' {filtro}
+        ) c
+        JOIN pedidos p ON p.id = c.pedido_id
+        GROUP BY c.customer_id
+    """
+
+
+def registrar_compra(cursor, customer_id: int, pedido_id: int) -> None:
+    # Llamar en la misma transacción que inserta el loyalty_tx 'purchase'
+    ensure_customer_stats_table()
+    cursor.execute("""
+        INSERT INTO customer_stats (customer_id, first_purchase_at, last_purchase_at, visits, lifetime_spend, avg_ticket)
+        SELECT %s, p.fecha, p.fecha, 1, COALESCE(p.total, 0), COALESCE(p.total, 0)
+        FROM pedidos p
+        WHERE p.id = %s
+        ON DUPLICATE KEY UPDATE
+            first_purchase_at = LEAST(COALESCE(first_purchase_at, VALUES(first_purchase_at)), VALUES(first_purchase_at)),
+            last_purchase_at = GREATEST(COALESCE(last_purchase_at, VALUES(last_purchase_at)), VALUES(last_purchase_at)),
+            visits = visits + 1,
+            lifetime_spend = lifetime_spend + VALUES(lifetime_spend),
+            avg_ticket = lifetime_spend / visits
+    """, (customer_id, pedido_id))
+
+
+def clientes_de_pedidos(cursor, pedido_ids) -> set:
+    ids = [int(x) for x in pedido_ids]
+    if not ids:
+        return set()
+    placeholders = ",".join(["%s"] * len(ids))
+    tabla_tx = archivo.tabla_lectura(cursor, "loyalty")
+    cursor.execute(f"""
+        SELECT DISTINCT customer_id
+        FROM {tabla_tx} tx
+        WHERE tx.reason = 'purchase' AND tx.pedido_id IN ({placeholders})
+    """, ids)
+    return {int(r["customer_id"]) for r in cursor.fetchall() if r["customer_id"] is not None}
+
+
+def refrescar_clientes(cursor, customer_ids) -> None:
+    ids = sorted({int(x) for x in customer_ids})
+    if not ids:
+        return
+    ensure_customer_stats_table()
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"DELETE FROM customer_stats WHERE customer_id IN ({placeholders})", ids)
+    tabla_tx = archivo.tabla_lectura(cursor, "loyalty")
+    cursor.execute(f"""
+        INSERT INTO customer_stats (customer_id, first_purchase_at, last_purchase_at, visits, lifetime_spend, avg_ticket)
+        {_compras_sql(tabla_tx, f"AND tx.customer_id IN ({placeholders})")}
+    """, ids)
+
+
+def reconstruir() -> int:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            ensure_customer_stats_table()
+            cursor.execute("DELETE FROM customer_stats")
+            cursor.execute(f"""
+                INSERT INTO customer_stats (customer_id, first_purchase_at, last_purchase_at, visits, lifetime_spend, avg_ticket)
+                {_compras_sql(archivo.tabla_lectura(cursor, "loyalty"))}
+            """)
+            n = cursor.rowcount
+        conn.commit()
+        return n
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "reconstruir":
+        print(f"customer_stats reconstruida para {reconstruir()} cliente(s).")
+    else:
+        print("Uso: python customer_stats.py reconstruir")
@@ -1,8 +1,20 @@
 import os
+import time
+import threading
 import pymysql
 
-def get_connection():
-    conn = pymysql.connect(
+# Fuerza sesión a utf8mb4 + collation de MySQL 8 (una sola vez por conexión física)
+SESSION_INIT_SQL = "SET NAMES utf8mb4 COLLATE utf8mb4_0900_ai_ci"
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))
+POOL_WAIT_TIMEOUT = float(os.getenv("DB_POOL_WAIT_TIMEOUT", 10))
+# Si la conexión estuvo ociosa más de esto, se hace ping antes de entregarla
+POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", 30))
+
+
+def _connect_raw():
+    return pymysql.connect(
         host=os.getenv("DB_HOST"),
         port=int(os.getenv("DB_PORT", 3306)),
         user=os.getenv("DB_USER"),
@@ -12,14 +24,328 @@ def get_connection():
         charset="utf8mb4",
         use_unicode=True,
         autocommit=False,
+        init_command=SESSION_INIT_SQL,
     )
 
-    # Fuerza sesión a utf8mb4 + collation de MySQL 8
-    with conn.cursor() as cur:
-        cur.execute("SET NAMES utf8mb4 COLLATE utf8mb4_0900_ai_ci;")
-        cur.execute("SET character_set_client = utf8mb4;")
-        cur.execute("SET character_set_connection = utf8mb4;")
-        cur.execute("SET character_set_results = utf8mb4;")
-        cur.execute("SET collation_connection = 'utf8mb4_0900_ai_ci';")
 
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """Envoltura de una conexión pymysql: close() la regresa al pool en vez de cerrarla."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise pymysql.err.InterfaceError("La conexión ya fue regresada al pool")
+        return getattr(raw, name)
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, connect, max_size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 wait_timeout=POOL_WAIT_TIMEOUT, ping_after=POOL_PING_AFTER):
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.ping_after = ping_after
+
+        self._idle = []  # [(raw_conn, momento_en_que_regresó)]
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "discarded_idle": 0,
+        }
+
+    # ---------- checkout / release ----------
+    def acquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        waited_from = None
+
+        with self._cond:
+            while True:
+                self._expire_idle_locked()
+
+                if self._idle:
+                    raw, returned_at = self._idle.pop()
+                    self._in_use += 1
+                    self._record_wait_locked(waited_from)
+                    break
+
+                if self._in_use < self.max_size:
+                    raw, returned_at = None, None
+                    self._in_use += 1
+                    self._record_wait_locked(waited_from)
+                    break
+
+                if waited_from is None:
+                    waited_from = time.monotonic()
+                    self._stats["waits"] += 1
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    self._record_wait_locked(waited_from)
+                    raise PoolTimeout(f"No hay conexiones libres en el pool (max {self.max_size})")
+                self._cond.wait(remaining)
+
+        try:
+            if raw is not None and not self._healthy(raw, returned_at):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._close_quietly(raw)
+                raw = None
+
+            if raw is None:
+                raw = self._connect()
+                with self._cond:
+                    self._stats["misses"] += 1
+            else:
+                with self._cond:
+                    self._stats["hits"] += 1
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        reusable = raw.open
+        if reusable:
+            try:
+                # Descarta cualquier transacción que el handler haya dejado abierta
+                raw.rollback()
+            except Exception:
+                reusable = False
+
+        with self._cond:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_size:
+                self._idle.append((raw, time.monotonic()))
+                raw = None
+            self._cond.notify()
+
+        if raw is not None:
+            self._close_quietly(raw)
+
+    # ---------- helpers ----------
+    def _healthy(self, raw, returned_at):
+        if not raw.open:
+            return False
+        if returned_at is not None and time.monotonic() - returned_at < self.ping_after:
+            return True
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _expire_idle_locked(self):
+        if not self._idle:
+            return
+        now = time.monotonic()
+        keep = []
+        for raw, returned_at in self._idle:
+            if now - returned_at > self.idle_timeout:
+                self._stats["discarded_idle"] += 1
+                self._close_quietly(raw)
+            else:
+                keep.append((raw, returned_at))
+        self._idle = keep
+
+    def _record_wait_locked(self, waited_from):
+        if waited_from is None:
+            return
+        waited = time.monotonic() - waited_from
+        self._stats["wait_time_total"] += waited
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "pid": os.getpid(),
+            })
+        total = data["hits"] + data["misses"]
+        data["hit_ratio"] = round(data["hits"] / total, 4) if total else 0.0
+        return data
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for raw, _ in idle:
+            self._close_quietly(raw)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    # gunicorn hace fork: cada worker necesita su propio pool
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(_connect_raw)
+                _pool_pid = pid
+    return _pool
+
+
+# Conexiones entregadas en cada hilo: liberar_conexiones_hilo() regresa al pool las que
+# un handler olvidó cerrar (teardown de Flask), para no perder ese lugar para siempre
+_local = threading.local()
+
+
+def get_connection():
+    conn = get_pool().acquire()
+    abiertas = [c for c in getattr(_local, "abiertas", ()) if c.__dict__.get("_raw") is not None]
+    abiertas.append(conn)
+    _local.abiertas = abiertas
     return conn
+
+
+def liberar_conexiones_hilo() -> int:
+    # Regresa cuántas seguían abiertas (cada una es un close() que falta en algún handler)
+    abiertas, _local.abiertas = getattr(_local, "abiertas", []), []
+    fugas = 0
+    for conn in abiertas:
+        if conn.__dict__.get("_raw") is not None:
+            fugas += 1
+            conn.close()
+    return fugas
+
+
+def pool_stats() -> dict:
+    return get_pool().stats()
+
+
+# =========================================================
+# Caché de esquema (reemplaza sondeos a information_schema)
+# =========================================================
+SCHEMA_CACHE_TTL = float(os.getenv("DB_SCHEMA_CACHE_TTL", 600))
+
+
+class SchemaCache:
+    """Columnas por tabla del schema actual, cargadas en una sola consulta y servidas desde memoria."""
+
+    def __init__(self, ttl=SCHEMA_CACHE_TTL):
+        self.ttl = ttl
+        self._columns = None  # {tabla: set(columnas)}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _snapshot(self, cursor):
+        # Una sola lectura de self._columns: otro hilo puede invalidarlo en cualquier momento
+        columns = self._columns
+        if columns is None or (time.monotonic() - self._loaded_at) > self.ttl:
+            columns = self.load(cursor)
+        return columns
+
+    def load(self, cursor):
+        cursor.execute("""
+            SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE()
+        """)
+        columns = {}
+        for row in cursor.fetchall():
+            if isinstance(row, dict):
+                t, c = row["table_name"], row["column_name"]
+            else:
+                t, c = row[0], row[1]
+            columns.setdefault(t.lower(), set()).add(c.lower())
+
+        with self._lock:
+            self._columns = columns
+            self._loaded_at = time.monotonic()
+        return columns
+
+    def has_column(self, cursor, table_name: str, col_name: str) -> bool:
+        return col_name.lower() in self._snapshot(cursor).get(table_name.lower(), ())
+
+    def has_table(self, cursor, table_name: str) -> bool:
+        return table_name.lower() in self._snapshot(cursor)
+
+    def invalidate(self):
+        with self._lock:
+            self._columns = None
+
+
+schema_cache = SchemaCache()
+
+
+def invalidate_schema_cache():
+    # Llamar después de cualquier ALTER/CREATE TABLE hecho en runtime
+    schema_cache.invalidate()
+
+
+# =========================================================
+# DDL de tablas auxiliares (una vez por proceso)
+# =========================================================
+_ddl_done = set()
+_ddl_lock = threading.Lock()
+
+
+def ensure_ddl(nombre: str, statements) -> None:
+    # Corre en su propia conexión: un CREATE TABLE hace commit implícito y no debe
+    # mezclarse con la transacción del handler que lo necesita. Es una conexión fuera del
+    # pool: quien llama ya tiene una del pool, y con el pool lleno de handlers esperando
+    # este mismo _ddl_lock nadie podría tomar una segunda (PoolTimeout en cadena).
+    if nombre in _ddl_done:
+        return
+    with _ddl_lock:
+        if nombre in _ddl_done:
+            return
+        conn = _connect_raw()
+        try:
+            with conn.cursor() as cursor:
+                # statements puede ser una función (cursor) -> lista, para SQL que necesita
+                # consultar algo: solo se arma cuando de verdad se corre
+                if callable(statements):
+                    statements = statements(cursor)
+                for sql in statements:
+                    cursor.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+        invalidate_schema_cache()
+        _ddl_done.add(nombre)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+# =========================================================
+# PDFs del menú: URLs con hash de contenido
+# =========================================================
+# En el build (bin/post_compile) cada PDF se linealiza con qpdf ("fast web view": la
+# primera página se puede mostrar antes de bajar todo el archivo) y se copia a
+# static/dist/<nombre>.<hash>.pdf. manifest.json mapea el nombre original al archivo
+# con hash; como el contenido nunca cambia bajo esa URL se sirve como immutable.
+#
+# ESTATICOS_BASE_URL: si static/dist/ se publica en un CDN/bucket, las URLs apuntan
+# allá y ningún worker transmite el PDF.
+# ESTATICOS_X_ACCEL: prefijo de una location interna de nginx; el worker solo responde
+# la cabecera X-Accel-Redirect y nginx transmite el archivo (con Range).
+#
+#   python estaticos.py build
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+
+PDFS = ["carta.pdf", "menu_Mayo.pdf"]
+
+CACHE_INMUTABLE = "public, max-age=31536000, immutable"
+# Sin build (desarrollo): el original, revalidando por ETag
+CACHE_ORIGINAL = "public, max-age=300"
+
+BASE_URL = os.getenv("ESTATICOS_BASE_URL", "").rstrip("/")
+X_ACCEL = os.getenv("ESTATICOS_X_ACCEL", "").rstrip("/")
+
+_manifest = None
+
+
+def _hash_archivo(ruta) -> str:
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()[:12]
+
+
+def _linealizar(origen, destino) -> bool:
+    qpdf = shutil.which("qpdf")
+    if not qpdf:
+        return False
+    r = subprocess.run(
+        [qpdf, "--linearize", "--object-streams=generate", "--compress-streams=y",
+         "--recompress-flate", origen, destino],
+        capture_output=True,
+    )
+    # qpdf sale con 3 cuando solo hubo advertencias
+    return r.returncode in (0, 3) and os.path.exists(destino)
+
+
+def build() -> dict:
+    os.makedirs(DIST_DIR, exist_ok=True)
+    manifest = {}
+    for nombre in PDFS:
+        origen = os.path.join(STATIC_DIR, nombre)
+        if not os.path.exists(origen):
+            print(f"  {nombre}: no existe, se omite")
+            continue
+        tmp = os.path.join(DIST_DIR, nombre + ".tmp")
+        optimizado = _linealizar(origen, tmp)
+        if not optimizado or os.path.getsize(tmp) > os.path.getsize(origen) * 1.05:
+            # Sin qpdf (o si linealizar lo infla) se publica el original tal cual
+            shutil.copyfile(origen, tmp)
+            optimizado = False
+        base, ext = os.path.splitext(nombre)
+        final = f"{base}.{_hash_archivo(tmp)}{ext}"
+        os.replace(tmp, os.path.join(DIST_DIR, final))
+        manifest[nombre] = final
+        print(f"  {nombre} -> dist/{final} ({os.path.getsize(origen):,} -> "
+              f"{os.path.getsize(os.path.join(DIST_DIR, final)):,} bytes{', linealizado' if optimizado else ''})")
+
+    # Archivos con hash que ya no están en el manifest
+    vigentes = set(manifest.values())
+    for f in os.listdir(DIST_DIR):
+        if f != "manifest.json" and f not in vigentes:
+            os.remove(os.path.join(DIST_DIR, f))
+
+    with open(MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def manifest() -> dict:
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def ruta_publicada(nombre: str) -> str | None:
+    # "dist/<nombre>.<hash>.pdf" relativo a static/, o None si no se corrió el build
+    final = manifest().get(nombre)
+    return f"dist/{final}" if final else None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        m = build()
+        print(f"{len(m)} archivo(s) en {MANIFEST}")
+    else:
+        print("Uso: python estaticos.py build")
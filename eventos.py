@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from pymysql import MySQLError
+
+from db import get_connection, ensure_ddl
+
+log = logging.getLogger(__name__)
+
+# =========================================================
+# Eventos del tablero de cocina
+# =========================================================
+# Quien modifica un pedido inserta el evento en eventos_tablero dentro de su misma
+# transacción (publicar). En cada worker un solo hilo de sondeo lee los eventos nuevos
+# de la tabla, mientras haya streams abiertos, y los reparte a sus suscriptores: un
+# evento llega a los streams de todos los workers, no solo al que atendió el cambio.
+# El id del evento es el AUTO_INCREMENT de la tabla, así Last-Event-ID vale en
+# cualquier worker al reconectar.
+
+# Duración máxima de un stream SSE: el navegador se reconecta solo (EventSource)
+SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", 300))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+# Cada stream ocupa un hilo de gthread: tope por worker para no dejar sin hilos a los requests
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", 4))
+SSE_POLL_SECS = float(os.getenv("SSE_POLL_SECS", 1))
+
+# Eventos que se conservan en la tabla: al publicar se purga, a lo más cada PURGA_SECS
+# por worker, todo lo anterior a los últimos EVENTOS_CONSERVAR ids
+EVENTOS_CONSERVAR = 5000
+PURGA_SECS = 600
+# Una transacción puede hacer commit después de otra con id mayor: el sondeo vuelve a
+# mirar los últimos REVISAR_IDS ids para no perder esos eventos
+REVISAR_IDS = 50
+
+EVENTOS_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS eventos_tablero (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        tipo VARCHAR(32) NOT NULL,
+        data TEXT NULL,
+        creado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+
+def ensure_eventos_table() -> None:
+    ensure_ddl("eventos_tablero", EVENTOS_DDL)
+
+
+class InProcessBroker:
+    """Reparte los eventos del tablero a los suscriptores conectados a este worker."""
+
+    def __init__(self, max_queue=200, history=200, max_subs=SSE_MAX_STREAMS):
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._max_queue = max_queue
+        self._max_subs = max_subs
+        self._history = []
+        self._history_size = history
+
+    def publish(self, tipo: str, data: dict, id=None) -> dict:
+        with self._lock:
+            if id is None:
+                self._seq += 1
+                id = self._seq
+            else:
+                self._seq = max(self._seq, id)
+            evento = {"id": id, "tipo": tipo, "data": data, "ts": time.time()}
+            self._history.append(evento)
+            if len(self._history) > self._history_size:
+                self._history = self._history[-self._history_size:]
+            subs = list(self._subs)
+
+        for q in subs:
+            try:
+                q.put_nowait(evento)
+            except queue.Full:
+                # Cliente demasiado lento: se le pide recargar el tablero completo
+                self._reset(q)
+        return evento
+
+    def _resync(self):
+        return {"id": self._seq, "tipo": "resync", "data": {}, "ts": time.time()}
+
+    def _reset(self, q):
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            q.put_nowait(self._resync())
+        except queue.Full:
+            pass
+
+    def subscribe(self, last_id=None):
+        # None si el worker ya tiene el máximo de streams abiertos
+        q = queue.Queue(maxsize=self._max_queue)
+        with self._lock:
+            if len(self._subs) >= self._max_subs:
+                return None
+            if last_id is not None:
+                pendientes = [e for e in self._history if e["id"] > last_id]
+                # Historial vacío o que ya no llega hasta last_id: pudo perderse algo
+                if not self._history or self._history[0]["id"] > last_id + 1:
+                    pendientes = [self._resync()]
+                for e in pendientes[-self._max_queue:]:
+                    q.put_nowait(e)
+            self._subs.add(q)
+        return q
+
+    def unsubscribe(self, q) -> None:
+        with self._lock:
+            self._subs.discard(q)
+
+    @property
+    def subscribers(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+
+broker = InProcessBroker()
+_proxima_purga = 0.0
+
+
+def publicar(cursor, tipo: str, **data) -> None:
+    global _proxima_purga
+    # Va dentro de la transacción del cambio: el evento existe solo si el cambio hizo commit
+    ensure_eventos_table()
+    cursor.execute(
+        "INSERT INTO eventos_tablero (tipo, data) VALUES (%s, %s)",
+        (tipo, json.dumps(data, default=str)),
+    )
+    evento_id = cursor.lastrowid
+    # Por tiempo y no por id exacto: el AUTO_INCREMENT se salta ids (rollbacks, inserts fallidos)
+    if evento_id and time.monotonic() >= _proxima_purga:
+        _proxima_purga = time.monotonic() + PURGA_SECS
+        cursor.execute("DELETE FROM eventos_tablero WHERE id <= %s", (evento_id - EVENTOS_CONSERVAR,))
+
+
+# =========================
+# Sondeo (un hilo por worker)
+# =========================
+_sondeo_lock = threading.Lock()
+_sondeo_activo = False
+
+
+def _leer_eventos(cursor, ultimo, vistos):
+    if ultimo is None:
+        # Arranque: lo que ya está en la tabla no se reparte
+        cursor.execute("SELECT id FROM eventos_tablero ORDER BY id DESC LIMIT %s", (REVISAR_IDS,))
+        ids = [r["id"] for r in cursor.fetchall()]
+        vistos.update(ids)
+        return max(ids, default=0), []
+    cursor.execute("""
+        SELECT id, tipo, data FROM eventos_tablero
+        WHERE id > %s
+        ORDER BY id
+        LIMIT 500
+    """, (max(0, ultimo - REVISAR_IDS),))
+    nuevos = [r for r in cursor.fetchall() if r["id"] not in vistos]
+    return max([ultimo] + [r["id"] for r in nuevos]), nuevos
+
+
+def _sondear() -> None:
+    global _sondeo_activo
+    ultimo, vistos = None, set()
+    while True:
+        with _sondeo_lock:
+            # Sin streams abiertos en este worker el hilo termina (el próximo stream lo relanza)
+            if broker.subscribers == 0:
+                _sondeo_activo = False
+                return
+        try:
+            ensure_eventos_table()
+            conn = get_connection()
+            try:
+                with conn.cursor() as cursor:
+                    ultimo, nuevos = _leer_eventos(cursor, ultimo, vistos)
+                conn.commit()
+            finally:
+                conn.close()
+            for r in nuevos:
+                vistos.add(r["id"])
+                broker.publish(r["tipo"], json.loads(r["data"] or "{}"), id=r["id"])
+            vistos = {i for i in vistos if i > ultimo - REVISAR_IDS}
+        except MySQLError:
+            log.exception("Error leyendo eventos_tablero")
+        time.sleep(SSE_POLL_SECS)
+
+
+def iniciar_sondeo() -> None:
+    global _sondeo_activo
+    with _sondeo_lock:
+        if _sondeo_activo:
+            return
+        _sondeo_activo = True
+    threading.Thread(target=_sondear, daemon=True, name="eventos-sondeo").start()
+
+
+def formato_sse(evento: dict) -> str:
+    payload = json.dumps(evento["data"], default=str)
+    return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {payload}\n\n"
+
+
+def sse_stream(q, max_duration=SSE_MAX_DURATION, keepalive=SSE_KEEPALIVE):
+    # q viene de broker.subscribe(); quien crea la respuesta se encarga del unsubscribe
+    fin = time.monotonic() + max_duration
+    yield "retry: 3000\n\n"
+    while True:
+        restante = fin - time.monotonic()
+        if restante <= 0:
+            return
+        try:
+            evento = q.get(timeout=min(keepalive, restante))
+        except queue.Empty:
+            yield ": keepalive\n\n"
+            continue
+        yield formato_sse(evento)
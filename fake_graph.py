@@ -0,0 +1,174 @@
+import json
+import random
+import sys
+import threading
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# =========================================================
+# Graph API falsa para probar sync_instagram.py en local
+# =========================================================
+# Sirve /<cuenta>/insights (anuncios) y /<ig-user>/media + ?ids=... (publicaciones
+# orgánicas con sus insights) con paginación por cursor y datos deterministas. Con
+# --fallas P responde 429 (Retry-After: 0) o el error 17 de Graph con probabilidad P,
+# para ejercitar los reintentos.
+#
+#   python fake_graph.py [puerto] [--anuncios N] [--publicaciones N] [--fallas 0.2] [--latencia 0.05]
+#   META_GRAPH_URL=http://127.0.0.1:8765 META_ACCESS_TOKEN=x META_AD_ACCOUNT_ID=1 python sync_instagram.py
+#   META_GRAPH_URL=http://127.0.0.1:8765 META_ACCESS_TOKEN=x META_IG_USER_ID=1 python sync_instagram_organico.py
+
+ANUNCIOS = 20
+PUBLICACIONES = 60  # una cada ~2 días hacia atrás desde hoy
+FALLAS = 0.0
+LATENCIA = 0.0
+
+_stats = {"peticiones": 0, "fallas": 0}
+_stats_lock = threading.Lock()
+
+
+def _metricas_pago(dia: date, anuncio: int) -> dict:
+    rnd = random.Random(f"{dia.isoformat()}-{anuncio}")
+    alcance = rnd.randint(100, 5000)
+    impresiones = alcance + rnd.randint(0, 3000)
+    return {
+        "date_start": dia.isoformat(),
+        "date_stop": dia.isoformat(),
+        "campaign_id": str(1000 + anuncio % 4),
+        "campaign_name": f"Campaña {anuncio % 4}",
+        "ad_name": f"Anuncio {anuncio}",
+        "reach": str(alcance),
+        "impressions": str(impresiones),
+        "frequency": f"{impresiones / alcance:.6f}",
+        "spend": f"{rnd.uniform(5, 300):.2f}",
+    }
+
+
+def _publicaciones() -> list:
+    ahora = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    pubs = []
+    for i in range(PUBLICACIONES):
+        rnd = random.Random(f"pub-{i}")
+        hora = ahora - timedelta(days=2 * i, hours=rnd.randint(0, 12))
+        pubs.append({
+            "id": str(17900000000000000 + i),
+            "timestamp": hora.strftime("%Y-%m-%dT%H:%M:%S+0000"),
+            "media_type": rnd.choice(["IMAGE", "VIDEO", "CAROUSEL_ALBUM"]),
+            "media_product_type": rnd.choice(["FEED", "REELS"]),
+            "permalink": f"https://www.instagram.com/p/fake{i}/",
+            "caption": f"Publicación {i} 🍳",
+        })
+    return pubs
+
+
+def _insights_publicacion(media_id: str) -> dict:
+    rnd = random.Random(f"ins-{media_id}")
+    alcance = rnd.randint(200, 8000)
+    valores = {
+        "reach": alcance, "views": alcance + rnd.randint(0, 6000), "likes": rnd.randint(5, 400),
+        "comments": rnd.randint(0, 60), "shares": rnd.randint(0, 80), "saved": rnd.randint(0, 90),
+    }
+    return {"data": [{"name": k, "period": "lifetime", "values": [{"value": v}]} for k, v in valores.items()]}
+
+
+def _rango(qs):
+    if "time_range" in qs:
+        tr = json.loads(qs["time_range"][0])
+        return date.fromisoformat(tr["since"]), date.fromisoformat(tr["until"])
+    hasta = date.today()
+    return hasta - timedelta(days=29), hasta
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status, cuerpo, headers=None):
+        datos = json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        qs = parse_qs(url.query)
+        with _stats_lock:
+            _stats["peticiones"] += 1
+        if LATENCIA:
+            threading.Event().wait(LATENCIA)
+
+        if FALLAS and random.random() < FALLAS:
+            with _stats_lock:
+                _stats["fallas"] += 1
+            if random.random() < 0.5:
+                return self._json(429, {"error": {"message": "Too many calls", "code": 4}}, {"Retry-After": "0"})
+            return self._json(400, {"error": {"message": "User request limit reached", "code": 17}})
+
+        if url.path.endswith("/insights"):
+            return self._insights(url, qs)
+        if url.path.endswith("/media"):
+            return self._media(url, qs)
+        if url.path.rstrip("/") == "" and "ids" in qs:
+            ids = qs["ids"][0].split(",")
+            if len(ids) > 50:
+                return self._json(400, {"error": {"message": "Too many ids", "code": 100}})
+            return self._json(200, {mid: {"id": mid, "insights": _insights_publicacion(mid)} for mid in ids})
+        if url.path.strip("/").isdigit():
+            mid = url.path.strip("/")
+            return self._json(200, {"id": mid, "insights": _insights_publicacion(mid)})
+        return self._json(404, {"error": {"message": f"Ruta desconocida {url.path}", "code": 100}})
+
+    def _insights(self, url, qs):
+        desde, hasta = _rango(qs)
+        filas = []
+        dia = desde
+        while dia <= hasta:
+            filas.extend(_metricas_pago(dia, a) for a in range(ANUNCIOS))
+            dia += timedelta(days=1)
+        return self._pagina(url, qs, filas)
+
+    def _media(self, url, qs):
+        pubs = _publicaciones()
+        if "since" in qs:
+            since = datetime.fromtimestamp(int(qs["since"][0]), timezone.utc)
+            pubs = [p for p in pubs if datetime.strptime(p["timestamp"], "%Y-%m-%dT%H:%M:%S%z") >= since]
+        return self._pagina(url, qs, pubs)
+
+    def _pagina(self, url, qs, filas):
+        limite = int(qs.get("limit", ["25"])[0])
+        offset = int(qs.get("after", ["0"])[0])
+        cuerpo = {"data": filas[offset:offset + limite], "paging": {"cursors": {"after": str(offset + limite)}}}
+        if offset + limite < len(filas):
+            siguiente = {k: v[0] for k, v in qs.items()}
+            siguiente["after"] = str(offset + limite)
+            cuerpo["paging"]["next"] = f"http://{self.headers['Host']}{url.path}?{urlencode(siguiente)}"
+        return self._json(200, cuerpo)
+
+
+def servir(puerto: int = 8765):
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), Handler)
+    print(f"Graph API falsa en http://127.0.0.1:{servidor.server_address[1]} "
+          f"(anuncios={ANUNCIOS}, publicaciones={PUBLICACIONES}, fallas={FALLAS}, latencia={LATENCIA}s)")
+    return servidor
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    puerto = int(args[0]) if args and args[0].isdigit() else 8765
+    if "--publicaciones" in args:
+        PUBLICACIONES = int(args[args.index("--publicaciones") + 1])
+    if "--anuncios" in args:
+        ANUNCIOS = int(args[args.index("--anuncios") + 1])
+    if "--fallas" in args:
+        FALLAS = float(args[args.index("--fallas") + 1])
+    if "--latencia" in args:
+        LATENCIA = float(args[args.index("--latencia") + 1])
+    servidor = servir(puerto)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{_stats['peticiones']} peticiones, {_stats['fallas']} fallas simuladas")
@@ -0,0 +1,176 @@
+import sys
+from datetime import date, datetime, timedelta
+
+from db import get_connection, invalidate_schema_cache
+
+# =========================================================
+# Filtros de fecha "sargables"
+# =========================================================
+# Meses, rangos y días se traducen a rangos semiabiertos [inicio, fin) sobre la
+# columna cruda (fecha >= %s AND fecha < %s) para que MySQL pueda usar el índice,
+# en vez de envolver la columna en DATE_FORMAT()/DATE().
+
+DIAS_SEMANA = {'Domingo': 1, 'Lunes': 2, 'Martes': 3, 'Miércoles': 4, 'Jueves': 5, 'Viernes': 6, 'Sábado': 7}
+
+
+def parse_fecha(val) -> date | None:
+    if not val:
+        return None
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    try:
+        return datetime.strptime(str(val).strip()[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def rango_mes(yyyy_mm: str):
+    try:
+        year_str, month_str = str(yyyy_mm).split("-")
+        inicio = date(int(year_str), int(month_str), 1)
+    except (ValueError, TypeError):
+        return None
+    fin = date(inicio.year + 1, 1, 1) if inicio.month == 12 else date(inicio.year, inicio.month + 1, 1)
+    return inicio, fin
+
+
+class FiltroFechas:
+    def __init__(self, meses=(), desde=None, hasta=None, dia=None, dias_semana=()):
+        rangos = sorted(r for r in (rango_mes(m) for m in (meses or ())) if r)
+        # Meses consecutivos se juntan en un solo rango
+        self.rangos = []
+        for inicio, fin in rangos:
+            if self.rangos and inicio <= self.rangos[-1][1]:
+                self.rangos[-1] = (self.rangos[-1][0], max(fin, self.rangos[-1][1]))
+            else:
+                self.rangos.append((inicio, fin))
+
+        self.desde = parse_fecha(desde)
+        hasta = parse_fecha(hasta)
+        self.hasta_excl = hasta + timedelta(days=1) if hasta else None
+
+        dia = parse_fecha(dia)
+        if dia:
+            self.rangos = [(dia, dia + timedelta(days=1))]
+
+        self.dias_semana = sorted({
+            DIAS_SEMANA[d] if d in DIAS_SEMANA else int(d)
+            for d in (dias_semana or ())
+            if d in DIAS_SEMANA or str(d).isdigit()
+        })
+
+    @property
+    def inicio(self):
+        # Límite inferior efectivo del filtro (None = sin límite)
+        cotas = []
+        if self.rangos:
+            cotas.append(self.rangos[0][0])
+        if self.desde:
+            cotas.append(self.desde)
+        return max(cotas) if cotas else None
+
+    def condiciones(self, col: str):
+        conds, params = [], []
+
+        if self.rangos:
+            partes = []
+            for inicio, fin in self.rangos:
+                partes.append(f"({col} >= %s AND {col} < %s)")
+                params.extend([inicio, fin])
+            conds.append(partes[0] if len(partes) == 1 else "(" + " OR ".join(partes) + ")")
+
+        if self.desde:
+            conds.append(f"{col} >= %s")
+            params.append(self.desde)
+        if self.hasta_excl:
+            conds.append(f"{col} < %s")
+            params.append(self.hasta_excl)
+
+        if self.dias_semana:
+            # Residual: el rango de arriba sigue siendo el que usa el índice
+            conds.append(f"DAYOFWEEK({col}) IN ({','.join(['%s'] * len(self.dias_semana))})")
+            params.extend(self.dias_semana)
+
+        return conds, params
+
+    def sql(self, col: str, extra=(), prefijo: str = "WHERE"):
+        # extra: [(condición con %s, valor)] p.ej. [("origen = %s", "uber")]
+        conds, params = self.condiciones(col)
+        for cond, val in extra:
+            conds.append(cond)
+            params.append(val)
+        if not conds:
+            return "", params
+        return f"{prefijo} " + " AND ".join(conds), params
+
+
+def meses_con_datos(cursor, tabla: str, col: str = "fecha") -> list:
+    # Meses "YYYY-MM" (más reciente primero) con al menos una fila. MIN/MAX y un
+    # LIMIT 1 por mes se resuelven en el índice de col, sin recorrer la tabla
+    cursor.execute(f"SELECT MIN({col}) AS primero, MAX({col}) AS ultimo FROM {tabla}")
+    row = cursor.fetchone() or {}
+    primero, ultimo = parse_fecha(row.get("primero")), parse_fecha(row.get("ultimo"))
+    if not primero or not ultimo:
+        return []
+    meses = []
+    mes = date(ultimo.year, ultimo.month, 1)
+    while mes >= date(primero.year, primero.month, 1):
+        inicio, fin = rango_mes(mes.strftime("%Y-%m"))
+        cursor.execute(f"SELECT 1 FROM {tabla} WHERE {col} >= %s AND {col} < %s LIMIT 1", (inicio, fin))
+        if cursor.fetchone():
+            meses.append(mes.strftime("%Y-%m"))
+        mes = date(mes.year - 1, 12, 1) if mes.month == 1 else date(mes.year, mes.month - 1, 1)
+    return meses
+
+
+# =========================================================
+# Índices que soportan los rangos
+# =========================================================
+INDICES = [
+    ("pedidos", "idx_pedidos_fecha_estado_origen", "(fecha, estado, origen)"),
+    # Keyset (fecha, id) de /raw-data y su export
+    ("pedidos", "idx_pedidos_fecha_id", "(fecha, id)"),
+    ("insumos_compras", "idx_compras_fecha", "(fecha)"),
+    # Última compra por insumo (recalcular_costo_vigente)
+    ("insumos_compras", "idx_compras_insumo_fecha", "(insumo_id, fecha, id)"),
+    ("ads_instagram_performance", "idx_ads_dia", "(dia)"),
+    ("organic_instagram_performance", "idx_org_hora_publicacion", "(hora_publicacion)"),
+]
+
+
+def asegurar_indices() -> list:
+    creados = []
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            for tabla, nombre, columnas in INDICES:
+                cursor.execute("""
+                    SELECT 1 FROM information_schema.TABLES
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                """, (tabla,))
+                if not cursor.fetchone():
+                    continue
+                cursor.execute("""
+                    SELECT 1 FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+                    LIMIT 1
+                """, (tabla, nombre))
+                if cursor.fetchone():
+                    continue
+                cursor.execute(f"ALTER TABLE {tabla} ADD INDEX {nombre} {columnas}")
+                creados.append(f"{tabla}.{nombre}")
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_schema_cache()
+    return creados
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "indices":
+        creados = asegurar_indices()
+        print("Índices creados: " + (", ".join(creados) if creados else "ninguno (ya existían)"))
+    else:
+        print("Uso: python filtros.py indices")
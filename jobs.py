@@ -0,0 +1,298 @@
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+from flask import Blueprint, render_template, redirect, url_for, flash
+
+from db import get_connection, ensure_ddl, _connect_raw
+
+log = logging.getLogger(__name__)
+
+# =========================================================
+# Jobs periódicos dentro de la app
+# =========================================================
+# Cada worker de gunicorn corre un hilo que revisa cada JOBS_TICK_SECS qué jobs ya
+# tocan. Para correr uno toma GET_LOCK('jobs:<nombre>', 0) en una conexión fuera del
+# pool: solo un worker lo gana y los demás lo saltan. El trabajo corre en un subproceso
+# (python <script> <args>), así no compite por el GIL con los requests y el timeout lo
+# puede matar de verdad.
+# El historial queda en jobs_ejecuciones y se ve en /admin/jobs.
+
+JOBS_DDL = """
+    CREATE TABLE IF NOT EXISTS jobs_ejecuciones (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        job VARCHAR(64) NOT NULL,
+        inicio DATETIME NOT NULL,
+        fin DATETIME NULL,
+        estado VARCHAR(16) NOT NULL,
+        worker VARCHAR(128) NULL,
+        salida TEXT NULL,
+        KEY idx_jobs_job_inicio (job, inicio)
+    )
+"""
+
+HABILITADOS = os.getenv("JOBS_HABILITADOS", "1") == "1"
+TICK_SECS = float(os.getenv("JOBS_TICK_SECS", 60))
+SALIDA_MAX = 8000  # caracteres de stdout/stderr que se guardan por corrida
+# Código de salida de un script que no corrió por falta de credenciales (EX_CONFIG,
+# el mismo que sync_instagram.SALIDA_SIN_CREDENCIALES)
+SALIDA_SIN_CREDENCIALES = 78
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+JOBS = {}
+
+
+def registrar(nombre: str, comando, cada: timedelta, timeout: int, descripcion: str = "") -> None:
+    # comando: [script, args...] relativo a la raíz del repo, o una función que lo regresa
+    JOBS[nombre] = {
+        "nombre": nombre,
+        "comando": comando,
+        "cada": cada,
+        "timeout": timeout,
+        "descripcion": descripcion,
+    }
+
+
+registrar("meta_ads", ["sync_instagram.py", "incremental"], timedelta(hours=6), 15 * 60,
+          "Insights de anuncios (watermark + ventana de atribución)")
+registrar("ig_organico", ["sync_instagram_organico.py", "incremental"], timedelta(hours=6), 15 * 60,
+          "Publicaciones orgánicas y sus insights")
+registrar("rollup_ventas", lambda: ["rollup.py", (date.today() - timedelta(days=3)).isoformat()], timedelta(hours=24), 10 * 60,
+          "Recalcula rollup_ventas de los últimos 3 días (red de seguridad)")
+registrar("costos_vigentes", ["costeo.py", "costos"], timedelta(hours=24), 10 * 60,
+          "Costo vigente por insumo y costo de productos")
+registrar("stock_reconciliar", ["stock.py", "reconciliar"], timedelta(hours=24), 5 * 60,
+          "Compara stock_balance contra el ledger (error = hay diferencias)")
+registrar("customer_stats", ["customer_stats.py", "reconstruir"], timedelta(days=7), 20 * 60,
+          "Reconstruye customer_stats desde loyalty_tx")
+registrar("archivo_compactar", ["archivo.py", "compactar"], timedelta(hours=24), 30 * 60,
+          "Snapshots mensuales y archivo de ledgers viejos")
+
+
+def ensure_jobs_table() -> None:
+    ensure_ddl("jobs_ejecuciones", [JOBS_DDL])
+
+
+def _comando(job) -> list:
+    args = job["comando"]() if callable(job["comando"]) else job["comando"]
+    return [sys.executable, os.path.join(BASE_DIR, args[0]), *args[1:]]
+
+
+def _texto(salida) -> str:
+    if isinstance(salida, bytes):
+        return salida.decode("utf-8", "replace")
+    return salida or ""
+
+
+def _correr(job):
+    try:
+        r = subprocess.run(_comando(job), cwd=BASE_DIR, capture_output=True, text=True, timeout=job["timeout"])
+        if r.returncode == 0:
+            estado = "ok"
+        elif r.returncode == SALIDA_SIN_CREDENCIALES:
+            estado = "sin_credenciales"
+        else:
+            estado = "error"
+        salida = r.stdout + r.stderr
+    except subprocess.TimeoutExpired as e:
+        # subprocess.run ya mató al proceso
+        estado = "timeout"
+        salida = _texto(e.stdout) + _texto(e.stderr) + f"\n[timeout después de {job['timeout']}s]"
+    except OSError as e:
+        estado, salida = "error", str(e)
+    return estado, salida[-SALIDA_MAX:]
+
+
+def pendientes(cursor) -> list:
+    # Jobs cuya última corrida (en cualquier worker) ya tiene más de 'cada'
+    cursor.execute("""
+        SELECT job, TIMESTAMPDIFF(SECOND, MAX(inicio), NOW()) AS hace
+        FROM jobs_ejecuciones
+        GROUP BY job
+    """)
+    hace = {r["job"]: r["hace"] for r in cursor.fetchall()}
+    return [n for n, j in JOBS.items() if hace.get(n) is None or hace[n] >= j["cada"].total_seconds()]
+
+
+def ejecutar(nombre: str, forzar: bool = False):
+    # Regresa el estado de la corrida, o None si otro worker la tiene o todavía no toca
+    ensure_jobs_table()
+    job = JOBS[nombre]
+    clave = f"jobs:{nombre}"
+    # Conexión propia, fuera del pool: retiene el lock mientras dura el subproceso (hasta
+    # timeout) y no debe quitarle un lugar del pool a los requests del worker
+    conn = _connect_raw()
+    try:
+        with conn.cursor() as cursor:
+            # El lock vive en esta sesión: se libera solo si el worker muere
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS ok", (clave,))
+            if not (cursor.fetchone() or {}).get("ok"):
+                return None
+            try:
+                # Revisar de nuevo con el lock: otro worker pudo terminarlo hace un momento
+                if not forzar and nombre not in pendientes(cursor):
+                    return None
+                # 'corriendo' sin lock = el worker que la corría murió
+                cursor.execute("""
+                    UPDATE jobs_ejecuciones SET estado = 'abandonado', fin = NOW()
+                    WHERE job = %s AND estado = 'corriendo'
+                """, (nombre,))
+                cursor.execute("""
+                    INSERT INTO jobs_ejecuciones (job, inicio, estado, worker)
+                    VALUES (%s, NOW(), 'corriendo', %s)
+                """, (nombre, WORKER))
+                ejecucion_id = cursor.lastrowid
+                conn.commit()
+
+                estado, salida = _correr(job)
+
+                cursor.execute("""
+                    UPDATE jobs_ejecuciones SET fin = NOW(), estado = %s, salida = %s WHERE id = %s
+                """, (estado, salida, ejecucion_id))
+                conn.commit()
+                return estado
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (clave,))
+    finally:
+        conn.close()
+
+
+def _en_hilo(nombre: str, forzar: bool = False) -> None:
+    def correr():
+        try:
+            ejecutar(nombre, forzar)
+        except Exception:
+            log.exception("Job %s falló", nombre)
+        finally:
+            with _lock:
+                _en_curso.discard(nombre)
+
+    with _lock:
+        if nombre in _en_curso:
+            return
+        _en_curso.add(nombre)
+    threading.Thread(target=correr, daemon=True, name=f"job-{nombre}").start()
+
+
+def _ciclo() -> None:
+    # Arranque desfasado para que los workers no consulten todos al mismo tiempo
+    time.sleep(random.uniform(1, min(TICK_SECS, 30)))
+    while True:
+        try:
+            ensure_jobs_table()
+            conn = get_connection()
+            try:
+                with conn.cursor() as cursor:
+                    tocan = pendientes(cursor)
+            finally:
+                conn.close()
+            for nombre in tocan:
+                _en_hilo(nombre)
+        except Exception:
+            log.exception("Error revisando jobs")
+        time.sleep(TICK_SECS)
+
+
+_lock = threading.Lock()
+_en_curso = set()
+_iniciado = False
+
+
+def iniciar() -> None:
+    # Una vez por proceso (primer request del worker)
+    global _iniciado
+    if _iniciado or not HABILITADOS:
+        return
+    with _lock:
+        if _iniciado:
+            return
+        _iniciado = True
+    threading.Thread(target=_ciclo, daemon=True, name="jobs").start()
+
+
+# =========================
+# /admin/jobs
+# =========================
+jobs_bp = Blueprint("jobs", __name__, url_prefix="/admin")
+
+
+@jobs_bp.route("/jobs")
+def jobs_index():
+    ensure_jobs_table()
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT e.*, TIMESTAMPDIFF(SECOND, e.inicio, COALESCE(e.fin, NOW())) AS duracion
+                FROM jobs_ejecuciones e
+                JOIN (SELECT job, MAX(id) AS id FROM jobs_ejecuciones GROUP BY job) u ON u.id = e.id
+            """)
+            ultimas = {r["job"]: r for r in cursor.fetchall()}
+            cursor.execute("""
+                SELECT id, job, inicio, fin, estado, worker,
+                       TIMESTAMPDIFF(SECOND, inicio, COALESCE(fin, NOW())) AS duracion
+                FROM jobs_ejecuciones
+                ORDER BY id DESC
+                LIMIT 50
+            """)
+            historial = cursor.fetchall()
+    finally:
+        conn.close()
+
+    jobs = [
+        {
+            **j,
+            "cada_horas": j["cada"].total_seconds() / 3600,
+            "ultima": ultimas.get(n),
+            "siguiente": (ultimas[n]["inicio"] + j["cada"]) if n in ultimas else None,
+        }
+        for n, j in JOBS.items()
+    ]
+    return render_template("admin/jobs.html", jobs=jobs, historial=historial,
+                           habilitados=HABILITADOS, worker=WORKER)
+
+
+@jobs_bp.route("/jobs/<int:ejecucion_id>")
+def jobs_salida(ejecucion_id):
+    ensure_jobs_table()
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT job, estado, salida FROM jobs_ejecuciones WHERE id = %s", (ejecucion_id,))
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return "No encontrado", 404
+    return f"[{row['job']} · {row['estado']}]\n\n{row['salida'] or ''}", 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+@jobs_bp.route("/jobs/<nombre>/correr", methods=["POST"])
+def jobs_correr(nombre):
+    if nombre not in JOBS:
+        flash("Job desconocido.", "error")
+    else:
+        _en_hilo(nombre, forzar=True)
+        flash(f"Job {nombre} lanzado (si otro worker lo está corriendo, se omite).", "success")
+    return redirect(url_for("jobs.jobs_index"))
+
+
+if __name__ == "__main__":
+    # python jobs.py listar | correr <nombre>
+    accion = sys.argv[1] if len(sys.argv) > 1 else ""
+    if accion == "listar":
+        for n, j in JOBS.items():
+            print(f"{n:<20} cada {j['cada']}  timeout {j['timeout']}s  {j['descripcion']}")
+    elif accion == "correr" and len(sys.argv) > 2 and sys.argv[2] in JOBS:
+        estado = ejecutar(sys.argv[2], forzar=True)
+        print(f"{sys.argv[2]}: {estado or 'omitido (otro proceso tiene el lock)'}")
+        sys.exit(0 if estado in ("ok", None) else 1)
+    else:
+        print("Uso: python jobs.py listar | correr <nombre>")
@@ -0,0 +1,173 @@
+import logging
+import sys
+from datetime import date, datetime, timedelta
+
+from db import get_connection, ensure_ddl, schema_cache
+
+log = logging.getLogger(__name__)
+
+# =========================================================
+# Rollup diario de ventas (lo lee el dashboard)
+# =========================================================
+# rollup_ventas_dia:          (dia, hora, origen, metodo_pago) -> pedidos, total, descuento, monto_uber, neto
+# rollup_ventas_producto_dia: (dia, origen, metodo_pago, producto_id) -> categoria, pedidos, unidades, ingreso
+#
+# Se mantiene recalculando solo los días tocados por un pedido (alta, edición, borrado).
+# El handler junta los días dentro de su transacción y los refresca después del commit
+# (refrescar_tras_commit), en transacciones propias bajo READ COMMITTED: así el
+# INSERT ... SELECT lee pedidos como lectura consistente, sin los next-key locks que
+# toma en REPEATABLE READ y que serializaban (o trababan) los pedidos del mismo día.
+# GET_LOCK('rollup:<dia>') ordena dos refrescos del mismo día: el que entra después
+# ve todo lo que ya hizo commit. Si un refresco falla, el job rollup_ventas lo corrige.
+
+ROLLUP_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS rollup_ventas_dia (
+        dia DATE NOT NULL,
+        hora TINYINT NOT NULL,
+        origen VARCHAR(50) NOT NULL DEFAULT '',
+        metodo_pago VARCHAR(50) NOT NULL DEFAULT '',
+        pedidos INT NOT NULL DEFAULT 0,
+        total DECIMAL(14,2) NOT NULL DEFAULT 0,
+        descuento DECIMAL(14,2) NOT NULL DEFAULT 0,
+        monto_uber DECIMAL(14,2) NOT NULL DEFAULT 0,
+        neto DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (dia, hora, origen, metodo_pago)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_ventas_producto_dia (
+        dia DATE NOT NULL,
+        origen VARCHAR(50) NOT NULL DEFAULT '',
+        metodo_pago VARCHAR(50) NOT NULL DEFAULT '',
+        producto_id INT NOT NULL,
+        categoria VARCHAR(100) NULL,
+        pedidos INT NOT NULL DEFAULT 0,
+        unidades DECIMAL(14,3) NOT NULL DEFAULT 0,
+        ingreso DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (dia, origen, metodo_pago, producto_id),
+        KEY idx_rvpd_producto (producto_id, dia)
+    )
+    """,
+]
+
+
+def ensure_rollup_tables() -> None:
+    ensure_ddl("rollup_ventas", ROLLUP_DDL)
+
+
+def _as_date(val):
+    if val is None:
+        return None
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    return datetime.strptime(str(val)[:10], "%Y-%m-%d").date()
+
+
+def dias_de_pedidos(cursor, pedido_ids, dias_extra=()) -> set:
+    # dias_extra: días leídos antes de un cambio de fecha
+    dias = {_as_date(d) for d in dias_extra if d}
+    ids = [int(x) for x in pedido_ids]
+    if not ids:
+        return dias
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"SELECT DISTINCT DATE(fecha) AS dia FROM pedidos WHERE id IN ({placeholders})", ids)
+    return dias | {_as_date(r["dia"]) for r in cursor.fetchall() if r["dia"] is not None}
+
+
+def refrescar_dias(cursor, dias) -> None:
+    dias = sorted({_as_date(d) for d in dias if d is not None})
+    if not dias:
+        return
+    ensure_rollup_tables()
+
+    col_desc = "COALESCE(pe.descuento, 0)" if schema_cache.has_column(cursor, "pedidos", "descuento") else "0"
+
+    for dia in dias:
+        desde = datetime.combine(dia, datetime.min.time())
+        hasta = desde + timedelta(days=1)
+
+        cursor.execute("DELETE FROM rollup_ventas_dia WHERE dia = %s", (dia,))
+        cursor.execute("DELETE FROM rollup_ventas_producto_dia WHERE dia = %s", (dia,))
+
+        cursor.execute(f"""
+            INSERT INTO rollup_ventas_dia (dia, hora, origen, metodo_pago, pedidos, total, descuento, monto_uber, neto)
+            SELECT
+                %s, HOUR(pe.fecha), COALESCE(pe.origen, ''), COALESCE(pe.metodo_pago, ''),
+                COUNT(*), COALESCE(SUM(pe.total), 0), COALESCE(SUM({col_desc}), 0),
+                COALESCE(SUM(pe.monto_uber), 0), COALESCE(SUM(pe.neto), 0)
+            FROM pedidos pe
+            WHERE pe.fecha >= %s AND pe.fecha < %s
+            GROUP BY HOUR(pe.fecha), COALESCE(pe.origen, ''), COALESCE(pe.metodo_pago, '')
+        """, (dia, desde, hasta))
+
+        cursor.execute("""
+            INSERT INTO rollup_ventas_producto_dia (dia, origen, metodo_pago, producto_id, categoria, pedidos, unidades, ingreso)
+            SELECT
+                %s, COALESCE(pe.origen, ''), COALESCE(pe.metodo_pago, ''), pi.producto_id, MAX(p.categoria),
+                COUNT(DISTINCT pe.id), COALESCE(SUM(pi.cantidad), 0), COALESCE(SUM(pi.subtotal), 0)
+            FROM pedidos pe
+            JOIN pedido_items pi ON pi.pedido_id = pe.id
+            JOIN productos p ON p.id = pi.producto_id
+            WHERE pe.fecha >= %s AND pe.fecha < %s
+            GROUP BY COALESCE(pe.origen, ''), COALESCE(pe.metodo_pago, ''), pi.producto_id
+        """, (dia, desde, hasta))
+
+
+def refrescar_aislado(conn, dias) -> None:
+    # Un día por transacción, fuera de la transacción del pedido (ver arriba)
+    dias = sorted({_as_date(d) for d in dias if d is not None})
+    if not dias:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        try:
+            for dia in dias:
+                clave = f"rollup:{dia.isoformat()}"
+                cursor.execute("SELECT GET_LOCK(%s, 10) AS ok", (clave,))
+                try:
+                    refrescar_dias(cursor, [dia])
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (clave,))
+        finally:
+            # La conexión regresa al pool: no dejarle el nivel de aislamiento cambiado
+            cursor.execute("SET SESSION transaction_isolation = @@GLOBAL.transaction_isolation")
+            conn.commit()
+
+
+def refrescar_tras_commit(conn, dias) -> None:
+    # El pedido ya hizo commit: un error aquí no debe tumbar el request
+    try:
+        refrescar_aislado(conn, dias)
+    except Exception:
+        log.exception("No se pudo refrescar el rollup de %s", sorted(dias))
+
+
+def reconstruir(desde=None) -> int:
+    # Backfill completo (o desde una fecha), un día por transacción
+    ensure_rollup_tables()
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            if desde:
+                cursor.execute("SELECT DISTINCT DATE(fecha) AS dia FROM pedidos WHERE fecha >= %s ORDER BY dia", (desde,))
+            else:
+                cursor.execute("SELECT DISTINCT DATE(fecha) AS dia FROM pedidos ORDER BY dia")
+            dias = [_as_date(r["dia"]) for r in cursor.fetchall() if r["dia"] is not None]
+
+        conn.commit()
+        refrescar_aislado(conn, dias)
+        return len(dias)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    n = reconstruir(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Rollup de ventas reconstruido para {n} día(s).")
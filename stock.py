@@ -0,0 +1,149 @@
+import sys
+from decimal import Decimal
+
+import archivo
+from db import get_connection, ensure_ddl
+
+# =========================================================
+# Saldo de stock por insumo (stock_balance)
+# =========================================================
+# Se mantiene en la misma transacción que cada INSERT/DELETE sobre
+# inventario_movimientos, para no sumar todo el ledger en cada consulta.
+# reconciliar() compara saldo contra SUM(ledger) y reporta (o corrige) diferencias.
+
+STOCK_BALANCE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS stock_balance (
+        insumo_id INT NOT NULL PRIMARY KEY,
+        stock DECIMAL(16,4) NOT NULL DEFAULT 0,
+        actualizado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+    """,
+    # Lectura consistente sin locks: quien llama puede tener movimientos sin commit
+    "SET TRANSACTION ISOLATION LEVEL READ COMMITTED",
+    # Carga inicial desde el ledger, solo si la tabla está vacía
+    """
+    INSERT INTO stock_balance (insumo_id, stock)
+    SELECT insumo_id, SUM(cantidad_base)
+    FROM inventario_movimientos
+    WHERE NOT EXISTS (SELECT 1 FROM stock_balance)
+    GROUP BY insumo_id
+    """,
+]
+
+
+def ensure_stock_balance_table() -> None:
+    ensure_ddl("stock_balance", STOCK_BALANCE_DDL)
+
+
+def aplicar_deltas(cursor, deltas: dict) -> None:
+    rows = [(int(i), str(d)) for i, d in deltas.items() if d]
+    if not rows:
+        return
+    ensure_stock_balance_table()
+    cursor.executemany("""
+        INSERT INTO stock_balance (insumo_id, stock) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE stock = stock + VALUES(stock)
+    """, rows)
+
+
+def movimientos_por_ref(cursor, tipo: str, ref_tabla: str, ref_ids) -> dict:
+    ids = [int(x) for x in ref_ids]
+    if not ids:
+        return {}
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"""
+        SELECT insumo_id, SUM(cantidad_base) AS total
+        FROM inventario_movimientos
+        WHERE tipo = %s AND ref_tabla = %s AND ref_id IN ({placeholders})
+        GROUP BY insumo_id
+    """, (tipo, ref_tabla, *ids))
+    return {int(r["insumo_id"]): Decimal(str(r["total"] or 0)) for r in cursor.fetchall()}
+
+
+def antes_de_insertar(cursor, tipo: str, ref_tabla: str, ref_ids) -> dict:
+    # Con INSERT IGNORE no se sabe qué filas entraron: se compara el ledger antes y después
+    return movimientos_por_ref(cursor, tipo, ref_tabla, ref_ids)
+
+
+def despues_de_insertar(cursor, tipo: str, ref_tabla: str, ref_ids, antes: dict) -> None:
+    despues = movimientos_por_ref(cursor, tipo, ref_tabla, ref_ids)
+    aplicar_deltas(cursor, {i: despues.get(i, Decimal("0")) - antes.get(i, Decimal("0")) for i in set(antes) | set(despues)})
+
+
+def borrar_movimientos(cursor, tipo: str, ref_tabla: str, ref_ids) -> None:
+    ids = [int(x) for x in ref_ids]
+    if not ids:
+        return
+    deltas = {i: -total for i, total in movimientos_por_ref(cursor, tipo, ref_tabla, ids).items()}
+    placeholders = ",".join(["%s"] * len(ids))
+    # Movimientos viejos pueden estar ya en el archivo (archivo.py)
+    for i, d in archivo.borrar_archivados(
+        cursor, "inventario", f"tipo = %s AND ref_tabla = %s AND ref_id IN ({placeholders})", (tipo, ref_tabla, *ids)
+    ).items():
+        deltas[i] = deltas.get(i, Decimal("0")) + d
+    aplicar_deltas(cursor, deltas)
+    cursor.execute(f"""
+        DELETE FROM inventario_movimientos
+        WHERE tipo = %s AND ref_tabla = %s AND ref_id IN ({placeholders})
+    """, (tipo, ref_tabla, *ids))
+
+
+def reconciliar(corregir: bool = False) -> list:
+    ensure_stock_balance_table()
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            # Total del ledger = snapshot del último corte + movimientos vivos (archivo.saldos)
+            ledger = archivo.saldos(cursor, "inventario")
+            cursor.execute("SELECT insumo_id, stock FROM stock_balance")
+            balance = {int(r["insumo_id"]): Decimal(str(r["stock"])) for r in cursor.fetchall()}
+            drift = [
+                {
+                    "insumo_id": i,
+                    "saldo": balance.get(i, Decimal("0")),
+                    "ledger": ledger.get(i, Decimal("0")),
+                    "diferencia": balance.get(i, Decimal("0")) - ledger.get(i, Decimal("0")),
+                }
+                for i in sorted(set(ledger) | set(balance))
+                if balance.get(i, Decimal("0")) != ledger.get(i, Decimal("0"))
+            ]
+            conn.commit()
+
+            if corregir and drift:
+                # Se corrige restando la diferencia (no escribiendo el ledger): así no se pisan
+                # movimientos que entraron después del snapshot. executemany solo expande el
+                # grupo VALUES(...), por eso no hay %s en el ON DUPLICATE KEY UPDATE.
+                con_saldo = [d for d in drift if d["insumo_id"] in balance]
+                sin_saldo = [d for d in drift if d["insumo_id"] not in balance]
+                if con_saldo:
+                    cursor.executemany(
+                        "UPDATE stock_balance SET stock = stock - %s WHERE insumo_id = %s",
+                        [(str(d["diferencia"]), d["insumo_id"]) for d in con_saldo],
+                    )
+                if sin_saldo:
+                    cursor.executemany("""
+                        INSERT INTO stock_balance (insumo_id, stock) VALUES (%s, %s)
+                        ON DUPLICATE KEY UPDATE stock = stock + VALUES(stock)
+                    """, [(d["insumo_id"], str(d["ledger"])) for d in sin_saldo])
+                conn.commit()
+        return drift
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # python stock.py reconciliar [--corregir]
+    if len(sys.argv) > 1 and sys.argv[1] == "reconciliar":
+        corregir = "--corregir" in sys.argv
+        drift = reconciliar(corregir=corregir)
+        for d in drift:
+            print(f"insumo {d['insumo_id']}: saldo={d['saldo']} ledger={d['ledger']} diferencia={d['diferencia']}")
+        if not drift:
+            print("stock_balance cuadra con inventario_movimientos.")
+        elif corregir:
+            print(f"{len(drift)} insumo(s) corregidos.")
+        sys.exit(1 if drift and not corregir else 0)
+    else:
+        print("Uso: python stock.py reconciliar [--corregir]")
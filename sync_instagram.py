@@ -1,112 +1,367 @@
+import hashlib
 import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
 import requests
-import pymysql
-from datetime import datetime
-from db import get_connection
+from requests.adapters import HTTPAdapter
+
+from db import get_connection, ensure_ddl, schema_cache, invalidate_schema_cache
 
 # === CREDENCIALES DESDE RAILWAY ===
 ACCESS_TOKEN = os.environ.get("META_ACCESS_TOKEN")
 AD_ACCOUNT_ID = os.environ.get("META_AD_ACCOUNT_ID") # Ejemplo: act_123456789
 # ==================================
 
-def obtener_insights_pago():
-    if not AD_ACCOUNT_ID.startswith("act_"):
-        # Nos aseguramos de que tenga el prefijo correcto que exige Meta
-        cuenta_id = f"act_{AD_ACCOUNT_ID}"
-    else:
-        cuenta_id = AD_ACCOUNT_ID
-
-    url = f"https://graph.facebook.com/v19.0/{cuenta_id}/insights"
-    
-    params = {
-        "level": "ad",  # Trae los datos detallados a nivel de anuncio
-        "fields": "date_start,campaign_id,campaign_name,ad_name,reach,impressions,frequency,spend",
-        "time_increment": 1,  # ¡CLAVE! Nos desglosa la info día por día
-        "date_preset": "last_30d",  # Revisa los últimos 30 días para actualizar cambios de atribución
-        "access_token": ACCESS_TOKEN,
-        "limit": 150
-    }
-    
-    lista_insights = []
-    
+# META_GRAPH_URL permite apuntar a un servidor falso local (fake_graph.py)
+GRAPH_URL = os.environ.get("META_GRAPH_URL", "https://graph.facebook.com/v19.0").rstrip("/")
+
+DIAS_SYNC = int(os.environ.get("META_SYNC_DIAS", 30))
+# Modo incremental: días hacia atrás que Meta todavía puede corregir (atribución)
+DIAS_ATRIBUCION = int(os.environ.get("META_DIAS_ATRIBUCION", 3))
+# Rango por petición: ventanas más cortas = más páginas en paralelo
+VENTANA_DIAS = int(os.environ.get("META_VENTANA_DIAS", 7))
+CONCURRENCIA = int(os.environ.get("META_CONCURRENCIA", 4))
+LOTE_UPSERT = int(os.environ.get("META_LOTE_UPSERT", 500))
+# Código de salida del CLI cuando faltan credenciales (EX_CONFIG): jobs.py lo registra
+# como "sin_credenciales" en vez de "error"
+SALIDA_SIN_CREDENCIALES = 78
+
+TIMEOUT = (5, 60)  # (conexión, lectura)
+MAX_REINTENTOS = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Códigos de error de Graph API por límite de uso (app, usuario, página, anuncios)
+CODIGOS_LIMITE = {4, 17, 32, 613} | set(range(80000, 80015))
+
+
+class GraphError(Exception):
+    pass
+
+
+# =========================================================
+# Cliente HTTP: sesión compartida + reintentos
+# =========================================================
+
+def crear_sesion(concurrencia: int = CONCURRENCIA) -> requests.Session:
+    # Una sesión para todos los hilos: reutiliza conexiones TLS (pool del tamaño de la concurrencia)
+    sesion = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(1, concurrencia))
+    sesion.mount("https://", adapter)
+    sesion.mount("http://", adapter)
+    return sesion
+
+
+def _error_graph(res):
     try:
-        print(f"Consultando la API de Marketing para la cuenta {cuenta_id}...")
-        res = requests.get(url, params=params)
-        res.raise_for_status()
-        
-        datos_json = res.json()
-        lista_insights.extend(datos_json.get("data", []))
-        
-        # Lógica de paginación por si tienes muchísimos anuncios circulando
-        while "paging" in datos_json and "next" in datos_json["paging"]:
-            res = requests.get(datos_json["paging"]["next"])
-            res.raise_for_status()
-            datos_json = res.json()
-            lista_insights.extend(datos_json.get("data", []))
-            
-        print(f"Se obtuvieron {len(lista_insights)} registros diarios de rendimiento pagado.")
-        return lista_insights
+        return (res.json() or {}).get("error") or {}
+    except ValueError:
+        return {}
 
-    except Exception as e:
-        print(f"Error al obtener insights de pago: {e}")
-        return []
 
-def sincronizar_bd_pago():
-    # Print de diagnóstico temporal
-    print(f"[DIAGNÓSTICO] TOKEN encontrado: {'SÍ' if ACCESS_TOKEN else 'NO'}")
-    print(f"[DIAGNÓSTICO] AD_ACCOUNT_ID encontrado: {'SÍ' if AD_ACCOUNT_ID else 'NO'}")
+def _es_reintentable(res) -> bool:
+    if res.status_code == 429 or res.status_code >= 500:
+        return True
+    error = _error_graph(res)
+    return error.get("code") in CODIGOS_LIMITE or bool(error.get("is_transient"))
+
+
+def _espera(intento: int, res=None) -> float:
+    retry_after = res.headers.get("Retry-After") if res is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+    # Exponencial con jitter para que los hilos no reintenten todos a la vez
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** intento)) * random.uniform(0.5, 1.0)
+
+
+def graph_get(sesion, url, params=None) -> dict:
+    for intento in range(MAX_REINTENTOS + 1):
+        try:
+            res = sesion.get(url, params=params, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if intento == MAX_REINTENTOS:
+                raise GraphError(f"Sin respuesta de Graph API: {e}") from e
+            time.sleep(_espera(intento))
+            continue
+
+        if res.ok:
+            return res.json()
+        if intento < MAX_REINTENTOS and _es_reintentable(res):
+            espera = _espera(intento, res)
+            print(f"  Límite/errores de Graph API ({res.status_code}), reintento en {espera:.1f}s")
+            time.sleep(espera)
+            continue
+        error = _error_graph(res)
+        raise GraphError(f"HTTP {res.status_code}: {error.get('message') or res.text[:200]}")
+
+
+def paginas(sesion, url, params):
+    # Una página a la vez siguiendo paging.next (la URL siguiente ya trae el token y el cursor)
+    datos = graph_get(sesion, url, params)
+    while True:
+        yield datos.get("data", [])
+        siguiente = (datos.get("paging") or {}).get("next")
+        if not siguiente:
+            return
+        datos = graph_get(sesion, siguiente)
+
+
+def paginas_concurrentes(sesion, url, lista_params, concurrencia: int = CONCURRENCIA):
+    # Cada juego de params (ventana de fechas) se pagina en su hilo; las páginas llegan
+    # por una cola acotada, así quien consume escribe mientras se sigue descargando
+    cola = queue.Queue(maxsize=concurrencia * 2)
+    parar = threading.Event()
+    fin = object()
+
+    def poner(item):
+        while not parar.is_set():
+            try:
+                cola.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def trabajar(params):
+        try:
+            for pagina in paginas(sesion, url, params):
+                if parar.is_set():
+                    return
+                poner(pagina)
+        finally:
+            poner(fin)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as ex:
+        futuros = [ex.submit(trabajar, p) for p in lista_params]
+        try:
+            pendientes = len(futuros)
+            while pendientes:
+                item = cola.get()
+                if item is fin:
+                    pendientes -= 1
+                    continue
+                yield item
+        finally:
+            parar.set()
+    # Errores de cualquier ventana (las demás ya se procesaron)
+    for f in futuros:
+        f.result()
+
+
+def ventanas(desde: date, hasta: date, dias: int = VENTANA_DIAS) -> list:
+    resultado = []
+    inicio = desde
+    while inicio <= hasta:
+        fin = min(hasta, inicio + timedelta(days=dias - 1))
+        resultado.append((inicio, fin))
+        inicio = fin + timedelta(days=1)
+    return resultado
+
+
+def guardar_en_lotes(conn, sql, filas, lote: int = LOTE_UPSERT) -> int:
+    # executemany arma un INSERT multi-fila por lote (solo placeholders en VALUES);
+    # commit por lote para no sostener locks mientras se descarga lo demás
+    total = 0
+    buffer = []
+    with conn.cursor() as cursor:
+        for fila in filas:
+            buffer.append(fila)
+            if len(buffer) >= lote:
+                cursor.executemany(sql, buffer)
+                conn.commit()
+                total += len(buffer)
+                buffer = []
+        if buffer:
+            cursor.executemany(sql, buffer)
+            conn.commit()
+            total += len(buffer)
+    return total
+
+
+# =========================================================
+# Marcas de agua (sync incremental)
+# =========================================================
+# Último día sincronizado por (fuente, cuenta). La siguiente corrida incremental pide
+# desde ese día menos la ventana que todavía puede cambiar.
+
+SYNC_WATERMARKS_DDL = """
+    CREATE TABLE IF NOT EXISTS sync_watermarks (
+        fuente VARCHAR(32) NOT NULL,
+        cuenta VARCHAR(64) NOT NULL,
+        ultimo_dia DATE NOT NULL,
+        actualizado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (fuente, cuenta)
+    )
+"""
 
+
+def leer_watermark(cursor, fuente: str, cuenta: str):
+    ensure_ddl("sync_watermarks", [SYNC_WATERMARKS_DDL])
+    cursor.execute("SELECT ultimo_dia FROM sync_watermarks WHERE fuente = %s AND cuenta = %s", (fuente, cuenta))
+    row = cursor.fetchone()
+    return row["ultimo_dia"] if row else None
+
+
+def guardar_watermark(cursor, fuente: str, cuenta: str, dia) -> None:
+    ensure_ddl("sync_watermarks", [SYNC_WATERMARKS_DDL])
+    cursor.execute("""
+        INSERT INTO sync_watermarks (fuente, cuenta, ultimo_dia) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE ultimo_dia = VALUES(ultimo_dia)
+    """, (fuente, cuenta, dia))
+
+
+def rango_sync(cursor, fuente: str, cuenta: str, modo: str, hoy: date = None):
+    hoy = hoy or date.today()
+    completo = (hoy - timedelta(days=DIAS_SYNC - 1), hoy)
+    if modo == "completo":
+        return completo
+    ultimo = leer_watermark(cursor, fuente, cuenta)
+    if ultimo is None:
+        return completo
+    # Días nuevos + la ventana de atribución; nunca más atrás que una corrida completa
+    return max(completo[0], ultimo - timedelta(days=DIAS_ATRIBUCION - 1)), hoy
+
+
+def hash_metricas(*valores) -> str:
+    return hashlib.sha1("|".join("" if v is None else str(v) for v in valores).encode("utf-8")).hexdigest()
+
+
+# =========================================================
+# Anuncios pagados -> ads_instagram_performance
+# =========================================================
+
+CAMPOS_PAGO = "date_start,campaign_id,campaign_name,ad_name,reach,impressions,frequency,spend"
+
+UPSERT_PAGO_SQL = """
+    INSERT INTO ads_instagram_performance
+        (dia, identificador_campana, nombre_campana, nombre_anuncio,
+         alcance, impresiones, frecuencia, importe_gastado, metricas_hash, fecha_importacion)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        nombre_campana = VALUES(nombre_campana),
+        nombre_anuncio = VALUES(nombre_anuncio),
+        alcance = VALUES(alcance),
+        impresiones = VALUES(impresiones),
+        frecuencia = VALUES(frecuencia),
+        importe_gastado = VALUES(importe_gastado),
+        metricas_hash = VALUES(metricas_hash),
+        fecha_importacion = VALUES(fecha_importacion)
+"""
+
+
+def asegurar_esquema_pago(cursor) -> None:
+    if not schema_cache.has_column(cursor, "ads_instagram_performance", "metricas_hash"):
+        cursor.execute("ALTER TABLE ads_instagram_performance ADD COLUMN metricas_hash CHAR(40) NULL")
+        invalidate_schema_cache()
+
+
+def hashes_pago(cursor, desde: date, hasta: date) -> dict:
+    cursor.execute("""
+        SELECT dia, identificador_campana, nombre_anuncio, metricas_hash
+        FROM ads_instagram_performance
+        WHERE dia BETWEEN %s AND %s
+    """, (desde, hasta))
+    return {
+        (str(r["dia"]), str(r["identificador_campana"]), r["nombre_anuncio"]): r["metricas_hash"]
+        for r in cursor.fetchall()
+    }
+
+
+def _cuenta_id() -> str:
+    # Nos aseguramos de que tenga el prefijo correcto que exige Meta
+    return AD_ACCOUNT_ID if AD_ACCOUNT_ID.startswith("act_") else f"act_{AD_ACCOUNT_ID}"
+
+
+def obtener_insights_pago(desde: date, hasta: date, sesion=None):
+    # Genera filas de insights día por día conforme llegan las páginas
+    sesion = sesion or crear_sesion()
+    url = f"{GRAPH_URL}/{_cuenta_id()}/insights"
+    lista_params = [
+        {
+            "level": "ad",  # Trae los datos detallados a nivel de anuncio
+            "fields": CAMPOS_PAGO,
+            "time_increment": 1,  # Nos desglosa la info día por día
+            "time_range": f'{{"since":"{inicio.isoformat()}","until":"{fin.isoformat()}"}}',
+            "access_token": ACCESS_TOKEN,
+            "limit": 150,
+        }
+        for inicio, fin in ventanas(desde, hasta)
+    ]
+    for pagina in paginas_concurrentes(sesion, url, lista_params):
+        yield from pagina
+
+
+def fila_pago(item, importado_en) -> tuple:
+    # Meta nos entrega strings, los formateamos al tipo de dato de MySQL
+    fila = (
+        item.get("date_start"),
+        item.get("campaign_id"),
+        item.get("campaign_name"),
+        item.get("ad_name"),
+        int(item.get("reach", 0) or 0),
+        int(item.get("impressions", 0) or 0),
+        float(item.get("frequency", 0.00) or 0),
+        float(item.get("spend", 0.00) or 0),
+    )
+    return fila + (hash_metricas(*fila), importado_en)
+
+
+def sincronizar_bd_pago(modo: str = "incremental"):
     if not ACCESS_TOKEN or not AD_ACCOUNT_ID:
         print("Faltan las credenciales de Meta Ads en las variables de entorno.")
-        return
-
-    records = obtener_insights_pago()
-    if not records:
-        print("No hay datos de pago para procesar.")
-        return
+        return None
 
+    inicio = time.monotonic()
+    importado_en = datetime.now().replace(microsecond=0)
+    resumen = {"modo": modo, "obtenidas": 0, "cambiadas": 0, "omitidas": 0}
     conn = get_connection()
     try:
         with conn.cursor() as cursor:
-            for item in records:
-                # Meta nos entrega strings, los formateamos al tipo de dato de tu MySQL
-                dia = item.get("date_start")
-                campana_id = item.get("campaign_id")
-                campana_nombre = item.get("campaign_name")
-                anuncio_nombre = item.get("ad_name")
-                
-                alcance = int(item.get("reach", 0))
-                impresiones = int(item.get("impressions", 0))
-                frecuencia = float(item.get("frequency", 0.00))
-                importe_gastado = float(item.get("spend", 0.00))
-                
-                # SQL adaptado exactamente a las columnas de tu nueva tabla
-                sql = """
-                    INSERT INTO tu_nombre_de_tabla_pagada 
-                        (dia, identificador_campana, nombre_campana, nombre_anuncio, 
-                         alcance, impresiones, frecuencia, importe_gastado, fecha_importacion)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
-                    ON DUPLICATE KEY UPDATE
-                        nombre_campana = VALUES(nombre_campana),
-                        nombre_anuncio = VALUES(nombre_anuncio),
-                        alcance = VALUES(alcance),
-                        impresiones = VALUES(impresiones),
-                        frecuencia = VALUES(frecuencia),
-                        importe_gastado = VALUES(importe_gastado),
-                        fecha_importacion = NOW()
-                """
-                
-                valores = (dia, campana_id, campana_nombre, anuncio_nombre, alcance, impresiones, frecuencia, importe_gastado)
-                cursor.execute(sql, valores)
-            
-            conn.commit()
-            print("¡Sincronización de campañas de pago guardada exitosamente!")
-            
+            asegurar_esquema_pago(cursor)
+            desde, hasta = rango_sync(cursor, "meta_ads", _cuenta_id(), modo)
+            existentes = hashes_pago(cursor, desde, hasta)
+        conn.commit()
+        resumen["desde"], resumen["hasta"] = desde, hasta
+        print(f"Consultando la API de Marketing para la cuenta {_cuenta_id()} ({modo}: {desde} a {hasta})...")
+
+        def filas_cambiadas():
+            # Solo se escriben filas nuevas o con métricas distintas a las guardadas
+            for item in obtener_insights_pago(desde, hasta):
+                fila = fila_pago(item, importado_en)
+                resumen["obtenidas"] += 1
+                if existentes.get((str(fila[0]), str(fila[1]), fila[3])) == fila[8]:
+                    resumen["omitidas"] += 1
+                    continue
+                resumen["cambiadas"] += 1
+                yield fila
+
+        guardar_en_lotes(conn, UPSERT_PAGO_SQL, filas_cambiadas())
+        with conn.cursor() as cursor:
+            guardar_watermark(cursor, "meta_ads", _cuenta_id(), hasta)
+        conn.commit()
+    except (GraphError, requests.RequestException) as e:
+        conn.rollback()
+        print(f"Error al obtener insights de pago: {e}")
+        return None
     except Exception as e:
         conn.rollback()
         print(f"Error guardando datos de pago en MySQL: {e}")
+        return None
     finally:
         conn.close()
 
+    resumen["segundos"] = round(time.monotonic() - inicio, 2)
+    print(f"Sync de pago ({modo}, {resumen['desde']} a {resumen['hasta']}): {resumen['obtenidas']} obtenidas, "
+          f"{resumen['cambiadas']} cambiadas, {resumen['omitidas']} sin cambios, {resumen['segundos']}s")
+    return resumen
+
+
 if __name__ == "__main__":
-    sincronizar_bd_pago()
+    # python sync_instagram.py [incremental|completo]
+    import sys
+    resumen = sincronizar_bd_pago(sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ("incremental", "completo") else "incremental")
+    if resumen is None:
+        sys.exit(SALIDA_SIN_CREDENCIALES if not (ACCESS_TOKEN and AD_ACCOUNT_ID) else 1)
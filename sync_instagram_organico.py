@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import requests
+
+from db import get_connection, schema_cache, invalidate_schema_cache
+from sync_instagram import (
+    ACCESS_TOKEN, GRAPH_URL, CONCURRENCIA, SALIDA_SIN_CREDENCIALES, GraphError,
+    crear_sesion, graph_get, paginas, guardar_en_lotes, leer_watermark, guardar_watermark,
+)
+
+# =========================================================
+# Publicaciones orgánicas -> organic_instagram_performance
+# =========================================================
+# Lista /{ig-user}/media desde la última publicación sincronizada (menos los días en
+# que sus métricas todavía cambian) y pide los insights de hasta LOTE_IDS publicaciones
+# por petición (?ids=a,b,c&fields=insights.metric(...)), varias peticiones en paralelo.
+#
+#   python sync_instagram_organico.py [incremental|completo]
+
+IG_USER_ID = os.environ.get("META_IG_USER_ID")
+
+# Primera corrida / modo completo: publicaciones de los últimos N días
+DIAS_ORGANICO = int(os.environ.get("META_ORGANICO_DIAS", 90))
+# Incremental: las métricas de una publicación siguen moviéndose unos días
+DIAS_ACTUALIZAR = int(os.environ.get("META_ORGANICO_DIAS_ACTUALIZAR", 7))
+LOTE_IDS = 50  # máximo de ids por petición en Graph API
+ZONA = ZoneInfo(os.environ.get("META_ZONA_HORARIA", "America/Mexico_City"))
+
+# Métrica de Graph API -> columna
+METRICAS = {
+    "reach": "alcance",
+    "views": "visualizaciones",
+    "likes": "me_gusta",
+    "comments": "comentarios",
+    "shares": "veces_compartido",
+    "saved": "veces_guardado",
+}
+CAMPOS_MEDIA = "id,timestamp,media_type,media_product_type,permalink,caption"
+
+ORGANICO_DDL = """
+    CREATE TABLE IF NOT EXISTS organic_instagram_performance (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        identificador_publicacion VARCHAR(64) NULL,
+        hora_publicacion DATETIME NULL,
+        tipo_publicacion VARCHAR(32) NULL,
+        enlace_permanente VARCHAR(255) NULL,
+        descripcion TEXT NULL,
+        alcance INT NULL,
+        visualizaciones INT NULL,
+        me_gusta INT NULL,
+        comentarios INT NULL,
+        veces_compartido INT NULL,
+        veces_guardado INT NULL,
+        fecha_importacion DATETIME NULL,
+        UNIQUE KEY uq_org_publicacion (identificador_publicacion),
+        KEY idx_org_hora_publicacion (hora_publicacion)
+    )
+"""
+
+# Columnas que el sync necesita si la tabla ya existía (importaciones CSV)
+COLUMNAS_SYNC = {
+    "identificador_publicacion": "VARCHAR(64) NULL",
+    "tipo_publicacion": "VARCHAR(32) NULL",
+    "enlace_permanente": "VARCHAR(255) NULL",
+    "descripcion": "TEXT NULL",
+    "fecha_importacion": "DATETIME NULL",
+}
+
+UPSERT_ORGANICO_SQL = """
+    INSERT INTO organic_instagram_performance
+        (identificador_publicacion, hora_publicacion, tipo_publicacion, enlace_permanente, descripcion,
+         alcance, visualizaciones, me_gusta, comentarios, veces_compartido, veces_guardado, fecha_importacion)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        hora_publicacion = VALUES(hora_publicacion),
+        tipo_publicacion = VALUES(tipo_publicacion),
+        enlace_permanente = VALUES(enlace_permanente),
+        descripcion = VALUES(descripcion),
+        alcance = VALUES(alcance),
+        visualizaciones = VALUES(visualizaciones),
+        me_gusta = VALUES(me_gusta),
+        comentarios = VALUES(comentarios),
+        veces_compartido = VALUES(veces_compartido),
+        veces_guardado = VALUES(veces_guardado),
+        fecha_importacion = VALUES(fecha_importacion)
+"""
+
+
+def _tiene_indice(cursor, tabla: str, nombre: str) -> bool:
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (tabla, nombre))
+    return cursor.fetchone() is not None
+
+
+def asegurar_esquema_organico(cursor) -> None:
+    cursor.execute(ORGANICO_DDL)
+    invalidate_schema_cache()
+    for col, tipo in COLUMNAS_SYNC.items():
+        if not schema_cache.has_column(cursor, "organic_instagram_performance", col):
+            cursor.execute(f"ALTER TABLE organic_instagram_performance ADD COLUMN {col} {tipo}")
+            invalidate_schema_cache()
+    # Filas importadas por CSV quedan con NULL: no chocan con el índice único
+    if not _tiene_indice(cursor, "organic_instagram_performance", "uq_org_publicacion"):
+        cursor.execute("ALTER TABLE organic_instagram_performance ADD UNIQUE KEY uq_org_publicacion (identificador_publicacion)")
+
+
+def _hora_local(timestamp: str) -> datetime:
+    # Graph entrega "2025-05-01T18:30:00+0000"; el dashboard agrupa por día local
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z").astimezone(ZONA).replace(tzinfo=None)
+
+
+def obtener_publicaciones(sesion, desde: datetime):
+    # Páginas de publicaciones (más recientes primero) con hora local >= desde
+    params = {
+        "fields": CAMPOS_MEDIA,
+        "since": int(desde.replace(tzinfo=ZONA).timestamp()),
+        "limit": LOTE_IDS,
+        "access_token": ACCESS_TOKEN,
+    }
+    for pagina in paginas(sesion, f"{GRAPH_URL}/{IG_USER_ID}/media", params):
+        recientes = [m for m in pagina if _hora_local(m["timestamp"]) >= desde]
+        if recientes:
+            yield recientes
+        if len(recientes) < len(pagina):
+            return
+
+
+def _valor(metrica: dict):
+    if metrica.get("values"):
+        return metrica["values"][0].get("value")
+    return (metrica.get("total_value") or {}).get("value")
+
+
+def _parsear_insights(nodo: dict) -> dict:
+    return {m["name"]: _valor(m) for m in ((nodo or {}).get("insights") or {}).get("data", [])}
+
+
+def obtener_metricas(sesion, media_ids: list) -> dict:
+    campos = f"insights.metric({','.join(METRICAS)})"
+    try:
+        datos = graph_get(sesion, f"{GRAPH_URL}/", {"ids": ",".join(media_ids), "fields": campos, "access_token": ACCESS_TOKEN})
+        return {mid: _parsear_insights(datos.get(mid)) for mid in media_ids}
+    except GraphError as e:
+        # Un tipo de publicación sin alguna métrica tumba el lote completo: se piden una por una
+        print(f"  Lote de insights falló ({e}); reintentando por publicación")
+    resultado = {}
+    for mid in media_ids:
+        try:
+            resultado[mid] = _parsear_insights(graph_get(sesion, f"{GRAPH_URL}/{mid}", {"fields": campos, "access_token": ACCESS_TOKEN}))
+        except GraphError as e:
+            print(f"  Sin insights para {mid}: {e}")
+            resultado[mid] = {}
+    return resultado
+
+
+def _filas(lote, futuro, importado_en):
+    metricas = futuro.result()
+    for m in lote:
+        valores = metricas.get(m["id"], {})
+        yield (
+            m["id"],
+            _hora_local(m["timestamp"]),
+            m.get("media_product_type") or m.get("media_type"),
+            m.get("permalink"),
+            m.get("caption"),
+        ) + tuple(valores.get(api) for api in METRICAS) + (importado_en,)
+
+
+def filas_organicas(desde: datetime, importado_en, sesion=None):
+    # Los insights de cada página se piden en paralelo (hasta CONCURRENCIA lotes en vuelo)
+    # mientras se sigue paginando; las filas salen en orden de publicación
+    sesion = sesion or crear_sesion()
+    with ThreadPoolExecutor(max_workers=max(1, CONCURRENCIA)) as ex:
+        en_vuelo = deque()
+        for pagina in obtener_publicaciones(sesion, desde):
+            for i in range(0, len(pagina), LOTE_IDS):
+                lote = pagina[i:i + LOTE_IDS]
+                en_vuelo.append((lote, ex.submit(obtener_metricas, sesion, [m["id"] for m in lote])))
+                if len(en_vuelo) >= CONCURRENCIA:
+                    yield from _filas(*en_vuelo.popleft(), importado_en)
+        while en_vuelo:
+            yield from _filas(*en_vuelo.popleft(), importado_en)
+
+
+def sincronizar_organico(modo: str = "incremental"):
+    if not ACCESS_TOKEN or not IG_USER_ID:
+        print("Faltan META_ACCESS_TOKEN o META_IG_USER_ID en las variables de entorno.")
+        return None
+
+    inicio = time.monotonic()
+    importado_en = datetime.now().replace(microsecond=0)
+    hoy = date.today()
+    resumen = {"modo": modo, "publicaciones": 0}
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            asegurar_esquema_organico(cursor)
+            ultimo = leer_watermark(cursor, "ig_organico", IG_USER_ID) if modo == "incremental" else None
+        conn.commit()
+        desde_dia = hoy - timedelta(days=DIAS_ORGANICO) if ultimo is None else ultimo - timedelta(days=DIAS_ACTUALIZAR)
+        desde = datetime.combine(desde_dia, datetime.min.time())
+        resumen["desde"] = desde_dia
+        print(f"Consultando publicaciones de Instagram {IG_USER_ID} ({modo}: desde {desde_dia})...")
+
+        mas_reciente = [ultimo]
+
+        def contar(filas):
+            for fila in filas:
+                resumen["publicaciones"] += 1
+                if mas_reciente[0] is None or fila[1].date() > mas_reciente[0]:
+                    mas_reciente[0] = fila[1].date()
+                yield fila
+
+        guardar_en_lotes(conn, UPSERT_ORGANICO_SQL, contar(filas_organicas(desde, importado_en)))
+        if mas_reciente[0] is not None:
+            with conn.cursor() as cursor:
+                # Marca = día de la publicación más reciente vista
+                guardar_watermark(cursor, "ig_organico", IG_USER_ID, mas_reciente[0])
+            conn.commit()
+    except (GraphError, requests.RequestException) as e:
+        conn.rollback()
+        print(f"Error al obtener publicaciones orgánicas: {e}")
+        return None
+    except Exception as e:
+        conn.rollback()
+        print(f"Error guardando publicaciones orgánicas en MySQL: {e}")
+        return None
+    finally:
+        conn.close()
+
+    resumen["segundos"] = round(time.monotonic() - inicio, 2)
+    print(f"Sync orgánico ({modo}, desde {resumen['desde']}): {resumen['publicaciones']} publicaciones, {resumen['segundos']}s")
+    return resumen
+
+
+if __name__ == "__main__":
+    resumen = sincronizar_organico(sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ("incremental", "completo") else "incremental")
+    if resumen is None:
+        sys.exit(SALIDA_SIN_CREDENCIALES if not (ACCESS_TOKEN and IG_USER_ID) else 1)